@@ -2,6 +2,8 @@
 ASGI config for recursivegarden project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+HTTP requests go to Django, where ``/api/async/`` is served by async views,
+and ``/ws/canvas/`` to the canvas WebSocket.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
@@ -11,6 +13,24 @@ import os
 
 from django.core.asgi import get_asgi_application
 
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'recursivegarden.settings')
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported once Django is set up, since it loads models.
+from backend.zettle.sockets import CanvasSocket  # noqa: E402
+
+CANVAS_SOCKET_PATH = "/ws/canvas/"
+
+canvas_socket = CanvasSocket()
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "websocket":
+        if scope["path"] != CANVAS_SOCKET_PATH:
+            await receive()
+            await send({"type": "websocket.close"})
+            return
+        await canvas_socket(scope, receive, send)
+        return
+    await django_application(scope, receive, send)
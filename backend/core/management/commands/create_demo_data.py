@@ -4,6 +4,7 @@ from django.db import transaction
 
 from backend.users.models import User
 from backend.zettle.models import ZettleCard
+from backend.zettle.sequences import place_cards
 
 DEMO_USERS = [
     ("superadmin", "Super Admin User", "admin@example.com"),
@@ -144,14 +145,13 @@ class Command(BaseCommand):
             self.create_card(reply_data)
 
         # Create sequence cards
-        prev_card = card
+        sequence_cards = []
         for seq_data in sequence:
             seq_data["card_type"] = ZettleCard.CardType.TEXT
             seq_data["author"] = author
-            next_card = self.create_card(seq_data)
-            prev_card.next = next_card
-            prev_card.save()
-            prev_card = next_card
+            sequence_cards.append(self.create_card(seq_data))
+        if sequence_cards:
+            place_cards(card, sequence_cards, at_end=True)
 
         return card
 
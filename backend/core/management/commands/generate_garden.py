@@ -0,0 +1,60 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from backend.zettle.generator import BATCH_SIZE, GardenGenerator, update_indexes
+
+
+class Command(BaseCommand):
+    help = (
+        "Add a synthetic garden of any size for load testing. The same seed "
+        "always yields the same cards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--cards", type=int, default=100_000)
+        parser.add_argument("--seed", type=int, default=42)
+        parser.add_argument(
+            "--users", type=int, default=10, help="Authors to spread the cards over."
+        )
+        parser.add_argument(
+            "--blobs",
+            action="store_true",
+            help="Give some image and text cards stored files.",
+        )
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+        parser.add_argument(
+            "--skip-indexes",
+            action="store_true",
+            help="Leave the tiles and search index to be rebuilt later.",
+        )
+
+    def handle(self, *args, **options):
+        generator = GardenGenerator(
+            seed=options["seed"],
+            users=options["users"],
+            blobs=options["blobs"],
+            batch_size=options["batch_size"],
+        )
+        start = time.perf_counter()
+
+        def progress(created):
+            rate = created / (time.perf_counter() - start)
+            self.stdout.write(f"{created} cards ({rate:,.0f}/s)")
+
+        tag_links = generator.generate(options["cards"], progress)
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Created {options['cards']} cards and {tag_links} tag links in "
+                f"{elapsed:.1f}s ({options['cards'] / elapsed:,.0f} cards/s)"
+            )
+        )
+        if not options["skip_indexes"]:
+            start = time.perf_counter()
+            update_indexes()
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Updated the indexes in {time.perf_counter() - start:.1f}s"
+                )
+            )
@@ -0,0 +1,182 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Upper bounds of the histogram buckets, in seconds, queries and bytes.
+DURATION_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+QUERY_BUCKETS = [0, 1, 2, 3, 5, 10, 20, 50, 100, 200]
+SIZE_BUCKETS = [1_000, 10_000, 100_000, 1_000_000, 10_000_000]
+
+# Transaction control, which isn't counted as queries: requests open a
+# transaction outside tests but a savepoint inside one.
+TRANSACTION_STATEMENTS = ("BEGIN", "SAVEPOINT", "RELEASE SAVEPOINT", "ROLLBACK")
+
+
+class Histogram:
+    """Cumulative bucket counts for one set of labels, as Prometheus reads them."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        # Bucket counts are kept per bucket and summed when rendered.
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """The histograms of one process, by metric name and label values.
+
+    Observations take a lock held for a few dict lookups, so recording is
+    cheap enough to leave on for every request.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def define(self, name, help, buckets, labels):
+        self.metrics[name] = {
+            "help": help,
+            "buckets": buckets,
+            "labels": labels,
+            "series": {},
+        }
+
+    def observe(self, name, value, labels):
+        metric = self.metrics[name]
+        with self.lock:
+            histogram = metric["series"].get(labels)
+            if histogram is None:
+                histogram = metric["series"][labels] = Histogram(metric["buckets"])
+            histogram.observe(value)
+
+    def clear(self):
+        with self.lock:
+            for metric in self.metrics.values():
+                metric["series"].clear()
+
+    def render(self) -> str:
+        """The histograms in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for name, metric in self.metrics.items():
+                lines.append(f"# HELP {name} {metric['help']}")
+                lines.append(f"# TYPE {name} histogram")
+                for labels, histogram in sorted(metric["series"].items()):
+                    label_text = ",".join(
+                        f'{label}="{_escape(value)}"'
+                        for label, value in zip(metric["labels"], labels)
+                    )
+                    prefix = f"{label_text}," if label_text else ""
+                    cumulative = 0
+                    for bound, count in zip(
+                        [*histogram.buckets, "+Inf"], histogram.counts
+                    ):
+                        cumulative += count
+                        lines.append(
+                            f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}'
+                        )
+                    lines.append(f"{name}_sum{{{label_text}}} {histogram.sum}")
+                    lines.append(f"{name}_count{{{label_text}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REGISTRY = Registry()
+REQUEST_LABELS = ["view", "action", "method", "status"]
+REGISTRY.define(
+    "http_request_duration_seconds",
+    "Time to answer a request.",
+    DURATION_BUCKETS,
+    REQUEST_LABELS,
+)
+REGISTRY.define(
+    "http_request_db_queries",
+    "Database queries made by a request.",
+    QUERY_BUCKETS,
+    REQUEST_LABELS,
+)
+REGISTRY.define(
+    "http_request_db_duration_seconds",
+    "Time a request spent in database queries.",
+    DURATION_BUCKETS,
+    REQUEST_LABELS,
+)
+REGISTRY.define(
+    "http_request_serialize_duration_seconds",
+    "Time a request spent in serializers.",
+    DURATION_BUCKETS,
+    REQUEST_LABELS,
+)
+REGISTRY.define(
+    "http_request_template_duration_seconds",
+    "Time a request spent rendering templates.",
+    DURATION_BUCKETS,
+    REQUEST_LABELS,
+)
+REGISTRY.define(
+    "http_response_size_bytes",
+    "Size of a response body. Streamed responses are left out.",
+    SIZE_BUCKETS,
+    REQUEST_LABELS,
+)
+
+
+class RequestMetrics:
+    """What one request spent its time on, filled in as it runs."""
+
+    def __init__(self, max_queries):
+        self.max_queries = max_queries
+        self.query_count = 0
+        self.db_time = 0.0
+        self.queries = []
+        self.timings = {"serialize": 0.0, "template": 0.0}
+        self.active = set()
+
+    def __call__(self, execute, sql, params, many, context):
+        """Time a query, as a database execute wrapper."""
+        if sql.startswith(TRANSACTION_STATEMENTS):
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.query_count += 1
+            self.db_time += elapsed
+            # Only kept by reference; formatted if the request is logged.
+            if len(self.queries) < self.max_queries:
+                self.queries.append((elapsed, sql, params, many))
+
+
+current_request = ContextVar("current_request", default=None)
+
+
+@contextmanager
+def timed(phase):
+    """Add the time spent in the block to the current request's ``phase``.
+
+    Nested blocks of the same phase, such as a serializer inside a list
+    serializer, are only counted once.
+    """
+    metrics = current_request.get()
+    if metrics is None or phase in metrics.active:
+        yield
+        return
+    metrics.active.add(phase)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.timings[phase] += time.perf_counter() - start
+        metrics.active.discard(phase)
@@ -0,0 +1,164 @@
+import logging
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connection
+from rest_framework.response import Response
+
+from backend.core.metrics import REGISTRY, RequestMetrics, current_request
+
+logger = logging.getLogger(__name__)
+
+# Requests slower than this are logged with their queries.
+SLOW_REQUEST_SECONDS = 1.0
+
+# At most one slow request per view is logged in this many seconds.
+SLOW_LOG_INTERVAL = 60.0
+
+# Queries kept per request for the slow log.
+MAX_LOGGED_QUERIES = 50
+
+
+class MetricsMiddleware:
+    """Records each request's timings in the metrics histograms.
+
+    The total time, database queries and time, serializer and template time
+    and response size are labelled by URL name and viewset action, never by
+    path, so the number of series stays bounded. A slow request is logged
+    with its slowest queries, at most once per view every
+    ``METRICS_SLOW_LOG_INTERVAL`` seconds.
+
+    It runs async under ASGI, so async views aren't passed through a thread.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+        self.slow_seconds = getattr(
+            settings, "METRICS_SLOW_REQUEST_SECONDS", SLOW_REQUEST_SECONDS
+        )
+        self.slow_interval = getattr(
+            settings, "METRICS_SLOW_LOG_INTERVAL", SLOW_LOG_INTERVAL
+        )
+        self.last_logged = {}
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics = RequestMetrics(MAX_LOGGED_QUERIES)
+        token = current_request.set(metrics)
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(metrics):
+                response = self.get_response(request)
+        finally:
+            current_request.reset(token)
+        return self.record(request, response, metrics, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics(MAX_LOGGED_QUERIES)
+        token = current_request.set(metrics)
+        start = time.perf_counter()
+        # Async queries run on the request's sync thread, whose connection
+        # the wrapper must be installed on.
+        await sync_to_async(watch_queries)(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(unwatch_queries)(metrics)
+            current_request.reset(token)
+        return self.record(request, response, metrics, time.perf_counter() - start)
+
+    def record(self, request, response, metrics, duration):
+        labels = self.labels(request, response)
+        if labels[0] == "metrics":
+            return response
+        REGISTRY.observe("http_request_duration_seconds", duration, labels)
+        REGISTRY.observe("http_request_db_queries", metrics.query_count, labels)
+        REGISTRY.observe("http_request_db_duration_seconds", metrics.db_time, labels)
+        REGISTRY.observe(
+            "http_request_serialize_duration_seconds",
+            metrics.timings["serialize"],
+            labels,
+        )
+        REGISTRY.observe(
+            "http_request_template_duration_seconds",
+            metrics.timings["template"],
+            labels,
+        )
+        if not response.streaming:
+            REGISTRY.observe("http_response_size_bytes", len(response.content), labels)
+        if duration >= self.slow_seconds:
+            self.log_slow_request(request, labels, duration, metrics)
+        return response
+
+    def process_template_response(self, request, response):
+        metrics = current_request.get()
+        if metrics is not None:
+            # Template responses are rendered after the view returns, by the
+            # handler, before the response comes back here. An API response's
+            # rendering is the JSON encoding, counted with its serializers.
+            phase = "serialize" if isinstance(response, Response) else "template"
+            start = time.perf_counter()
+
+            def record(response):
+                metrics.timings[phase] += time.perf_counter() - start
+
+            response.add_post_render_callback(record)
+        return response
+
+    def labels(self, request, response):
+        match = request.resolver_match
+        if match is None:
+            return "unmatched", "", request.method, str(response.status_code)
+        # ViewSet routes map each method to an action.
+        actions = getattr(match.func, "actions", None) or {}
+        return (
+            match.url_name or match.view_name,
+            actions.get(request.method.lower(), ""),
+            request.method,
+            str(response.status_code),
+        )
+
+    def log_slow_request(self, request, labels, duration, metrics):
+        now = time.monotonic()
+        view = labels[:2]
+        if now - self.last_logged.get(view, -self.slow_interval) < self.slow_interval:
+            return
+        self.last_logged[view] = now
+        slowest = sorted(metrics.queries, key=lambda query: -query[0])[:10]
+        logger.warning(
+            "Slow request %s %s took %.0fms: %d queries in %.0fms, serializing "
+            "%.0fms, templates %.0fms\n%s",
+            request.method,
+            request.get_full_path(),
+            duration * 1000,
+            metrics.query_count,
+            metrics.db_time * 1000,
+            metrics.timings["serialize"] * 1000,
+            metrics.timings["template"] * 1000,
+            "\n".join(
+                f"  {elapsed * 1000:.1f}ms: {sql} {_format_params(params, many)}"
+                for elapsed, sql, params, many in slowest
+            ),
+        )
+
+
+def watch_queries(metrics):
+    connection.execute_wrappers.append(metrics)
+
+
+def unwatch_queries(metrics):
+    connection.execute_wrappers.remove(metrics)
+
+
+def _format_params(params, many):
+    if many:
+        # executemany's rows could fill the log.
+        return f"({len(params)} rows)" if hasattr(params, "__len__") else "(many)"
+    return repr(params)
@@ -0,0 +1,62 @@
+from django.core.exceptions import ValidationError as DjangoValidationError
+from rest_framework import serializers
+from rest_framework.relations import MANY_RELATION_KWARGS
+
+from backend.core.metrics import timed
+
+
+class TimedSerializerMixin:
+    """Adds the time spent serializing to the request's metrics.
+
+    Set ``Meta.list_serializer_class`` to ``TimedListSerializer`` as well, so
+    lists are timed as a whole rather than item by item.
+    """
+
+    @property
+    def data(self):
+        with timed("serialize"):
+            return super().data
+
+
+class TimedListSerializer(TimedSerializerMixin, serializers.ListSerializer):
+    pass
+
+
+class BatchedManyRelatedField(serializers.ManyRelatedField):
+    """Looks up every related primary key in one query, not one per item."""
+
+    def to_internal_value(self, data):
+        if isinstance(data, str) or not hasattr(data, "__iter__"):
+            self.fail("not_a_list", input_type=type(data).__name__)
+        if not self.allow_empty and len(data) == 0:
+            self.fail("empty")
+        child = self.child_relation
+        queryset = child.get_queryset()
+        pks = []
+        for item in data:
+            if child.pk_field is not None:
+                item = child.pk_field.to_internal_value(item)
+            try:
+                if isinstance(item, bool):
+                    raise TypeError
+                pks.append(queryset.model._meta.pk.to_python(item))
+            except (TypeError, DjangoValidationError):
+                child.fail("incorrect_type", data_type=type(item).__name__)
+        found = queryset.in_bulk(pks)
+        for pk in pks:
+            if pk not in found:
+                child.fail("does_not_exist", pk_value=pk)
+        return [found[pk] for pk in pks]
+
+
+class BatchedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """``PrimaryKeyRelatedField`` whose ``many=True`` lists validate in one query."""
+
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        list_kwargs = {
+            key: value for key, value in kwargs.items() if key in MANY_RELATION_KWARGS
+        }
+        return BatchedManyRelatedField(
+            child_relation=cls(*args, **kwargs), **list_kwargs
+        )
@@ -0,0 +1,21 @@
+from django.http import HttpResponse
+from rest_framework.permissions import IsAdminUser
+from rest_framework.views import APIView
+from rest_framework_api_key.permissions import HasAPIKey
+
+from backend.core.metrics import REGISTRY
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class MetricsView(APIView):
+    """This process's request metrics, in the Prometheus text format.
+
+    Scrapers authenticate with an API key (``Authorization: Api-Key …``);
+    staff can also read it in the browser.
+    """
+
+    permission_classes = [HasAPIKey | IsAdminUser]
+
+    def get(self, request):
+        return HttpResponse(REGISTRY.render(), content_type=CONTENT_TYPE)
@@ -1,7 +1,10 @@
 from django.contrib import admin
 from django.urls import include, path
 
+from backend.core.views import MetricsView
+
 urlpatterns = [
     path("admin/", admin.site.urls),
+    path("metrics", MetricsView.as_view(), name="metrics"),
     path("", include("backend.zettle.urls")),
 ]
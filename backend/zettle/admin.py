@@ -1,7 +1,52 @@
 from django.contrib import admin
-from django.db.models import Count
+from django.core.paginator import Paginator
+from django.db import DatabaseError, connection, transaction
+from django.utils.functional import cached_property
 
-from backend.zettle.models import ZettleCard
+from backend.zettle.models import Blob, Vote, ZettleCard
+
+# Unfiltered changelists of tables estimated at this many rows or more show
+# the estimate rather than counting every row.
+ESTIMATE_COUNTS_AT = 10_000
+
+# The planner's row estimate for a table, kept up to date by ANALYZE.
+ESTIMATE_SQL = {
+    "postgresql": "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+    # The first number of an index's statistics is the table's row count.
+    "sqlite": "SELECT CAST(stat AS INTEGER) FROM sqlite_stat1 WHERE tbl = %s LIMIT 1",
+}
+
+
+def estimate_count(model) -> int | None:
+    """The database's estimate of a table's rows, or None if it has none."""
+    sql = ESTIMATE_SQL.get(connection.vendor)
+    if sql is None:
+        return None
+    try:
+        # A savepoint, since the statistics table may not exist yet.
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(sql, [model._meta.db_table])
+            row = cursor.fetchone()
+    except DatabaseError:
+        return None
+    return row[0] if row else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """Uses the row estimate for unfiltered lists of large tables.
+
+    Counting every row takes seconds on a large table. Filtered lists are
+    still counted exactly, through the filter's index.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimate_count(queryset.model)
+            if estimate is not None and estimate >= ESTIMATE_COUNTS_AT:
+                return estimate
+        return super().count
 
 
 @admin.register(ZettleCard)
@@ -12,14 +57,27 @@ class ZettleCardAdmin(admin.ModelAdmin):
         "author",
         "votes",
         "child_count",
+        "reply_count",
+        "tag_count",
         "created_at",
         "updated_at",
     ]
     list_filter = ["card_type", "author", "created_at", "updated_at"]
     search_fields = ["title", "text", "url", "author__username"]
-    readonly_fields = ["created_at", "updated_at", "uuid"]
-    raw_id_fields = ["parent", "next", "reply_to"]
-    filter_horizontal = ["tags"]
+    readonly_fields = [
+        "created_at",
+        "updated_at",
+        "uuid",
+        "child_count",
+        "reply_count",
+        "tag_count",
+    ]
+    # Picking from a list would load every user or card into the form.
+    raw_id_fields = ["author", "parent", "next", "reply_to", "tags"]
+    # Counts are stored on the cards, and the total is estimated, so a page
+    # never counts over the whole table.
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
     fieldsets = [
         (None, {"fields": ["card_type", "author", "title", "votes"]}),
@@ -50,21 +108,34 @@ class ZettleCardAdmin(admin.ModelAdmin):
         (
             "Metadata",
             {
-                "fields": ["uuid", "created_at", "updated_at"],
+                "fields": [
+                    "uuid",
+                    "child_count",
+                    "reply_count",
+                    "tag_count",
+                    "created_at",
+                    "updated_at",
+                ],
             },
         ),
     ]
 
-    def get_queryset(self, request):
-        return super().get_queryset(request).annotate(child_count=Count("children"))
-
-    def child_count(self, obj):
-        return obj.child_count
-
-    child_count.admin_order_field = "child_count"
-    child_count.short_description = "Children"
-
     def save_model(self, request, obj, form, change):
         if not obj.author:
             obj.author = request.user
         super().save_model(request, obj, form, change)
+
+
+@admin.register(Vote)
+class VoteAdmin(admin.ModelAdmin):
+    list_display = ["card", "user", "value", "created_at"]
+    list_filter = ["value", "created_at"]
+    raw_id_fields = ["card", "user"]
+
+
+@admin.register(Blob)
+class BlobAdmin(admin.ModelAdmin):
+    list_display = ["name", "size", "ref_count", "created_at"]
+    list_filter = ["created_at"]
+    search_fields = ["sha256", "name"]
+    readonly_fields = ["sha256", "name", "size", "ref_count", "created_at"]
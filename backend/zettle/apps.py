@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ZettleConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "backend.zettle"
+
+    def ready(self):
+        from backend.zettle import signals  # noqa: F401
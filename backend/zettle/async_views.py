@@ -0,0 +1,153 @@
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.http import Http404, HttpResponse
+from django.utils.dateparse import parse_datetime
+from django.utils.decorators import method_decorator
+from django.views import View
+from rest_framework.request import Request
+from rest_framework.views import exception_handler
+
+from backend.core.renderers import FastJSONRenderer
+from backend.zettle.hierarchy import afetch_subtree, walk_subtree
+from backend.zettle.models import ZettleCard
+from backend.zettle.references import aresolve_references
+from backend.zettle.search import get_search_backend
+from backend.zettle.sync import agarden_version, make_etag
+from backend.zettle.views import (
+    SEARCH_CARDS,
+    ZettleCardViewSet,
+    add_validators,
+    canvas_rows,
+    not_modified,
+    search_hits,
+)
+
+JSON = "application/json"
+
+
+@method_decorator(transaction.non_atomic_requests, name="dispatch")
+class AsyncCardView(View):
+    """A card read served with the async ORM, for ASGI deployments.
+
+    Filtering, ordering, pagination and serialization are the
+    ``ZettleCardViewSet``'s, driven through an instance of it, so responses
+    match the sync API's. Queries run through ``aget``, ``acount`` and
+    ``aiterator``, so the event loop serves other requests while they wait.
+    Everything a serializer reads is loaded before it runs, as it can't
+    query from async code.
+
+    Only JSON is rendered, and there's no per-request transaction, which
+    Django doesn't allow for async views.
+    """
+
+    action = None
+    http_method_names = ["get", "head", "options"]
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.viewset = ZettleCardViewSet(
+            request=Request(request),
+            args=args,
+            kwargs=kwargs,
+            action=self.action,
+            format_kwarg=None,
+        )
+        try:
+            return await super().dispatch(request, *args, **kwargs)
+        except Exception as exc:
+            response = exception_handler(exc, {"view": self.viewset})
+            if response is None:
+                raise
+            return json_response(response.data, response.status_code)
+
+    async def get_object(self):
+        try:
+            card = await self.viewset.get_queryset().aget(uuid=self.kwargs["uuid"])
+        except ZettleCard.DoesNotExist:
+            raise Http404
+        self.viewset.check_object_permissions(self.viewset.request, card)
+        return card
+
+    async def resolve_references(self, cards):
+        """Load what model cards point to, when the response includes it.
+
+        The serializer would otherwise load it with a sync query.
+        """
+        if "reference" in self.viewset.get_serializer().fields:
+            await aresolve_references(cards)
+
+
+class AsyncCardList(AsyncCardView):
+    action = "list"
+
+    async def get(self, request):
+        changed, deleted = await agarden_version()
+        etag = make_etag(request.get_full_path(), JSON, changed, deleted)
+        last_modified = max(filter(None, [changed, deleted]), default=None)
+        response = not_modified(request, etag, last_modified)
+        if response is None:
+            response = await self.list()
+        return add_validators(response, etag, last_modified)
+
+    async def list(self):
+        viewset = self.viewset
+        canvas = viewset.request.query_params.get("view") == "canvas"
+        queryset = viewset.canvas_queryset if canvas else viewset.get_queryset
+        # Filters may look up tags or run a search, which only sync code can.
+        queryset = await sync_to_async(viewset.filter_queryset)(queryset())
+        page = await viewset.paginator.apaginate_queryset(queryset, viewset.request)
+        if canvas:
+            data = canvas_rows(page)
+        else:
+            await self.resolve_references(page)
+            data = viewset.get_serializer(page, many=True).data
+        response = viewset.get_paginated_response(data)
+        return json_response(response.data)
+
+
+class AsyncCardDetail(AsyncCardView):
+    action = "retrieve"
+
+    async def get(self, request, uuid):
+        if not self.viewset.request.query_params:
+            # Misses load and serialize the card in a sync thread.
+            data = await sync_to_async(self.viewset.cached_card)()
+            updated_at = parse_datetime(data["updated_at"])
+            etag = make_etag(data["uuid"], JSON, updated_at.timestamp())
+            response = not_modified(request, etag, updated_at)
+            if response is None:
+                response = json_response(data)
+            return add_validators(response, etag, updated_at)
+
+        card = await self.get_object()
+        etag = make_etag(card.uuid, JSON, card.updated_at.timestamp())
+        response = not_modified(request, etag, card.updated_at)
+        if response is None:
+            await self.resolve_references([card])
+            response = json_response(self.viewset.get_serializer(card).data)
+        return add_validators(response, etag, card.updated_at)
+
+
+class AsyncCardTree(AsyncCardView):
+    action = "tree"
+
+    async def get(self, request, uuid):
+        card = await self.get_object()
+        depth, ordering = self.viewset.tree_params(self.viewset.request)
+        root = await afetch_subtree(card, depth, ordering)
+        await self.resolve_references(list(walk_subtree(root)))
+        return json_response(self.viewset.nest_tree(root))
+
+
+class AsyncCardSearch(AsyncCardView):
+    action = "search"
+
+    async def get(self, request):
+        params = self.viewset.search_params(self.viewset.request)
+        # Backends query through raw cursors, which only sync code can use.
+        results = await sync_to_async(get_search_backend().search)(*params)
+        cards = await SEARCH_CARDS.ain_bulk([card_id for card_id, _, _ in results])
+        return json_response(search_hits(results, cards))
+
+
+def json_response(data, status=200):
+    return HttpResponse(FastJSONRenderer().render(data), JSON, status=status)
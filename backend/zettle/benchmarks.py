@@ -0,0 +1,444 @@
+import asyncio
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from urllib.parse import urlencode
+
+from django.core.handlers.wsgi import WSGIHandler
+from django.db import connection
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from backend.core.metrics import TRANSACTION_STATEMENTS
+from backend.zettle.models import ZettleCard
+
+# Requests timed per scenario by default.
+REQUESTS = 50
+
+# Cards sampled from the garden to pick request targets from.
+SAMPLE_SIZE = 1000
+
+# Most used tags to pick ``?tags=`` filters from.
+TAG_SAMPLE_SIZE = 20
+
+# Cards shifted by one ``move`` request.
+MOVED_CARDS = 20
+
+# Content types the generated model cards point to. Serialized cards make
+# one more query for each of them found among the cards.
+REFERENCE_TYPES = 2
+
+# Concurrent clients the sync and async reads are compared at by default.
+CONCURRENCY = [1, 8, 32]
+
+# Reads with both a sync and an async view.
+CONCURRENT_READS = ["list", "detail", "tree", "search"]
+
+# Worker threads of the simulated sync server, like a threaded WSGI server's.
+SYNC_THREADS = 8
+
+# Host the benchmark's requests are sent to, as the test client's are.
+HOST = "testserver"
+
+# Most queries each scenario may make, whatever the size of the garden. A
+# count that grows with the page or the garden is an N+1 regression.
+QUERY_BUDGETS = {
+    # Two for the garden version behind the ETag, one for the page count.
+    "list": 5 + REFERENCE_TYPES,
+    "list_sparse": 4,
+    "list_canvas": 4,
+    # Plus one for the object a model card points to.
+    "detail": 3,
+    "filter_type": 5,
+    "filter_bbox": 5 + REFERENCE_TYPES,
+    "filter_tag": 5 + REFERENCE_TYPES,
+    "filter_model": 5 + REFERENCE_TYPES,
+    # Plus one to look up the tags' ids.
+    "filter_tags": 6 + REFERENCE_TYPES,
+    "tag_directory": 1,
+    "ordering_votes": 5 + REFERENCE_TYPES,
+    "search": 2,
+    "search_filter": 6 + REFERENCE_TYPES,
+    "thread": 2 + REFERENCE_TYPES,
+    "tree": 3 + REFERENCE_TYPES,
+    # Plus one per tile whose top card moves out of it.
+    "move": 8,
+}
+
+
+class QueryCounter:
+    """A database execute wrapper that counts the queries run through it.
+
+    Transaction control is left out, as in the request metrics. Unlike ``CaptureQueriesContext``, this
+    doesn't read ``connection.queries``, whose log stops growing once full.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        if not sql.startswith(TRANSACTION_STATEMENTS):
+            self.count += 1
+        return execute(sql, params, many, context)
+
+
+def percentile(timings, fraction):
+    """The timing below which ``fraction`` of the sorted ``timings`` fall."""
+    index = min(len(timings) - 1, round(fraction * (len(timings) - 1)))
+    return timings[index]
+
+
+class Benchmark:
+    """Times the card API's main requests against the current garden.
+
+    Requests go through the full Django stack with the test client, so the
+    timings include routing, middleware, serialization and rendering, but
+    not the network. Each scenario makes two untimed requests first: one to
+    warm caches, such as ContentType's, as a running server's would be, and
+    one whose queries are counted. Then come ``requests`` timed ones against
+    cards picked from a sample with a fixed seed.
+    """
+
+    def __init__(self, requests=REQUESTS, seed=42, client=None):
+        self.requests = requests
+        self.rng = random.Random(seed)
+        self.client = client or APIClient()
+        self.scenarios = {
+            "list": self.list,
+            "list_sparse": self.list_sparse,
+            "list_canvas": self.list_canvas,
+            "detail": self.detail,
+            "filter_type": self.filter_type,
+            "filter_bbox": self.filter_bbox,
+            "filter_tag": self.filter_tag,
+            "filter_model": self.filter_model,
+            "filter_tags": self.filter_tags,
+            "tag_directory": self.tag_directory,
+            "ordering_votes": self.ordering_votes,
+            "search": self.search,
+            "search_filter": self.search_filter,
+            "thread": self.thread,
+            "tree": self.tree,
+            "move": self.move,
+        }
+        self.moves = 0
+
+    def sample(self):
+        """Pick the cards and words the requests are made for."""
+        last_id = ZettleCard.objects.order_by("-pk").values_list("pk", flat=True)
+        last_id = last_id.first() or 0
+        ids = self.rng.sample(range(1, last_id + 1), min(last_id, SAMPLE_SIZE))
+        cards = list(
+            ZettleCard.objects.filter(pk__in=ids).values(
+                "uuid", "title", "x", "y", "reply_to__uuid"
+            )
+        )
+        self.cards = cards or [{"uuid": None, "title": "", "x": 0, "y": 0}]
+        self.placed = [card for card in self.cards if card["x"] is not None]
+        self.threads = [
+            card["reply_to__uuid"] for card in cards if card["reply_to__uuid"]
+        ]
+        self.words = [
+            word for card in self.cards for word in card["title"].split()
+        ] or ["garden"]
+        self.tags = [
+            str(uuid)
+            for uuid in ZettleCard.objects.filter(tag_count__gt=0)
+            .order_by("-tag_count", "-id")
+            .values_list("uuid", flat=True)[:TAG_SAMPLE_SIZE]
+        ]
+
+    def run(self, names=None):
+        """Results for each scenario in ``names``, by default all of them."""
+        self.sample()
+        return {name: self.run_scenario(name) for name in names or self.scenarios}
+
+    def run_scenario(self, name):
+        request = self.scenarios[name]
+        request()
+        queries = QueryCounter()
+        with connection.execute_wrapper(queries):
+            response = request()
+        timings = []
+        start = time.perf_counter()
+        for _ in range(self.requests):
+            began = time.perf_counter()
+            request()
+            timings.append(time.perf_counter() - began)
+        elapsed = time.perf_counter() - start
+        timings.sort()
+        return {
+            "status": response.status_code,
+            "requests": self.requests,
+            "queries": queries.count,
+            "query_budget": QUERY_BUDGETS[name],
+            "mean_ms": round(statistics.fmean(timings) * 1000, 3),
+            "p50_ms": round(percentile(timings, 0.5) * 1000, 3),
+            "p95_ms": round(percentile(timings, 0.95) * 1000, 3),
+            "p99_ms": round(percentile(timings, 0.99) * 1000, 3),
+            "throughput": round(self.requests / elapsed, 1),
+        }
+
+    def card(self, cards=None):
+        return self.rng.choice(cards or self.cards)
+
+    def list(self):
+        return self.client.get(reverse("zettle:zettlecard-list"))
+
+    def list_sparse(self):
+        return self.client.get(
+            reverse("zettle:zettlecard-list"), {"fields": "uuid,title,x,y"}
+        )
+
+    def list_canvas(self):
+        return self.client.get(reverse("zettle:zettlecard-list"), {"view": "canvas"})
+
+    def detail(self):
+        return self.client.get(
+            reverse("zettle:zettlecard-detail", args=[self.card()["uuid"]])
+        )
+
+    def filter_type(self):
+        return self.client.get(
+            reverse("zettle:zettlecard-list"),
+            {"card_type": self.rng.choice(["text", "url", "topic"])},
+        )
+
+    def filter_bbox(self):
+        card = self.card(self.placed)
+        x, y = card["x"], card["y"]
+        bbox = f"{x - 2000},{y - 2000},{x + 2000},{y + 2000}"
+        return self.client.get(reverse("zettle:zettlecard-list"), {"bbox": bbox})
+
+    def filter_tag(self):
+        return self.client.get(
+            reverse("zettle:zettlecard-list"), {"tag": self.rng.choice(self.words)}
+        )
+
+    def filter_model(self):
+        return self.client.get(
+            reverse("zettle:zettlecard-list"), {"card_type": "model"}
+        )
+
+    def filter_tags(self):
+        # Two of the most used tags, so the intersection isn't empty.
+        tags = self.rng.sample(self.tags, min(len(self.tags), 2))
+        return self.client.get(
+            reverse("zettle:zettlecard-list"), {"tags": ",".join(tags)}
+        )
+
+    def tag_directory(self):
+        return self.client.get(reverse("zettle:zettlecard-tag-directory"))
+
+    def ordering_votes(self):
+        return self.client.get(
+            reverse("zettle:zettlecard-list"), {"ordering": "-votes"}
+        )
+
+    def search(self):
+        return self.client.get(
+            reverse("zettle:zettlecard-search"), {"q": self.rng.choice(self.words)}
+        )
+
+    def search_filter(self):
+        return self.client.get(
+            reverse("zettle:zettlecard-list"), {"search": self.rng.choice(self.words)}
+        )
+
+    def thread(self):
+        uuid = self.rng.choice(self.threads) if self.threads else self.card()["uuid"]
+        return self.client.get(
+            reverse("zettle:zettlecard-thread", args=[uuid]), {"depth": 2}
+        )
+
+    def tree(self):
+        return self.client.get(
+            reverse("zettle:zettlecard-tree", args=[self.card()["uuid"]]),
+            {"depth": 2},
+        )
+
+    def move(self):
+        # Each pair of moves shifts the same cards there and back, so they
+        # don't drift across the canvas.
+        self.moves += 1
+        offset = 10 if self.moves % 2 else -10
+        picker = random.Random((self.moves + 1) // 2)
+        uuids = [
+            str(card["uuid"])
+            for card in picker.sample(self.cards, min(MOVED_CARDS, len(self.cards)))
+        ]
+        return self.client.post(
+            reverse("zettle:zettlecard-move"),
+            {"uuids": uuids, "dx": offset, "dy": offset},
+            format="json",
+        )
+
+
+def percentiles(timings, elapsed):
+    timings = sorted(timings)
+    return {
+        "p50_ms": round(percentile(timings, 0.5) * 1000, 3),
+        "p95_ms": round(percentile(timings, 0.95) * 1000, 3),
+        "throughput": round(len(timings) / elapsed, 1),
+    }
+
+
+class ConcurrencyBenchmark(Benchmark):
+    """Compares the sync and async card reads under concurrent clients.
+
+    The sync API is served by ``WSGIHandler`` on a pool of ``sync_threads``
+    workers, as a threaded WSGI server would. The async views are served by
+    ``backend.asgi.application`` on one event loop, as an ASGI server would.
+    Each of the ``clients`` sends its share of the requests one after
+    another, so a request's time includes waiting for a free worker. The
+    network isn't included, and both sides get the same requests.
+    """
+
+    def __init__(self, requests=REQUESTS, seed=42, sync_threads=SYNC_THREADS):
+        super().__init__(requests, seed)
+        self.sync_threads = sync_threads
+
+    def run(self, concurrency=CONCURRENCY, reads=None):
+        """Sync and async results for each read, by number of clients."""
+        self.sample()
+        return {
+            read: {clients: self.compare(read, clients) for clients in concurrency}
+            for read in reads or CONCURRENT_READS
+        }
+
+    def compare(self, read, clients):
+        targets = [self.target(read) for _ in range(self.requests)]
+        return {
+            "sync": self.run_sync(
+                [
+                    (reverse(f"zettle:zettlecard-{name}", kwargs=kwargs), query)
+                    for name, kwargs, query in targets
+                ],
+                clients,
+            ),
+            "async": asyncio.run(
+                self.run_async(
+                    [
+                        (reverse(f"zettle:async-card-{name}", kwargs=kwargs), query)
+                        for name, kwargs, query in targets
+                    ],
+                    clients,
+                )
+            ),
+        }
+
+    def target(self, read):
+        """The URL name, arguments and query string of a request for ``read``."""
+        if read == "list":
+            return "list", None, ""
+        if read == "detail":
+            return "detail", {"uuid": self.card()["uuid"]}, ""
+        if read == "tree":
+            return "tree", {"uuid": self.card()["uuid"]}, "depth=2"
+        return "search", None, urlencode({"q": self.rng.choice(self.words)})
+
+    def run_sync(self, requests, clients):
+        handler = WSGIHandler()
+        timings = []
+        errors = []
+        with ThreadPoolExecutor(self.sync_threads) as workers:
+
+            def client(share):
+                for path, query in share:
+                    began = time.perf_counter()
+                    status = workers.submit(wsgi_get, handler, path, query).result()
+                    timings.append(time.perf_counter() - began)
+                    if status != 200:
+                        errors.append(status)
+
+            start = time.perf_counter()
+            threads = [
+                threading.Thread(target=client, args=(requests[i::clients],))
+                for i in range(clients)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+        return {**percentiles(timings, elapsed), "errors": len(errors)}
+
+    async def run_async(self, requests, clients):
+        # Imported late, as it sets Django up when first imported.
+        from backend.asgi import application
+
+        timings = []
+        errors = []
+
+        async def client(share):
+            for path, query in share:
+                began = time.perf_counter()
+                status = await asgi_get(application, path, query)
+                timings.append(time.perf_counter() - began)
+                if status != 200:
+                    errors.append(status)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client(requests[i::clients]) for i in range(clients)))
+        elapsed = time.perf_counter() - start
+        return {**percentiles(timings, elapsed), "errors": len(errors)}
+
+
+def wsgi_get(handler, path, query):
+    """GET ``path`` from a WSGI app, returning the status code."""
+    environ = {
+        "REQUEST_METHOD": "GET",
+        "SCRIPT_NAME": "",
+        "PATH_INFO": path,
+        "QUERY_STRING": query,
+        "SERVER_NAME": HOST,
+        "SERVER_PORT": "80",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "HTTP_HOST": HOST,
+        "wsgi.input": BytesIO(),
+        "wsgi.url_scheme": "http",
+    }
+    statuses = []
+    body = handler(environ, lambda status, headers: statuses.append(status))
+    try:
+        b"".join(body)
+    finally:
+        body.close()
+    return int(statuses[0].split()[0])
+
+
+async def asgi_get(application, path, query):
+    """GET ``path`` from an ASGI app, returning the status code."""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": [(b"host", HOST.encode())],
+        "server": (HOST, 80),
+        "client": ("127.0.0.1", 0),
+    }
+    requested = asyncio.Event()
+    statuses = []
+
+    async def receive():
+        if not requested.is_set():
+            requested.set()
+            return {"type": "http.request", "body": b"", "more_body": False}
+        # The client never disconnects; Django stops listening once done.
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            statuses.append(message["status"])
+
+    await application(scope, receive, send)
+    return statuses[0]
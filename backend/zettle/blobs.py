@@ -0,0 +1,128 @@
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Case, Count, F, Value, When
+from django.utils import timezone
+
+from backend.zettle.models import Blob, ZettleCard
+from backend.zettle.storage import BLOB_DIR, blob_digest, get_blob_storage
+from backend.zettle.thumbnails import thumbnail_dir
+
+# Card fields whose files are stored as blobs.
+BLOB_FIELDS = ["image", "document"]
+
+# Blobs are kept this long after losing their last reference, or after being
+# stored without one, since the card that will reference a fresh upload may
+# not be saved yet.
+BLOB_GRACE = timedelta(days=1)
+
+
+def register_blob(name: str) -> Blob | None:
+    """The row of a stored blob, created with no references if it has none."""
+    digest = blob_digest(name)
+    if digest is None:
+        return None
+    blob, _ = Blob.objects.get_or_create(
+        sha256=digest,
+        defaults={"name": name, "size": get_blob_storage().size(name)},
+    )
+    return blob
+
+
+def acquire_blobs(names):
+    """Add a reference to each named blob. Files stored elsewhere are ignored."""
+    for name in names:
+        blob = register_blob(name)
+        if blob is not None:
+            Blob.objects.filter(pk=blob.pk).update(
+                ref_count=F("ref_count") + 1, unreferenced_since=None
+            )
+
+
+def release_blobs(names):
+    """Drop a reference to each named blob; unreferenced ones are collected later."""
+    digests = [digest for digest in map(blob_digest, names) if digest]
+    for digest in digests:
+        Blob.objects.filter(sha256=digest, ref_count__gt=0).update(
+            ref_count=F("ref_count") - 1,
+            unreferenced_since=Case(
+                When(ref_count=1, then=Value(timezone.now())),
+                default=F("unreferenced_since"),
+            ),
+        )
+
+
+def count_references() -> int:
+    """Recount every blob's references from the cards, returning the rows fixed."""
+    counts = {}
+    for field in BLOB_FIELDS:
+        rows = (
+            ZettleCard.objects.filter(**{f"{field}__startswith": f"{BLOB_DIR}/"})
+            .values_list(field)
+            .annotate(count=Count("pk"))
+            .order_by()
+        )
+        for name, count in rows:
+            counts[name] = counts.get(name, 0) + count
+    fixed = 0
+    for name, count in counts.items():
+        blob = register_blob(name)
+        if blob.ref_count != count:
+            Blob.objects.filter(pk=blob.pk).update(
+                ref_count=count, unreferenced_since=None
+            )
+            fixed += 1
+    fixed += (
+        Blob.objects.exclude(name__in=counts)
+        .exclude(ref_count=0)
+        .update(ref_count=0, unreferenced_since=timezone.now())
+    )
+    return fixed
+
+
+def delete_blob_files(name: str):
+    """Delete a blob and every file derived from it, such as thumbnails."""
+    storage = get_blob_storage()
+    storage.delete(name)
+    derived = str(thumbnail_dir(name))
+    if storage.exists(derived):
+        _, files = storage.listdir(derived)
+        for filename in files:
+            storage.delete(f"{derived}/{filename}")
+
+
+def collect_blobs(grace=BLOB_GRACE) -> int:
+    """Delete the blobs no card has referenced for ``grace``, returning how many.
+
+    Files under the blob directory without a row (e.g. from an upload whose
+    card failed to save) are registered first, so they are collected as well.
+    """
+    for name in walk_files(BLOB_DIR):
+        if not Blob.objects.filter(sha256=blob_digest(name)).exists():
+            register_blob(name)
+
+    deleted = 0
+    cutoff = timezone.now() - grace
+    blobs = Blob.objects.filter(ref_count=0, unreferenced_since__lt=cutoff)
+    for blob in blobs.iterator():
+        with transaction.atomic():
+            # A card may have taken a reference since the query ran.
+            if not Blob.objects.filter(pk=blob.pk, ref_count=0).delete()[0]:
+                continue
+            transaction.on_commit(lambda name=blob.name: delete_blob_files(name))
+        deleted += 1
+    return deleted
+
+
+def walk_files(directory: str):
+    """Names of the stored blobs, skipping the directories of derived files."""
+    storage = get_blob_storage()
+    if not storage.exists(directory):
+        return
+    directories, files = storage.listdir(directory)
+    for filename in files:
+        yield f"{directory}/{filename}"
+    for name in directories:
+        # Blob files sit two levels down, e.g. blobs/ab/cd/abcd….pdf.
+        if directory.count("/") < 2:
+            yield from walk_files(f"{directory}/{name}")
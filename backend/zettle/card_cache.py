@@ -0,0 +1,330 @@
+import threading
+import time
+from collections import Counter, OrderedDict
+from functools import cache
+
+import orjson
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from backend.core.renderers import FastJSONRenderer
+
+DEFAULT_BACKEND = "backend.zettle.card_cache.CardCache"
+
+# Prefix of the keys written to the shared cache.
+KEY_PREFIX = "zettle-card"
+
+# How long a request waits for another one loading the same card before
+# loading it itself.
+FILL_WAIT = 1.0
+
+# How often a request waiting on another process's load checks for its result.
+FILL_POLL_INTERVAL = 0.01
+
+STATS = [
+    "local_hits",
+    "shared_hits",
+    "coalesced",
+    "misses",
+    "evictions",
+    "invalidations",
+]
+
+
+def encode(payload) -> bytes:
+    return FastJSONRenderer().render(payload)
+
+
+def decode(body: bytes):
+    return orjson.loads(body)
+
+
+class Fill:
+    """A card being loaded, which other requests for it wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.entry = None
+
+
+class CardCache:
+    """Serialized cards by uuid, read through two tiers.
+
+    The first tier is an LRU in process memory, bounded by ``max_bytes`` of
+    encoded JSON. Entries live ``local_timeout`` seconds, which bounds how
+    long a process can serve a card another process changed. The second,
+    optional tier is the Django cache named by ``shared``, holding entries for
+    ``timeout`` seconds, so one process's loads serve the others.
+
+    Only one request per process loads a given card at a time, and with a
+    shared tier, only one per deployment; the others wait for its result. A
+    load is only stored if no card was invalidated while it ran, so a payload
+    read before a write commits never outlives the write.
+
+    Payloads hold absolute URLs, so each entry records the origin it was
+    serialized for and is a miss for requests to any other.
+    """
+
+    def __init__(
+        self, max_bytes=32 * 1024 * 1024, local_timeout=5, shared=None, timeout=300
+    ):
+        self.max_bytes = max_bytes
+        self.local_timeout = local_timeout
+        self.shared = caches[shared] if shared else None
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._uuids_by_id = {}
+        self._fills = {}
+        self._size = 0
+        self._epoch = 0
+        self._generation = None
+        self._generation_expires = 0
+        self._lock = threading.Lock()
+        self._stats = Counter()
+        self._stats_lock = threading.Lock()
+
+    def get_or_load(self, uuid, origin, load) -> dict:
+        """The payload of card ``uuid`` as served at ``origin``, loaded on a miss.
+
+        ``load`` returns the card's pk and payload. Whatever it raises, such as
+        ``Http404``, propagates, and nothing is cached.
+        """
+        uuid = str(uuid)
+        body = self._get_local(uuid, origin)
+        if body is not None:
+            self.count("local_hits")
+            return decode(body)
+
+        with self._lock:
+            fill = self._fills.get(uuid)
+            leader = fill is None
+            if leader:
+                fill = self._fills[uuid] = Fill()
+            epoch = self._epoch
+        if not leader:
+            return self._wait(fill, origin, load)
+        try:
+            fill.entry = self._fill(uuid, origin, load, epoch)
+        finally:
+            with self._lock:
+                del self._fills[uuid]
+            fill.done.set()
+        return decode(fill.entry[2])
+
+    def invalidate(self, uuids=(), card_ids=()):
+        """Drop the given cards from both tiers, by uuid or by primary key."""
+        uuids = {str(uuid) for uuid in uuids}
+        card_ids = {pk for pk in card_ids if pk is not None}
+        invalidated = 0
+        with self._lock:
+            self._epoch += 1
+            uuids.update(
+                self._uuids_by_id[pk] for pk in card_ids if pk in self._uuids_by_id
+            )
+            for uuid in uuids:
+                invalidated += self._discard(uuid)
+        self.count("invalidations", invalidated)
+        if self.shared is None or not (uuids or card_ids):
+            return
+        aliases = self.shared.get_many([self._key("id", pk) for pk in card_ids])
+        uuids.update(aliases.values())
+        # Loads that started before now must not store what they read.
+        now = time.time()
+        self.shared.set_many(
+            {self._key("changed", uuid): now for uuid in uuids}
+            | {self._key("changed-id", pk): now for pk in card_ids},
+            self.timeout,
+        )
+        self.shared.delete_many([self._key("card", uuid) for uuid in uuids])
+
+    def clear(self):
+        """Drop every card, here and, through a new key generation, everywhere."""
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+            self._uuids_by_id.clear()
+            self._size = 0
+        if self.shared is not None:
+            key = f"{KEY_PREFIX}:generation"
+            self.shared.add(key, 0, None)
+            try:
+                self._generation = self.shared.incr(key)
+            except ValueError:  # Evicted since added.
+                self._generation = 0
+
+    def count(self, stat, amount=1):
+        with self._stats_lock:
+            self._stats[stat] += amount
+
+    def stats(self) -> dict:
+        """Lookup, eviction and invalidation counts for this process.
+
+        ``coalesced`` lookups waited for another request's load, and
+        ``misses`` loaded the card from the database.
+        """
+        with self._stats_lock:
+            stats = {name: self._stats[name] for name in STATS}
+        lookups = sum(stats[name] for name in STATS[:4])
+        hits = lookups - stats["misses"]
+        stats["hit_rate"] = hits / lookups if lookups else None
+        stats["entries"] = len(self._entries)
+        stats["bytes"] = self._size
+        return stats
+
+    @property
+    def size(self):
+        return self._size
+
+    def _fill(self, uuid, origin, load, epoch):
+        """Load a card for the requests waiting on this process's fill."""
+        lease = None
+        if self.shared is not None:
+            entry = self.shared.get(self._key("card", uuid))
+            if entry is not None and entry[0] == origin:
+                self.count("shared_hits")
+                self._set_local(uuid, entry, epoch)
+                return entry
+            # The process adding the lease loads the card; the others wait.
+            key = self._key("lease", uuid)
+            if self.shared.add(key, 1, FILL_WAIT):
+                lease = key
+            else:
+                entry = self._wait_shared(uuid, origin)
+                if entry is not None:
+                    self._set_local(uuid, entry, epoch)
+                    return entry
+        started = time.time()
+        try:
+            entry = self._load(origin, load)
+            if self.shared is not None:
+                self._share(uuid, entry, started)
+        finally:
+            if lease is not None:
+                self.shared.delete(lease)
+        self._set_local(uuid, entry, epoch)
+        return entry
+
+    def _load(self, origin, load):
+        self.count("misses")
+        pk, payload = load()
+        return origin, pk, encode(payload)
+
+    def _wait(self, fill, origin, load):
+        """The result of another request's load, or our own past ``FILL_WAIT``."""
+        if fill.done.wait(FILL_WAIT) and fill.entry and fill.entry[0] == origin:
+            self.count("coalesced")
+            return decode(fill.entry[2])
+        return decode(self._load(origin, load)[2])
+
+    def _wait_shared(self, uuid, origin):
+        """Poll for the entry another process is loading, up to ``FILL_WAIT``."""
+        deadline = time.monotonic() + FILL_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(FILL_POLL_INTERVAL)
+            entry = self.shared.get(self._key("card", uuid))
+            if entry is not None and entry[0] == origin:
+                self.count("coalesced")
+                return entry
+        return None
+
+    def _share(self, uuid, entry, started):
+        """Store a loaded entry in the shared tier, unless changed since ``started``."""
+        key = self._key("card", uuid)
+        if self._changed_since(uuid, entry[1], started):
+            return
+        self.shared.set_many(
+            {key: entry, self._key("id", entry[1]): uuid}, self.timeout
+        )
+        # An invalidation may have run between the check and the write.
+        if self._changed_since(uuid, entry[1], started):
+            self.shared.delete(key)
+
+    def _changed_since(self, uuid, pk, started):
+        changed = self.shared.get_many(
+            [self._key("changed", uuid), self._key("changed-id", pk)]
+        )
+        return any(when >= started for when in changed.values())
+
+    def _key(self, kind, value):
+        now = time.monotonic()
+        if self._generation is None or now >= self._generation_expires:
+            self._generation = self.shared.get(f"{KEY_PREFIX}:generation", 0)
+            self._generation_expires = now + self.local_timeout
+        return f"{KEY_PREFIX}:{self._generation}:{kind}:{value}"
+
+    def _get_local(self, uuid, origin):
+        with self._lock:
+            entry = self._entries.get(uuid)
+            if entry is None:
+                return None
+            expires, (entry_origin, _, body) = entry
+            if expires <= time.monotonic():
+                self._discard(uuid)
+                return None
+            if entry_origin != origin:
+                return None
+            self._entries.move_to_end(uuid)
+            return body
+
+    def _set_local(self, uuid, entry, epoch):
+        size = len(entry[2])
+        if size > self.max_bytes:
+            return
+        evicted = 0
+        with self._lock:
+            if epoch != self._epoch:
+                return
+            self._discard(uuid)
+            self._entries[uuid] = (time.monotonic() + self.local_timeout, entry)
+            self._uuids_by_id[entry[1]] = uuid
+            self._size += size
+            while self._size > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+                evicted += 1
+        self.count("evictions", evicted)
+
+    def _discard(self, uuid) -> bool:
+        entry = self._entries.pop(uuid, None)
+        if entry is None:
+            return False
+        _, pk, body = entry[1]
+        self._size -= len(body)
+        if self._uuids_by_id.get(pk) == uuid:
+            del self._uuids_by_id[pk]
+        return True
+
+
+@cache
+def get_card_cache() -> CardCache:
+    """The cache configured by ``ZETTLE_CARD_CACHE``, local memory only by default.
+
+    The setting is a dict with the ``BACKEND`` class path and its ``OPTIONS``.
+    """
+    config = getattr(settings, "ZETTLE_CARD_CACHE", {})
+    backend = import_string(config.get("BACKEND", DEFAULT_BACKEND))
+    return backend(**config.get("OPTIONS", {}))
+
+
+def invalidate_cards(uuids=(), card_ids=()):
+    """Drop the cached payloads of the given cards, now and once the change commits.
+
+    Dropping them now keeps this connection's own reads current. Dropping them
+    again on commit clears what other requests loaded from the old rows since.
+    """
+    uuids, card_ids = set(uuids), {pk for pk in card_ids if pk is not None}
+    if not (uuids or card_ids):
+        return
+    cards = get_card_cache()
+    cards.invalidate(uuids, card_ids)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: cards.invalidate(uuids, card_ids))
+
+
+def clear_cards():
+    """Drop every cached payload, now and once the change commits."""
+    cards = get_card_cache()
+    cards.clear()
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(cards.clear)
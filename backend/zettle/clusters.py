@@ -0,0 +1,213 @@
+import operator
+from collections import Counter, defaultdict
+from functools import reduce
+
+from django.db import transaction
+from django.db.models import Q
+
+from backend.zettle.models import ZettleCard, ZettleTile
+from backend.zettle.spatial import GRID_SIZE
+
+# Zoom level -> tile size in canvas units. Tile sizes are multiples of the
+# spatial grid so a tile can be re-scanned through the grid index.
+CLUSTER_LEVELS = {
+    0.25: 4 * GRID_SIZE,
+    0.5: 2 * GRID_SIZE,
+}
+TOP_CARDS = 3
+
+STATE_FIELDS = ["uuid", "x", "y", "card_type", "title", "votes"]
+TILE_FIELDS = ["card_count", "sum_x", "sum_y", "type_counts", "top_cards"]
+
+
+def level_for_zoom(zoom: float) -> int:
+    """Index of the cluster level for a zoom, raising ValueError if unclustered."""
+    try:
+        return list(CLUSTER_LEVELS).index(zoom)
+    except ValueError:
+        raise ValueError(
+            f"zoom must be one of {', '.join(str(z) for z in CLUSTER_LEVELS)}"
+        )
+
+
+def card_state(card: ZettleCard, loaded=False) -> dict | None:
+    """The fields of a card that feed the tile aggregates, or None if unplaced.
+
+    With ``loaded=True`` the values are taken as of the card's last database
+    load, which is what the tiles currently account for.
+    """
+    if loaded:
+        if not hasattr(card, "_loaded_values"):
+            return None
+        state = {name: card.get_loaded_value(name) for name in STATE_FIELDS}
+    else:
+        state = {name: getattr(card, name) for name in STATE_FIELDS}
+    if state["x"] is None or state["y"] is None:
+        return None
+    return state
+
+
+def _tile_key(level, tile_size, state):
+    return level, state["x"] // tile_size, state["y"] // tile_size
+
+
+def _top_entry(state):
+    return {
+        "uuid": str(state["uuid"]),
+        "title": state["title"],
+        "votes": state["votes"],
+    }
+
+
+def _top_rank(entry):
+    """Most votes first, ties broken by uuid, as ``_top_cards_from_db`` orders."""
+    return -entry["votes"], entry["uuid"]
+
+
+def _top_cards_from_db(level, tile_x, tile_y):
+    tile_size = list(CLUSTER_LEVELS.values())[level]
+    cells = tile_size // GRID_SIZE
+    cards = ZettleCard.objects.filter(
+        grid_x__in=range(tile_x * cells, (tile_x + 1) * cells),
+        grid_y__range=(tile_y * cells, (tile_y + 1) * cells - 1),
+    ).order_by("-votes", "uuid")
+    return [_top_entry(state) for state in cards.values(*STATE_FIELDS)[:TOP_CARDS]]
+
+
+@transaction.atomic
+def update_tiles(removed=(), added=()):
+    """Apply card states leaving and entering tiles to every cluster level.
+
+    Both arguments are iterables of ``card_state`` dicts, so moving a card is
+    its old state removed plus its new state added.
+    """
+    removed = [state for state in removed if state is not None]
+    added = [state for state in added if state is not None]
+    deltas = defaultdict(
+        lambda: {"count": 0, "x": 0, "y": 0, "types": Counter(), "out": set(), "in": []}
+    )
+    for level, tile_size in enumerate(CLUSTER_LEVELS.values()):
+        for state in removed:
+            delta = deltas[_tile_key(level, tile_size, state)]
+            delta["count"] -= 1
+            delta["x"] -= state["x"]
+            delta["y"] -= state["y"]
+            delta["types"][state["card_type"]] -= 1
+            delta["out"].add(str(state["uuid"]))
+        for state in added:
+            delta = deltas[_tile_key(level, tile_size, state)]
+            delta["count"] += 1
+            delta["x"] += state["x"]
+            delta["y"] += state["y"]
+            delta["types"][state["card_type"]] += 1
+            delta["in"].append(_top_entry(state))
+
+    if not deltas:
+        return
+    # Tiles are created empty if missing, then locked and read in one query
+    # each, however many tiles the cards touch.
+    ZettleTile.objects.bulk_create(
+        [
+            ZettleTile(level=level, tile_x=tile_x, tile_y=tile_y)
+            for level, tile_x, tile_y in deltas
+        ],
+        ignore_conflicts=True,
+    )
+    tiles = ZettleTile.objects.select_for_update().filter(
+        reduce(
+            operator.or_,
+            (
+                Q(level=level, tile_x=tile_x, tile_y=tile_y)
+                for level, tile_x, tile_y in deltas
+            ),
+        )
+    )
+    changed, emptied = [], []
+    for tile in tiles:
+        delta = deltas[tile.level, tile.tile_x, tile.tile_y]
+        tile.card_count += delta["count"]
+        if tile.card_count <= 0:
+            emptied.append(tile.pk)
+            continue
+
+        tile.sum_x += delta["x"]
+        tile.sum_y += delta["y"]
+        type_counts = Counter(tile.type_counts)
+        type_counts.update(delta["types"])
+        tile.type_counts = {key: value for key, value in type_counts.items() if value}
+
+        readded = {entry["uuid"]: entry for entry in delta["in"]}
+        demoted = any(
+            entry["uuid"] not in readded
+            or readded[entry["uuid"]]["votes"] < entry["votes"]
+            for entry in tile.top_cards
+            if entry["uuid"] in delta["out"]
+        )
+        if demoted:
+            # A ranked card left the tile or lost votes, so the runner-up is
+            # not known from the aggregate alone.
+            tile.top_cards = _top_cards_from_db(tile.level, tile.tile_x, tile.tile_y)
+        else:
+            top_cards = [
+                entry
+                for entry in tile.top_cards
+                if entry["uuid"] not in delta["out"] and entry["uuid"] not in readded
+            ]
+            top_cards.extend(delta["in"])
+            top_cards.sort(key=_top_rank)
+            tile.top_cards = top_cards[:TOP_CARDS]
+        changed.append(tile)
+    ZettleTile.objects.filter(pk__in=emptied).delete()
+    ZettleTile.objects.bulk_update(changed, TILE_FIELDS)
+
+
+def cluster_payload(tile: ZettleTile) -> dict:
+    return {
+        "tile_x": tile.tile_x,
+        "tile_y": tile.tile_y,
+        "count": tile.card_count,
+        "x": tile.sum_x / tile.card_count,
+        "y": tile.sum_y / tile.card_count,
+        "card_type": max(tile.type_counts, key=tile.type_counts.get),
+        "type_counts": tile.type_counts,
+        "top_cards": tile.top_cards,
+    }
+
+
+def get_clusters(zoom: float, bbox: tuple[int, int, int, int]) -> list[dict]:
+    level = level_for_zoom(zoom)
+    tile_size = CLUSTER_LEVELS[zoom]
+    min_x, min_y, max_x, max_y = bbox
+    tiles = ZettleTile.objects.filter(
+        level=level,
+        tile_x__range=(min_x // tile_size, max_x // tile_size),
+        tile_y__range=(min_y // tile_size, max_y // tile_size),
+    ).order_by("tile_x", "tile_y")
+    return [cluster_payload(tile) for tile in tiles]
+
+
+@transaction.atomic
+def rebuild_tiles(chunk_size=2000):
+    """Recompute every tile from scratch."""
+    ZettleTile.objects.all().delete()
+    tiles = {}
+    cards = ZettleCard.objects.exclude(x=None).exclude(y=None).order_by()
+    for state in cards.values(*STATE_FIELDS).iterator(chunk_size=chunk_size):
+        for level, tile_size in enumerate(CLUSTER_LEVELS.values()):
+            key = _tile_key(level, tile_size, state)
+            if key not in tiles:
+                tiles[key] = ZettleTile(
+                    level=key[0], tile_x=key[1], tile_y=key[2], type_counts={}
+                )
+            tile = tiles[key]
+            tile.card_count += 1
+            tile.sum_x += state["x"]
+            tile.sum_y += state["y"]
+            tile.type_counts[state["card_type"]] = (
+                tile.type_counts.get(state["card_type"], 0) + 1
+            )
+            tile.top_cards = sorted(
+                [*tile.top_cards, _top_entry(state)], key=_top_rank
+            )[:TOP_CARDS]
+    ZettleTile.objects.bulk_create(tiles.values(), batch_size=chunk_size)
+    return len(tiles)
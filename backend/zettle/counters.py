@@ -0,0 +1,51 @@
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from backend.zettle.card_cache import clear_cards, invalidate_cards
+from backend.zettle.models import ZettleCard
+
+# Stored counters of the cards linking to a card, by the link they count.
+LINK_COUNTERS = {
+    "child_count": "parent",
+    "reply_count": "reply_to",
+}
+
+
+def link_count_subquery(link):
+    """The number of cards whose ``link`` is the outer card."""
+    linked = (
+        ZettleCard.objects.filter(**{link: OuterRef("pk")})
+        .order_by()
+        .values(link)
+        .annotate(count=Count("*"))
+        .values("count")
+    )
+    return Coalesce(Subquery(linked), 0)
+
+
+def recount_links(card_ids=None, counters=LINK_COUNTERS) -> int:
+    """Recount ``child_count`` and ``reply_count`` for the given cards, or all.
+
+    Each counter is read off the index of the link it counts, and only cards
+    whose stored count is off are written, with a fresh ``updated_at`` so
+    their ETags and the change feed pick the new count up. Returns how many
+    were.
+    """
+    cards = ZettleCard.objects.all()
+    if card_ids is not None:
+        card_ids = {pk for pk in card_ids if pk is not None}
+        if not card_ids:
+            return 0
+        cards = cards.filter(pk__in=card_ids)
+    fixed = 0
+    for counter in counters:
+        count = link_count_subquery(LINK_COUNTERS[counter])
+        fixed += cards.exclude(**{counter: count}).update(
+            **{counter: count}, updated_at=timezone.now()
+        )
+    if fixed and card_ids is None:
+        clear_cards()
+    elif fixed:
+        invalidate_cards(card_ids=card_ids)
+    return fixed
@@ -1,13 +1,26 @@
+from uuid import UUID
+
+from django.db.models import Case, IntegerField, When
 from django_filters import CharFilter
 from django_filters.rest_framework import FilterSet
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import OrderingFilter, SearchFilter
 
 from backend.zettle.models import ZettleCard
+from backend.zettle.references import parse_reference
+from backend.zettle.search import SEARCH_LIMIT, get_search_backend, search_words
+from backend.zettle.spatial import filter_bbox, parse_bbox
+from backend.zettle.tags import TagLink, filter_by_tags
 
 
 class ZettleCardFilter(FilterSet):
     title = CharFilter(lookup_expr="icontains")
-    tag = CharFilter(field_name="tags__title", lookup_expr="icontains")
+    tag = CharFilter(method="filter_tag_title")
+    tags = CharFilter(method="filter_tags")
+    tags_any = CharFilter(method="filter_tags")
     text = CharFilter(lookup_expr="icontains")
+    bbox = CharFilter(method="filter_bbox")
+    references = CharFilter(method="filter_references")
 
     class Meta:
         model = ZettleCard
@@ -17,4 +30,75 @@ class ZettleCardFilter(FilterSet):
             "created_at": ["gte", "lte"],
             "x": ["exact", "gte", "lte"],
             "y": ["exact", "gte", "lte"],
+            "child_count": ["exact", "gte", "lte"],
+            "reply_count": ["exact", "gte", "lte"],
+            "tag_count": ["exact", "gte", "lte"],
         }
+
+    def filter_bbox(self, queryset, name, value):
+        try:
+            bbox = parse_bbox(value)
+        except ValueError as e:
+            raise ValidationError({name: [str(e)]})
+        return filter_bbox(queryset, bbox)
+
+    def filter_references(self, queryset, name, value):
+        """Cards pointing to an ``app_label.model:id`` object."""
+        try:
+            content_type, object_id = parse_reference(value)
+        except ValueError as e:
+            raise ValidationError({name: [str(e)]})
+        return queryset.filter(content_type=content_type, object_id=object_id)
+
+    def filter_tag_title(self, queryset, name, value):
+        # A subquery rather than a join, so cards with several matching tags
+        # aren't listed more than once.
+        links = TagLink.objects.filter(from_zettlecard__title__icontains=value)
+        return queryset.filter(pk__in=links.values("to_zettlecard_id"))
+
+    def filter_tags(self, queryset, name, value):
+        """Cards tagged with all (``?tags=``) or any (``?tags_any=``) of the
+        comma-separated tag card uuids."""
+        try:
+            uuids = {UUID(part.strip()) for part in value.split(",") if part.strip()}
+        except ValueError:
+            raise ValidationError({name: ["Invalid uuid."]})
+        if not uuids:
+            return queryset
+        tag_ids = set(
+            ZettleCard.objects.filter(uuid__in=uuids).values_list("pk", flat=True)
+        )
+        match_all = name == "tags"
+        if not tag_ids or (match_all and len(tag_ids) < len(uuids)):
+            return queryset.none()
+        return filter_by_tags(queryset, tag_ids, match_all)
+
+
+class FullTextSearchFilter(SearchFilter):
+    """``?search=`` through the full-text index.
+
+    Results come back in relevance order (blended with votes for
+    ``rank=votes``) unless an explicit ``?ordering=`` is given, so this must
+    run after the OrderingFilter.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        query = request.query_params.get(self.search_param, "")
+        if not search_words(query):
+            return queryset
+
+        by_votes = request.query_params.get("rank") == "votes"
+        results = get_search_backend().search(query, SEARCH_LIMIT, by_votes)
+        if not results:
+            return queryset.none()
+
+        card_ids = [card_id for card_id, _, _ in results]
+        queryset = queryset.filter(pk__in=card_ids)
+        if OrderingFilter.ordering_param in request.query_params:
+            return queryset
+        return queryset.order_by(
+            Case(
+                *[When(pk=card_id, then=rank) for rank, card_id in enumerate(card_ids)],
+                output_field=IntegerField(),
+            )
+        )
@@ -0,0 +1,227 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict, defaultdict
+from functools import cache
+from pathlib import Path
+
+from django.conf import settings
+from django.template.loader import render_to_string
+from django.utils.module_loading import import_string
+
+from backend.core.metrics import timed
+
+# Bump to drop every cached fragment after changing the card templates.
+FRAGMENT_VERSION = "1"
+
+DEFAULT_BACKEND = "backend.zettle.fragments.LocMemFragmentCache"
+
+
+# How many times a file fragment is written again when an invalidation
+# removes its directory mid-write.
+WRITE_ATTEMPTS = 3
+
+
+def fragment_key(card) -> str:
+    """Cache key for a card's rendering, which changes whenever the card does.
+
+    It also covers what templates may show besides the card: its parent, its
+    tags and how many children it has. So it changes with them in every
+    process, even one that missed their invalidation. Lists should
+    ``select_related("parent")`` and ``prefetch_related("tags")``.
+    """
+    version = getattr(settings, "ZETTLE_FRAGMENT_VERSION", FRAGMENT_VERSION)
+    parent = card.parent.updated_at.timestamp() if card.parent_id else ""
+    tags = max((tag.updated_at.timestamp() for tag in card.tags.all()), default="")
+    return (
+        f"{card.uuid}:{card.updated_at.timestamp()}:{parent}:{tags}:"
+        f"{card.child_count}:{card.card_type}:{version}"
+    )
+
+
+class FragmentCache(ABC):
+    """Rendered card HTML, keyed by ``fragment_key`` and dropped per card."""
+
+    def __init__(self):
+        self._stats = Counter()
+        self._stats_lock = threading.Lock()
+
+    @abstractmethod
+    def get(self, key) -> str | None:
+        pass
+
+    @abstractmethod
+    def set(self, key, html: str):
+        pass
+
+    @abstractmethod
+    def invalidate(self, uuids):
+        """Drop every cached rendering of the given cards."""
+
+    @abstractmethod
+    def clear(self):
+        pass
+
+    def count(self, stat, amount=1):
+        with self._stats_lock:
+            self._stats[stat] += amount
+
+    def stats(self) -> dict:
+        """Hit, miss, write, eviction and invalidation counts for this process."""
+        with self._stats_lock:
+            stats = {
+                name: self._stats[name]
+                for name in ("hits", "misses", "writes", "evictions", "invalidations")
+            }
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else None
+        return stats
+
+
+class LocMemFragmentCache(FragmentCache):
+    """Per-process LRU cache, evicting the least recently used past ``max_bytes``."""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._keys_by_card = defaultdict(set)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+        self.count("hits" if html is not None else "misses")
+        return html
+
+    def set(self, key, html):
+        size = len(html.encode())
+        if size > self.max_bytes:
+            return
+        evicted = 0
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = html
+            self._keys_by_card[key.partition(":")[0]].add(key)
+            self._size += size
+            while self._size > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+                evicted += 1
+        self.count("writes")
+        self.count("evictions", evicted)
+
+    def invalidate(self, uuids):
+        invalidated = 0
+        with self._lock:
+            for uuid in uuids:
+                for key in list(self._keys_by_card.get(str(uuid), ())):
+                    self._discard(key)
+                    invalidated += 1
+        self.count("invalidations", invalidated)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_card.clear()
+            self._size = 0
+
+    @property
+    def size(self):
+        return self._size
+
+    def _discard(self, key):
+        html = self._entries.pop(key, None)
+        if html is None:
+            return
+        self._size -= len(html.encode())
+        uuid = key.partition(":")[0]
+        self._keys_by_card[uuid].discard(key)
+        if not self._keys_by_card[uuid]:
+            del self._keys_by_card[uuid]
+
+
+class FileFragmentCache(FragmentCache):
+    """Fragments stored as files under ``location``, one directory per card.
+
+    Shared by every process on the host, and survives restarts. There is no
+    size limit; entries only go away when their card is invalidated.
+    """
+
+    def __init__(self, location=None):
+        super().__init__()
+        self.location = Path(
+            location or Path(settings.MEDIA_ROOT).parent / "fragment_cache"
+        )
+
+    def _path(self, key):
+        uuid, _, rest = key.partition(":")
+        return self.location / uuid / f"{hashlib.md5(rest.encode()).hexdigest()}.html"
+
+    def get(self, key):
+        try:
+            html = self._path(key).read_text()
+        except FileNotFoundError:
+            html = None
+        self.count("hits" if html is not None else "misses")
+        return html
+
+    def set(self, key, html):
+        path = self._path(key)
+        for _ in range(WRITE_ATTEMPTS):
+            try:
+                self._write(path, html)
+            except FileNotFoundError:
+                # An invalidation removed the card's directory meanwhile.
+                continue
+            self.count("writes")
+            return
+
+    def _write(self, path, html):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename, so readers never see a partial fragment.
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(html)
+        os.replace(tmp_path, path)
+
+    def invalidate(self, uuids):
+        for uuid in uuids:
+            card_dir = self.location / str(uuid)
+            if card_dir.exists():
+                self.count("invalidations", len(list(card_dir.iterdir())))
+                shutil.rmtree(card_dir, ignore_errors=True)
+
+    def clear(self):
+        shutil.rmtree(self.location, ignore_errors=True)
+
+
+@cache
+def get_fragment_cache() -> FragmentCache:
+    """The cache configured by ``ZETTLE_FRAGMENT_CACHE``, local memory by default.
+
+    The setting is a dict with the ``BACKEND`` class path and its ``OPTIONS``.
+    """
+    config = getattr(settings, "ZETTLE_FRAGMENT_CACHE", {})
+    backend = import_string(config.get("BACKEND", DEFAULT_BACKEND))
+    return backend(**config.get("OPTIONS", {}))
+
+
+def render_card(card) -> str:
+    """The card's ``template_name`` rendered with only ``card`` in the context.
+
+    Nothing else may feed the template, since the cache key only covers the card.
+    """
+    fragments = get_fragment_cache()
+    key = fragment_key(card)
+    html = fragments.get(key)
+    if html is None:
+        with timed("template"):
+            html = render_to_string(card.template_name, {"card": card})
+        fragments.set(key, html)
+    return html
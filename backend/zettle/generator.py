@@ -0,0 +1,387 @@
+import random
+from collections import deque
+from datetime import UTC, datetime, timedelta
+from io import BytesIO
+from itertools import accumulate
+from uuid import UUID
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.contenttypes.models import ContentType
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+from django.db.models import Max
+from PIL import Image
+
+from backend.users.models import User
+from backend.zettle.blobs import count_references
+from backend.zettle.clusters import rebuild_tiles
+from backend.zettle.counters import recount_links
+from backend.zettle.models import ZettleCard
+from backend.zettle.ranking import hot_score
+from backend.zettle.search import get_search_backend
+from backend.zettle.sequences import keys_between
+from backend.zettle.spatial import grid_cell
+from backend.zettle.storage import get_blob_storage
+from backend.zettle.tags import recount_tags
+
+BATCH_SIZE = 10_000
+
+# Loads of at least this many cards drop the model's indexes while they run.
+DEFER_INDEXES_AT = 100_000
+
+# Generated gardens start here, so a seed always yields the same rows.
+START = datetime(2024, 1, 1, tzinfo=UTC)
+SPAN = timedelta(days=365)
+
+CARD_TYPES = ["text", "image", "url", "model", "topic"]
+CARD_TYPE_WEIGHTS = [60, 10, 15, 5, 10]
+
+WORDS = (  # noqa: SIM905
+    "garden note idea link thread draft sketch topic question answer source "
+    "quote summary outline memory pattern signal system model network graph "
+    "canvas layer cluster branch root seed leaf index archive review theory "
+    "method result design paper reading project meeting plan task issue"
+).split()
+
+CORPUS_WORDS = 100_000
+
+UUID_MASK = 0xC000 << 48 | 0xF000 << 64
+UUID_VERSION = 0x8000 << 48 | 0x4000 << 64
+
+# Shape of the garden. Parents come from a window of recent cards, so trees
+# grow deep; replies and tags pick from pools with Zipf weights, so a few
+# threads and topics take most of the links.
+PARENT_CHANCE = 0.6
+PARENT_WINDOW = 2000
+MAX_DEPTH = 24
+SEQUENCE_CHANCE = 0.02
+MAX_SEQUENCE_LENGTH = 400
+REPLY_CHANCE = 0.25
+THREAD_POOL = 500
+TOPIC_POOL = 1000
+MEAN_TAGS = 1.5
+CLUSTERS = 200
+CLUSTER_SPREAD = 1500
+CANVAS_SIZE = 200_000
+UNPLACED_CHANCE = 0.1
+USER_REFERENCE_CHANCE = 0.5
+BLOB_POOL = 20
+BLOB_CHANCE = 0.3
+
+
+# Columns written by the generator, in the order ``build_batch`` fills them.
+COLUMNS = [
+    "id",
+    "created_at",
+    "updated_at",
+    "uuid",
+    "card_type",
+    "author_id",
+    "title",
+    "votes",
+    "hot_score",
+    "text",
+    "image",
+    "thumbnails",
+    "document",
+    "url",
+    "slug",
+    "parent_id",
+    "next_id",
+    "reply_to_id",
+    "sequence_id",
+    "sequence_key",
+    "x",
+    "y",
+    "grid_x",
+    "grid_y",
+    "path",
+    "depth",
+    "tag_count",
+    "child_count",
+    "reply_count",
+    "content_type_id",
+    "object_id",
+]
+
+
+def _zipf_weights(size):
+    return list(accumulate(1 / (rank + 1) for rank in range(size)))
+
+
+class GardenGenerator:
+    """Writes a synthetic garden of a given size, the same for the same seed.
+
+    Rows are built in Python with their ids, paths, sequence keys and grid
+    cells already worked out, then inserted ``batch_size`` at a time with one
+    prepared statement, so no pass has to go back over them.
+    """
+
+    def __init__(self, seed=42, users=10, blobs=False, batch_size=BATCH_SIZE):
+        self.rng = random.Random(seed)
+        self.user_count = users
+        self.blobs = blobs
+        self.batch_size = batch_size
+        self.thread_weights = _zipf_weights(THREAD_POOL)
+        self.topic_weights = _zipf_weights(TOPIC_POOL)
+        self.native_uuids = connection.features.has_native_uuid_field
+        self.corpus = " ".join(self.rng.choices(WORDS, k=CORPUS_WORDS)) + " "
+        self.word_starts = [0]
+        for word in self.corpus.split():
+            self.word_starts.append(self.word_starts[-1] + len(word) + 1)
+
+    def generate(self, count, progress=None):
+        """Add ``count`` cards, returning the number of tag links made.
+
+        Foreign keys are checked once at the end, as ``loaddata`` does, rather
+        than on every insert. When the new cards at least double the garden,
+        the model's indexes are dropped for the load and built again after,
+        which is quicker than updating them one row at a time.
+        """
+        with connection.constraint_checks_disabled(), transaction.atomic():
+            self.user_ids = self.create_users()
+            content_types = ContentType.objects.get_for_models(User, ZettleCard)
+            self.user_type_id = content_types[User].pk
+            self.card_type_id = content_types[ZettleCard].pk
+            self.image_names, self.document_names = self.create_blobs()
+            self.next_id = (ZettleCard.objects.aggregate(Max("pk"))["pk__max"] or 0) + 1
+            self.recent = deque(maxlen=PARENT_WINDOW)
+            self.threads = []
+            self.topics = []
+            self.sequence = []
+            self.clusters = [
+                (
+                    self.rng.uniform(-CANVAS_SIZE, CANVAS_SIZE),
+                    self.rng.uniform(-CANVAS_SIZE, CANVAS_SIZE),
+                )
+                for _ in range(CLUSTERS)
+            ]
+            defer_indexes = (
+                count >= DEFER_INDEXES_AT and count >= ZettleCard.objects.count()
+            )
+            if defer_indexes:
+                with connection.schema_editor(atomic=False) as editor:
+                    for index in ZettleCard._meta.indexes:
+                        editor.remove_index(ZettleCard, index)
+            tag_links = self.insert(count, progress)
+            if defer_indexes:
+                with connection.schema_editor(atomic=False) as editor:
+                    for index in ZettleCard._meta.indexes:
+                        editor.add_index(ZettleCard, index)
+            connection.check_constraints(
+                table_names=[
+                    ZettleCard._meta.db_table,
+                    ZettleCard.tags.through._meta.db_table,
+                ]
+            )
+        return tag_links
+
+    def insert(self, count, progress=None):
+        insert_sql = (
+            f"INSERT INTO {ZettleCard._meta.db_table} ({', '.join(COLUMNS)}) "
+            f"VALUES ({', '.join(['%s'] * len(COLUMNS))})"
+        )
+        tags_sql = (
+            f"INSERT INTO {ZettleCard.tags.through._meta.db_table} "
+            "(from_zettlecard_id, to_zettlecard_id) VALUES (%s, %s)"
+        )
+        tag_links = 0
+        created = 0
+        with connection.cursor() as cursor:
+            while created < count:
+                size = min(self.batch_size, count - created)
+                cards, tags = self.build_batch(size, created, count)
+                cursor.executemany(insert_sql, cards)
+                cursor.executemany(tags_sql, tags)
+                created += size
+                tag_links += len(tags) // 2
+                if progress:
+                    progress(created)
+        return tag_links
+
+    def create_users(self):
+        existing = set(
+            User.objects.filter(username__startswith="garden_").values_list(
+                "username", flat=True
+            )
+        )
+        password = make_password(None)
+        User.objects.bulk_create(
+            User(username=username, email=f"{username}@example.com", password=password)
+            for i in range(self.user_count)
+            if (username := f"garden_{i}") not in existing
+        )
+        return list(
+            User.objects.filter(username__startswith="garden_")
+            .order_by("pk")
+            .values_list("pk", flat=True)[: self.user_count]
+        ) or [None]
+
+    def create_blobs(self):
+        """A few stored images and documents for cards to share."""
+        if not self.blobs:
+            return [], []
+        storage = get_blob_storage()
+        images, documents = [], []
+        for i in range(BLOB_POOL):
+            color = tuple(self.rng.randrange(256) for _ in range(3))
+            buffer = BytesIO()
+            Image.new("RGB", (1600, 1000), color).save(buffer, "PNG")
+            images.append(
+                storage.save(f"garden_{i}.png", ContentFile(buffer.getvalue()))
+            )
+            document = f"%PDF-1.4 garden document {i}\n".encode()
+            documents.append(storage.save(f"garden_{i}.pdf", ContentFile(document)))
+        return images, documents
+
+    def uuid(self):
+        # The bits of a version 4 uuid, set by hand as UUID(version=4) would.
+        value = self.rng.getrandbits(128) & ~UUID_MASK | UUID_VERSION
+        return UUID(int=value) if self.native_uuids else f"{value:032x}"
+
+    def words(self, count):
+        # Slicing a long run of words is several times quicker than joining
+        # fresh choices for every card.
+        start = self.rng.randrange(CORPUS_WORDS - count)
+        return self.corpus[
+            self.word_starts[start] : self.word_starts[start + count] - 1
+        ]
+
+    def build_batch(self, size, start, total):
+        rng = self.rng
+        adapt_datetime = connection.ops.adapt_datetimefield_value
+        empty_json = ZettleCard._meta.get_field("thumbnails").get_db_prep_save(
+            {}, connection
+        )
+        card_types = rng.choices(CARD_TYPES, CARD_TYPE_WEIGHTS, k=size)
+        cards, tags = [], []
+        for offset, card_type in enumerate(card_types):
+            pk = self.next_id
+            self.next_id += 1
+            created_at = START + SPAN * ((start + offset) / total)
+            votes = max(1, int(rng.paretovariate(1.2)))
+
+            parent_id, path = None, ""
+            if self.recent and rng.random() < PARENT_CHANCE:
+                parent_id, parent_path, depth = rng.choice(self.recent)
+                if depth < MAX_DEPTH:
+                    path = parent_path
+                else:
+                    parent_id = None
+            path = f"{path}{pk}/"
+            depth = path.count("/") - 1
+            self.recent.append((pk, path, depth))
+
+            next_id = sequence_id = None
+            sequence_key = ""
+            if not self.sequence and rng.random() < SEQUENCE_CHANCE:
+                # Sequences end with the garden, so every next card exists.
+                length = min(
+                    rng.randint(2, MAX_SEQUENCE_LENGTH), total - start - offset
+                )
+                self.sequence = keys_between(None, None, length)[::-1]
+                self.sequence_id = self.uuid()
+            if self.sequence:
+                sequence_key = self.sequence.pop()
+                sequence_id = self.sequence_id
+                # Members are consecutive cards, so the next one's id is known.
+                next_id = pk + 1 if self.sequence else None
+
+            reply_to_id = None
+            if self.threads and rng.random() < REPLY_CHANCE:
+                reply_to_id = self._pick(self.threads, self.thread_weights)[0]
+            self._add_to_pool(self.threads, THREAD_POOL, pk)
+
+            if card_type == "topic":
+                self._add_to_pool(self.topics, TOPIC_POOL, pk)
+            elif self.topics:
+                tag_count = min(int(rng.expovariate(1 / MEAN_TAGS)), len(self.topics))
+                tag_ids = set(self._pick(self.topics, self.topic_weights, tag_count))
+                for tag_id in tag_ids:
+                    tags.append((pk, tag_id))
+                    tags.append((tag_id, pk))
+
+            x = y = grid_x = grid_y = None
+            if rng.random() >= UNPLACED_CHANCE:
+                center_x, center_y = rng.choice(self.clusters)
+                x = int(rng.gauss(center_x, CLUSTER_SPREAD))
+                y = int(rng.gauss(center_y, CLUSTER_SPREAD))
+                grid_x, grid_y = grid_cell(x, y)
+
+            image = document = None
+            if self.blobs and rng.random() < BLOB_CHANCE:
+                if card_type == "image":
+                    image = rng.choice(self.image_names)
+                elif card_type == "text":
+                    document = rng.choice(self.document_names)
+
+            # Model cards point to a user or to an earlier card.
+            content_type_id = object_id = None
+            if card_type == "model":
+                if self.user_ids[0] and rng.random() < USER_REFERENCE_CHANCE:
+                    content_type_id = self.user_type_id
+                    object_id = rng.choice(self.user_ids)
+                elif len(self.recent) > 1:
+                    content_type_id = self.card_type_id
+                    object_id = self.recent[rng.randrange(len(self.recent) - 1)][0]
+
+            timestamp = adapt_datetime(created_at)
+            cards.append(
+                (
+                    pk,
+                    timestamp,
+                    timestamp,
+                    self.uuid(),
+                    card_type,
+                    rng.choice(self.user_ids),
+                    self.words(rng.randint(2, 6)).capitalize(),
+                    votes,
+                    hot_score(votes, created_at),
+                    self.words(rng.randint(5, 60)) if card_type != "topic" else "",
+                    image,
+                    empty_json,
+                    document,
+                    f"https://example.com/{pk}" if card_type == "url" else "",
+                    "",
+                    parent_id,
+                    next_id,
+                    reply_to_id,
+                    sequence_id,
+                    sequence_key,
+                    x,
+                    y,
+                    grid_x,
+                    grid_y,
+                    path,
+                    depth,
+                    # Counted by ``update_indexes`` once every link is in.
+                    0,
+                    0,
+                    0,
+                    content_type_id,
+                    object_id,
+                )
+            )
+        return cards, tags
+
+    def _pick(self, pool, weights, k=1):
+        # Slicing the weights costs as much as the pick, so full pools skip it.
+        if len(pool) < len(weights):
+            weights = weights[: len(pool)]
+        return self.rng.choices(pool, cum_weights=weights, k=k)
+
+    def _add_to_pool(self, pool, size, pk):
+        # Newer cards replace random old ones, so pools drift over time.
+        if len(pool) < size:
+            pool.append(pk)
+        else:
+            pool[self.rng.randrange(size)] = pk
+
+
+def update_indexes():
+    """Rebuild the indexes derived from the generated rows."""
+    rebuild_tiles()
+    get_search_backend().rebuild()
+    count_references()
+    recount_links()
+    recount_tags()
@@ -0,0 +1,140 @@
+from itertools import batched
+
+from django.db import connection, transaction
+from django.db.models import (
+    F,
+    Value,
+    aprefetch_related_objects,
+    prefetch_related_objects,
+)
+from django.db.models.functions import Concat, Substr
+
+from backend.zettle.models import ZettleCard, path_range
+
+MAX_TREE_DEPTH = 32
+
+# Sibling orderings accepted by the tree endpoint, mapped to SQL.
+TREE_ORDERINGS = {
+    "created_at": "c.created_at, c.id",
+    "-created_at": "c.created_at DESC, c.id DESC",
+    "title": "c.title, c.id",
+    "-title": "c.title DESC, c.id DESC",
+    "votes": "c.votes, c.id",
+    "-votes": "c.votes DESC, c.id DESC",
+}
+
+SUBTREE_SQL = """
+    WITH RECURSIVE subtree(id, tree_depth) AS (
+        SELECT id, 0 FROM zettle_zettlecard WHERE id = %s
+        UNION ALL
+        SELECT c.id, s.tree_depth + 1
+        FROM zettle_zettlecard c
+        JOIN subtree s ON c.parent_id = s.id
+        WHERE s.tree_depth < %s
+    )
+    SELECT c.*, s.tree_depth
+    FROM subtree s
+    JOIN zettle_zettlecard c ON c.id = s.id
+    ORDER BY s.tree_depth, {ordering}
+"""
+
+
+def fetch_subtree(root: ZettleCard, depth: int, ordering="created_at"):
+    """Load ``root`` and its descendants down to ``depth`` levels in one query.
+
+    Every returned card has ``tree_depth`` and ``tree_children`` (the loaded
+    children in ``ordering`` order) set. Its stored ``child_count`` includes
+    children past the depth limit.
+    """
+    cards = list(_subtree_query(root, depth, ordering))
+    prefetch_related_objects(cards, "tags")
+    return _link_subtree(cards, root)
+
+
+async def afetch_subtree(root: ZettleCard, depth: int, ordering="created_at"):
+    """``fetch_subtree`` for async views."""
+    cards = [card async for card in _subtree_query(root, depth, ordering)]
+    await aprefetch_related_objects(cards, "tags")
+    return _link_subtree(cards, root)
+
+
+def _subtree_query(root, depth, ordering):
+    return ZettleCard.objects.raw(
+        SUBTREE_SQL.format(ordering=TREE_ORDERINGS[ordering]),
+        [root.pk, min(depth, MAX_TREE_DEPTH)],
+    )
+
+
+def _link_subtree(cards, root):
+    by_id = {}
+    for card in cards:
+        card.tree_children = []
+        # A corrupt parent cycle can bring the root back in; keep the first.
+        if card.pk in by_id:
+            continue
+        by_id[card.pk] = card
+        if card.tree_depth and card.parent_id in by_id:
+            by_id[card.parent_id].tree_children.append(card)
+    return by_id[root.pk]
+
+
+def walk_subtree(card):
+    yield card
+    for child in card.tree_children:
+        yield from walk_subtree(child)
+
+
+def reroot_subtrees(card_ids):
+    """Make each surviving card in ``card_ids`` the root of its own subtree.
+
+    Used after a parent is deleted, since SET_NULL detaches its children
+    without saving them. Paths are read fresh so that deleting a card together
+    with its descendants works in any order.
+    """
+    roots = ZettleCard.objects.filter(pk__in=card_ids).values_list("pk", "path")
+    for pk, old_path in roots:
+        new_path = f"{pk}/"
+        if old_path == new_path:
+            continue
+        ZettleCard.objects.filter(**path_range(old_path)).update(
+            path=Concat(Value(new_path), Substr("path", len(old_path) + 1)),
+            depth=F("depth") - (old_path.count("/") - 1),
+        )
+
+
+@transaction.atomic
+def rebuild_paths(batch_size=2000):
+    """Recompute every materialized path from the ``parent`` links.
+
+    Cards caught in a parent cycle are unreachable from any root and are made
+    roots themselves.
+    """
+    children = {}
+    for pk, parent_id in ZettleCard.objects.values_list("pk", "parent_id").iterator(
+        chunk_size=batch_size
+    ):
+        children.setdefault(parent_id, []).append(pk)
+
+    paths = {}
+    stack = [(pk, "") for pk in children.get(None, [])]
+    unreached = {pk for siblings in children.values() for pk in siblings}
+    while stack or unreached:
+        if not stack:
+            stack.append((unreached.pop(), ""))
+        pk, parent_path = stack.pop()
+        unreached.discard(pk)
+        if pk in paths:
+            continue
+        paths[pk] = f"{parent_path}{pk}/"
+        stack.extend((child, paths[pk]) for child in children.get(pk, []))
+
+    # One prepared statement per card beats bulk_update's CASE expressions,
+    # whose cost grows with the batch.
+    rows = ((path, path.count("/") - 1, pk) for pk, path in paths.items())
+    with connection.cursor() as cursor:
+        for batch in batched(rows, batch_size):
+            cursor.executemany(
+                "UPDATE zettle_zettlecard SET path = %s, depth = %s WHERE id = %s",
+                batch,
+            )
+    return len(paths)
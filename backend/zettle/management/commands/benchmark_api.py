@@ -0,0 +1,143 @@
+import json
+import platform
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from backend.zettle.benchmarks import (
+    REQUESTS,
+    SYNC_THREADS,
+    Benchmark,
+    ConcurrencyBenchmark,
+)
+from backend.zettle.generator import GardenGenerator, update_indexes
+from backend.zettle.models import ZettleCard
+
+FORMAT_VERSION = 1
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the card API's main requests at each garden size, checking their "
+        "query budgets. Gardens smaller than a size are filled up with "
+        "generated cards first, so run it against a scratch database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            default="1000,100000,1000000",
+            help="Comma-separated garden sizes to benchmark, smallest first.",
+        )
+        parser.add_argument("--requests", type=int, default=REQUESTS)
+        parser.add_argument("--seed", type=int, default=42)
+        parser.add_argument(
+            "--scenarios", help="Comma-separated scenarios to run, by default all."
+        )
+        parser.add_argument(
+            "--concurrency",
+            help="Comma-separated numbers of concurrent clients to compare the "
+            "sync and async reads at, e.g. 1,8,32. Skipped by default.",
+        )
+        parser.add_argument(
+            "--threads",
+            type=int,
+            default=SYNC_THREADS,
+            help="Worker threads of the sync server in the concurrency comparison.",
+        )
+        parser.add_argument(
+            "--output", help="Write the results as JSON to this file, or - for stdout."
+        )
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(size) for size in options["sizes"].split(","))
+        names = options["scenarios"] and options["scenarios"].split(",")
+        concurrency = options["concurrency"] and [
+            int(clients) for clients in options["concurrency"].split(",")
+        ]
+        runs = []
+        # The test client's requests come from "testserver".
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "testserver"]):
+            for size in sizes:
+                existing = ZettleCard.objects.count()
+                if existing < size:
+                    self.stdout.write(f"Generating {size - existing} cards...")
+                    GardenGenerator(seed=options["seed"] + existing).generate(
+                        size - existing
+                    )
+                    update_indexes()
+                benchmark = Benchmark(options["requests"], options["seed"])
+                try:
+                    results = benchmark.run(names)
+                except KeyError as e:
+                    raise CommandError(f"Unknown scenario: {e}")
+                runs.append({"cards": ZettleCard.objects.count(), "scenarios": results})
+                self.write_table(runs[-1])
+                if concurrency:
+                    runs[-1]["concurrency"] = ConcurrencyBenchmark(
+                        options["requests"], options["seed"], options["threads"]
+                    ).run(concurrency)
+                    self.write_concurrency_table(runs[-1])
+
+        report = {
+            "version": FORMAT_VERSION,
+            "created_at": timezone.now().isoformat(),
+            "database": connection.vendor,
+            "python": platform.python_version(),
+            "requests": options["requests"],
+            "seed": options["seed"],
+            "threads": options["threads"],
+            "runs": runs,
+        }
+        if options["output"] == "-":
+            json.dump(report, sys.stdout, indent=2)
+        elif options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(report, f, indent=2)
+
+        over = [
+            f"{name} at {run['cards']} cards ({result['queries']} queries)"
+            for run in runs
+            for name, result in run["scenarios"].items()
+            if result["queries"] > result["query_budget"]
+        ]
+        if over:
+            raise CommandError(f"Over the query budget: {', '.join(over)}")
+
+    def write_table(self, run):
+        self.stdout.write(f"\n{run['cards']} cards")
+        self.stdout.write(
+            f"{'scenario':<16}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+            f"{'req/s':>10}{'queries':>10}"
+        )
+        for name, result in run["scenarios"].items():
+            queries = f"{result['queries']}/{result['query_budget']}"
+            line = (
+                f"{name:<16}{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}"
+                f"{result['p99_ms']:>10.1f}{result['throughput']:>10.1f}{queries:>10}"
+            )
+            if result["queries"] > result["query_budget"]:
+                line = self.style.ERROR(line)
+            self.stdout.write(line)
+
+    def write_concurrency_table(self, run):
+        self.stdout.write(f"\n{run['cards']} cards, sync vs async")
+        self.stdout.write(
+            f"{'read':<10}{'clients':>8}{'sync req/s':>12}{'async req/s':>12}"
+            f"{'sync p95':>10}{'async p95':>10}"
+        )
+        for read, by_clients in run["concurrency"].items():
+            for clients, result in by_clients.items():
+                sync, async_ = result["sync"], result["async"]
+                line = (
+                    f"{read:<10}{clients:>8}{sync['throughput']:>12.1f}"
+                    f"{async_['throughput']:>12.1f}{sync['p95_ms']:>10.1f}"
+                    f"{async_['p95_ms']:>10.1f}"
+                )
+                if sync["errors"] or async_["errors"]:
+                    line = self.style.ERROR(line)
+                self.stdout.write(line)
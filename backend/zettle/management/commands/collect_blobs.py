@@ -0,0 +1,35 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from backend.zettle.blobs import BLOB_GRACE, collect_blobs, count_references
+from backend.zettle.uploads import UPLOAD_SESSION_TTL, prune_upload_sessions
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete stored files no card references, and resumable uploads left "
+        f"unfinished for {UPLOAD_SESSION_TTL.days} days."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--recount",
+            action="store_true",
+            help="Recount every file's references from the cards first.",
+        )
+        parser.add_argument(
+            "--grace-hours",
+            type=float,
+            default=BLOB_GRACE.total_seconds() / 3600,
+            help="Keep unreferenced files stored more recently than this.",
+        )
+
+    def handle(self, *args, **options):
+        if options["recount"]:
+            fixed = count_references()
+            self.stdout.write(f"Fixed the reference counts of {fixed} files")
+        count = collect_blobs(timedelta(hours=options["grace_hours"]))
+        self.stdout.write(self.style.SUCCESS(f"Deleted {count} unreferenced files"))
+        count = prune_upload_sessions()
+        self.stdout.write(self.style.SUCCESS(f"Pruned {count} unfinished uploads"))
@@ -0,0 +1,35 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from backend.zettle.models import ZettleCard
+from backend.zettle.transfer import BATCH_SIZE, export_cards, export_media
+
+
+class Command(BaseCommand):
+    help = "Write every card, with its links and tags, as NDJSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "output", nargs="?", help="File to write to, standard output by default."
+        )
+        parser.add_argument(
+            "--media", help="Also write the card images and documents to this tar file."
+        )
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        cards = ZettleCard.objects.all()
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                self.write_cards(cards, output, options["batch_size"])
+        else:
+            self.write_cards(cards, sys.stdout, options["batch_size"])
+        if options["media"]:
+            with open(options["media"], "wb") as archive:
+                count = export_media(cards, archive)
+            self.stderr.write(self.style.SUCCESS(f"Archived {count} files"))
+
+    def write_cards(self, cards, output, batch_size):
+        for lines in export_cards(cards, batch_size):
+            output.write(lines)
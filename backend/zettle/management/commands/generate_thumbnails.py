@@ -0,0 +1,51 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from backend.zettle.models import ZettleCard
+from backend.zettle.thumbnails import generate_thumbnails
+
+
+def _generate(card_id, rerender):
+    try:
+        return generate_thumbnails(card_id, rerender)
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = "Generate the thumbnails of image cards that don't have them yet."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Regenerate the thumbnails of every image card, re-rendering "
+            "those shared by cards with the same image.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Number of images resized at once; 1 resizes them in this thread.",
+        )
+
+    def handle(self, *args, **options):
+        cards = ZettleCard.objects.exclude(image="").exclude(image__isnull=True)
+        if not options["all"]:
+            cards = cards.filter(thumbnails={})
+        card_ids = list(cards.order_by("pk").values_list("pk", flat=True))
+
+        rerender = [options["all"]] * len(card_ids)
+        if options["workers"] > 1:
+            with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+                results = list(executor.map(_generate, card_ids, rerender))
+        else:
+            results = list(map(generate_thumbnails, card_ids, rerender))
+        generated = sum(thumbnails is not None for thumbnails in results)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Generated thumbnails for {generated} of {len(card_ids)} cards"
+            )
+        )
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from backend.zettle.transfer import (
+    BATCH_SIZE,
+    GardenImportError,
+    import_cards,
+    import_media,
+)
+
+
+class Command(BaseCommand):
+    help = "Load the cards of an export_garden file, skipping those already here."
+
+    def add_arguments(self, parser):
+        parser.add_argument("input", help="NDJSON file written by export_garden.")
+        parser.add_argument(
+            "--media", help="Tar file of card images and documents to store first."
+        )
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        if options["media"]:
+            with open(options["media"], "rb") as archive:
+                count = import_media(archive)
+            self.stdout.write(f"Stored {count} files")
+        with open(options["input"], "rb") as f:
+            try:
+                counts = import_cards(f, options["batch_size"])
+            except GardenImportError as e:
+                raise CommandError(str(e))
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Imported {counts['created']} cards, "
+                f"skipped {counts['skipped']} already here"
+            )
+        )
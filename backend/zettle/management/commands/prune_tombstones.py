@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from backend.zettle.sync import TOMBSTONE_RETENTION, prune_tombstones
+
+
+class Command(BaseCommand):
+    help = (
+        f"Delete the records of cards deleted over {TOMBSTONE_RETENTION.days} days "
+        "ago, which the changes feed no longer serves."
+    )
+
+    def handle(self, *args, **options):
+        count = prune_tombstones()
+        self.stdout.write(self.style.SUCCESS(f"Pruned {count} tombstones"))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from backend.zettle.clusters import rebuild_tiles
+from backend.zettle.hierarchy import rebuild_paths
+from backend.zettle.search import get_search_backend
+
+INDEXES = {
+    "hierarchy": rebuild_paths,
+    "clusters": rebuild_tiles,
+    "search": lambda: get_search_backend().rebuild(),
+}
+
+
+class Command(BaseCommand):
+    help = "Rebuild the derived card indexes from the cards table."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--only",
+            nargs="+",
+            choices=INDEXES,
+            help="Rebuild only these indexes.",
+        )
+
+    def handle(self, *args, **options):
+        for name in options["only"] or INDEXES:
+            count = INDEXES[name]()
+            self.stdout.write(self.style.SUCCESS(f"Rebuilt {name}: {count} rows"))
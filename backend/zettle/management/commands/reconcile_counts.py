@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from backend.zettle.counters import recount_links
+from backend.zettle.tags import recount_tags
+
+COUNTERS = {
+    "children": lambda: recount_links(counters=["child_count"]),
+    "replies": lambda: recount_links(counters=["reply_count"]),
+    "tags": recount_tags,
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Recount the child, reply and tag counts stored on each card, fixing "
+        "any that drifted from the links."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--only",
+            nargs="+",
+            choices=COUNTERS,
+            help="Recount only these counters.",
+        )
+
+    def handle(self, *args, **options):
+        for name in options["only"] or COUNTERS:
+            count = COUNTERS[name]()
+            self.stdout.write(self.style.SUCCESS(f"Recounted {name}: {count} fixed"))
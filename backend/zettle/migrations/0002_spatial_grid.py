@@ -0,0 +1,51 @@
+# Generated by Django 5.1.6 on 2026-10-18 14:02
+
+from django.conf import settings
+from django.db import migrations, models
+
+GRID_SIZE = 512
+
+
+def populate_grid(apps, schema_editor):
+    ZettleCard = apps.get_model('zettle', 'ZettleCard')
+    cards = ZettleCard.objects.exclude(x=None).exclude(y=None).only('id', 'x', 'y')
+    batch = []
+    for card in cards.iterator(chunk_size=2000):
+        card.grid_x = card.x // GRID_SIZE
+        card.grid_y = card.y // GRID_SIZE
+        batch.append(card)
+        if len(batch) >= 2000:
+            ZettleCard.objects.bulk_update(batch, ['grid_x', 'grid_y'])
+            batch = []
+    ZettleCard.objects.bulk_update(batch, ['grid_x', 'grid_y'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('zettle', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='zettlecard',
+            options={'ordering': ['-created_at'], 'verbose_name': 'Zettle Card', 'verbose_name_plural': 'Zettle Cards'},
+        ),
+        migrations.AddField(
+            model_name='zettlecard',
+            name='grid_x',
+            field=models.IntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='zettlecard',
+            name='grid_y',
+            field=models.IntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='zettlecard',
+            index=models.Index(fields=['grid_x', 'grid_y'], name='zettle_zett_grid_x_fc03e2_idx'),
+        ),
+        migrations.RunPython(populate_grid, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.6 on 2026-10-18 14:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zettle', '0002_spatial_grid'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ZettleTile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('level', models.PositiveSmallIntegerField()),
+                ('tile_x', models.IntegerField()),
+                ('tile_y', models.IntegerField()),
+                ('card_count', models.PositiveIntegerField(default=0)),
+                ('sum_x', models.BigIntegerField(default=0)),
+                ('sum_y', models.BigIntegerField(default=0)),
+                ('type_counts', models.JSONField(default=dict)),
+                ('top_cards', models.JSONField(default=list)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('level', 'tile_x', 'tile_y'), name='unique_zettle_tile')],
+            },
+        ),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 5.1.6 on 2026-10-18 14:06
+
+from django.db import migrations
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE zettle_search USING fts5(
+        title, text, tags, tokenize = 'unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    INSERT INTO zettle_search (rowid, title, text, tags)
+    SELECT c.id, c.title, c.text, COALESCE((
+        SELECT group_concat(t.title, ' ') FROM zettle_zettlecard_tags ct
+        JOIN zettle_zettlecard t ON t.id = ct.to_zettlecard_id
+        WHERE ct.from_zettlecard_id = c.id
+    ), '')
+    FROM zettle_zettlecard c
+    """,
+]
+
+POSTGRES_FORWARD = [
+    """
+    CREATE TABLE zettle_search (
+        card_id bigint PRIMARY KEY
+            REFERENCES zettle_zettlecard (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+        document tsvector NOT NULL
+    )
+    """,
+    "CREATE INDEX zettle_search_document_idx ON zettle_search USING GIN (document)",
+    """
+    INSERT INTO zettle_search (card_id, document)
+    SELECT c.id,
+        setweight(to_tsvector('simple', c.title), 'A') ||
+        setweight(to_tsvector('simple', COALESCE((
+            SELECT string_agg(t.title, ' ') FROM zettle_zettlecard_tags ct
+            JOIN zettle_zettlecard t ON t.id = ct.to_zettlecard_id
+            WHERE ct.from_zettlecard_id = c.id
+        ), '')), 'B') ||
+        setweight(to_tsvector('simple', c.text), 'C')
+    FROM zettle_zettlecard c
+    """,
+]
+
+BACKWARD = ["DROP TABLE zettle_search"]
+
+
+def create_search_index(apps, schema_editor):
+    statements = {
+        'sqlite': SQLITE_FORWARD,
+        'postgresql': POSTGRES_FORWARD,
+    }.get(schema_editor.connection.vendor, [])
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        for statement in BACKWARD:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zettle', '0003_tiles'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.1.6 on 2026-10-18 14:08
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def populate_paths(apps, schema_editor):
+    ZettleCard = apps.get_model('zettle', 'ZettleCard')
+    children = {}
+    for pk, parent_id in ZettleCard.objects.values_list('pk', 'parent_id'):
+        children.setdefault(parent_id, []).append(pk)
+
+    paths = {}
+    stack = [(pk, '') for pk in children.get(None, [])]
+    unreached = {pk for siblings in children.values() for pk in siblings}
+    while stack or unreached:
+        if not stack:
+            stack.append((unreached.pop(), ''))
+        pk, parent_path = stack.pop()
+        unreached.discard(pk)
+        if pk in paths:
+            continue
+        paths[pk] = f'{parent_path}{pk}/'
+        stack.extend((child, paths[pk]) for child in children.get(pk, []))
+
+    ZettleCard.objects.bulk_update(
+        [ZettleCard(pk=pk, path=path, depth=path.count('/') - 1) for pk, path in paths.items()],
+        ['path', 'depth'],
+        batch_size=2000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('zettle', '0004_search_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='zettlecard',
+            name='depth',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='zettlecard',
+            name='path',
+            field=models.CharField(blank=True, editable=False, max_length=1023),
+        ),
+        migrations.AddIndex(
+            model_name='zettlecard',
+            index=models.Index(fields=['path'], name='zettle_zett_path_367485_idx'),
+        ),
+        migrations.RunPython(populate_paths, migrations.RunPython.noop),
+    ]
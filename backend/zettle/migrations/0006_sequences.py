@@ -0,0 +1,69 @@
+# Generated by Django 5.1.6 on 2026-10-18 14:10
+
+import uuid
+
+from django.conf import settings
+from django.db import migrations, models
+
+KEY_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def base36(number):
+    digits = ''
+    while True:
+        number, digit = divmod(number, 36)
+        digits = KEY_DIGITS[digit] + digits
+        if not number:
+            return digits
+
+
+def populate_sequences(apps, schema_editor):
+    ZettleCard = apps.get_model('zettle', 'ZettleCard')
+    next_ids = dict(ZettleCard.objects.exclude(next=None).values_list('pk', 'next_id'))
+    has_prev = set(next_ids.values())
+
+    batch = []
+    for head in next_ids.keys() - has_prev:
+        chain, seen = [head], {head}
+        while chain[-1] in next_ids and next_ids[chain[-1]] not in seen:
+            chain.append(next_ids[chain[-1]])
+            seen.add(chain[-1])
+        # Equal-width keys sort in chain order and end in a non-zero digit.
+        width = len(base36(len(chain)))
+        sequence_id = uuid.uuid4()
+        batch.extend(
+            ZettleCard(
+                pk=pk,
+                sequence_id=sequence_id,
+                sequence_key=base36(position).rjust(width, '0') + 'i',
+            )
+            for position, pk in enumerate(chain)
+        )
+    ZettleCard.objects.bulk_update(batch, ['sequence_id', 'sequence_key'], batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('zettle', '0005_hierarchy_path'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='zettlecard',
+            name='sequence_id',
+            field=models.UUIDField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='zettlecard',
+            name='sequence_key',
+            field=models.CharField(blank=True, editable=False, max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name='zettlecard',
+            index=models.Index(fields=['sequence_id', 'sequence_key'], name='zettle_zett_sequenc_896edd_idx'),
+        ),
+        migrations.RunPython(populate_sequences, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.1.6 on 2026-10-18 14:15
+
+from django.conf import settings
+from django.db import migrations, models
+
+from backend.zettle.ranking import hot_score
+
+
+def populate_hot_scores(apps, schema_editor):
+    ZettleCard = apps.get_model('zettle', 'ZettleCard')
+    batch = [
+        ZettleCard(pk=pk, hot_score=hot_score(votes, created_at))
+        for pk, votes, created_at in ZettleCard.objects.values_list('pk', 'votes', 'created_at')
+    ]
+    ZettleCard.objects.bulk_update(batch, ['hot_score'], batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('zettle', '0006_sequences'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='zettlecard',
+            name='hot_score',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='zettlecard',
+            index=models.Index(fields=['reply_to', '-hot_score', '-id'], name='zettle_zett_reply_t_93ef1c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='zettlecard',
+            index=models.Index(fields=['reply_to', '-votes', '-id'], name='zettle_zett_reply_t_d835f8_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='zettlecard',
+            index=models.Index(fields=['reply_to', '-created_at', '-id'], name='zettle_zett_reply_t_cee4c2_idx'),
+        ),
+        migrations.RunPython(populate_hot_scores, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.1.6 on 2026-10-18 14:19
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('zettle', '0008_votes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='zettlecard',
+            index=models.Index(fields=['created_at', 'id'], name='zettle_zett_created_e65f69_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='zettlecard',
+            index=models.Index(fields=['updated_at', 'id'], name='zettle_zett_updated_1b7bf5_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='zettlecard',
+            index=models.Index(fields=['votes', 'id'], name='zettle_zett_votes_0b8e66_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='zettlecard',
+            index=models.Index(fields=['title', 'id'], name='zettle_zett_title_a06d1e_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-18 14:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zettle', '0010_tombstones'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='zettlecard',
+            name='thumbnails',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
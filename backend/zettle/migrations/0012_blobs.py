@@ -0,0 +1,63 @@
+# Generated by Django 5.1.6 on 2026-10-18 14:29
+
+import uuid
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+import backend.zettle.models
+import backend.zettle.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zettle', '0011_thumbnails'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='zettlecard',
+            name='document',
+            field=models.FileField(blank=True, max_length=1023, null=True, storage=backend.zettle.storage.get_blob_storage, upload_to=backend.zettle.models.get_file_upload_path),
+        ),
+        migrations.AlterField(
+            model_name='zettlecard',
+            name='image',
+            field=models.ImageField(blank=True, max_length=1023, null=True, storage=backend.zettle.storage.get_blob_storage, upload_to=backend.zettle.models.get_image_upload_path),
+        ),
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('name', models.CharField(max_length=1023)),
+                ('size', models.BigIntegerField()),
+                ('ref_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['ref_count', 'created_at'], name='zettle_blob_ref_cou_96d51e_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('uuid', models.UUIDField(db_index=True, default=uuid.uuid4, editable=False)),
+                ('filename', models.CharField(max_length=255)),
+                ('size', models.BigIntegerField()),
+                ('offset', models.BigIntegerField(default=0)),
+                ('sha256', models.CharField(blank=True, max_length=64)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
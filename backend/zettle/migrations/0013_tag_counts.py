@@ -0,0 +1,39 @@
+# Generated by Django 5.1.6 on 2026-10-18 14:59
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def populate_tag_counts(apps, schema_editor):
+    ZettleCard = apps.get_model('zettle', 'ZettleCard')
+    links = ZettleCard.tags.through.objects.filter(from_zettlecard_id=OuterRef('pk'))
+    ZettleCard.objects.update(
+        tag_count=Coalesce(
+            Subquery(links.values('from_zettlecard_id').annotate(count=Count('*')).values('count')),
+            0,
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('zettle', '0012_blobs'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='zettlecard',
+            name='tag_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='zettlecard',
+            index=models.Index(fields=['tag_count', 'id'], name='zettle_zett_tag_cou_cd9b0b_idx'),
+        ),
+        migrations.RunPython(populate_tag_counts, migrations.RunPython.noop),
+    ]
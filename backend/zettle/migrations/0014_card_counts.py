@@ -0,0 +1,52 @@
+# Generated by Django 5.1.6 on 2026-10-18 15:05
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def populate_counts(apps, schema_editor):
+    ZettleCard = apps.get_model('zettle', 'ZettleCard')
+    counts = {}
+    for counter, link in [('child_count', 'parent'), ('reply_count', 'reply_to')]:
+        linked = (
+            ZettleCard.objects.filter(**{link: OuterRef('pk')})
+            .order_by()
+            .values(link)
+            .annotate(count=Count('*'))
+            .values('count')
+        )
+        counts[counter] = Coalesce(Subquery(linked), 0)
+    ZettleCard.objects.update(**counts)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('zettle', '0013_tag_counts'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='zettlecard',
+            name='child_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='zettlecard',
+            name='reply_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='zettlecard',
+            index=models.Index(fields=['child_count', 'id'], name='zettle_zett_child_c_1f054e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='zettlecard',
+            index=models.Index(fields=['reply_count', 'id'], name='zettle_zett_reply_c_55a9a3_idx'),
+        ),
+        migrations.RunPython(populate_counts, migrations.RunPython.noop),
+    ]
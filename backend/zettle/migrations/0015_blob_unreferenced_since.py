@@ -0,0 +1,35 @@
+# Generated by Django 5.1.6 on 2026-10-18 15:49
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F
+
+
+def populate_unreferenced_since(apps, schema_editor):
+    Blob = apps.get_model('zettle', 'Blob')
+    Blob.objects.filter(ref_count__gt=0).update(unreferenced_since=None)
+    Blob.objects.filter(ref_count=0).update(unreferenced_since=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zettle', '0014_card_counts'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='blob',
+            name='zettle_blob_ref_cou_96d51e_idx',
+        ),
+        migrations.AddField(
+            model_name='blob',
+            name='unreferenced_since',
+            field=models.DateTimeField(default=django.utils.timezone.now, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='blob',
+            index=models.Index(fields=['ref_count', 'unreferenced_since'], name='zettle_blob_ref_cou_867f0c_idx'),
+        ),
+        migrations.RunPython(populate_unreferenced_since, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.1.6 on 2026-10-18 16:12
+
+from django.db import migrations
+
+# path_range() treats a range of paths as a prefix, which only holds when paths
+# compare bytewise. SQLite's default BINARY collation does; locale collations
+# such as PostgreSQL's en_US.UTF-8 don't, so the column gets a bytewise one.
+# Its index is rebuilt along with it.
+FORWARD = {
+    'postgresql': 'ALTER TABLE zettle_zettlecard ALTER COLUMN path TYPE varchar(1023) COLLATE "C"',
+    'mysql': 'ALTER TABLE zettle_zettlecard MODIFY path varchar(1023) CHARACTER SET ascii COLLATE ascii_bin NOT NULL',
+}
+
+BACKWARD = {
+    'postgresql': 'ALTER TABLE zettle_zettlecard ALTER COLUMN path TYPE varchar(1023) COLLATE "default"',
+    'mysql': 'ALTER TABLE zettle_zettlecard MODIFY path varchar(1023) NOT NULL',
+}
+
+
+def use_bytewise_collation(apps, schema_editor):
+    statement = FORWARD.get(schema_editor.connection.vendor)
+    if statement:
+        schema_editor.execute(statement)
+
+
+def use_default_collation(apps, schema_editor):
+    statement = BACKWARD.get(schema_editor.connection.vendor)
+    if statement:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zettle', '0015_blob_unreferenced_since'),
+    ]
+
+    operations = [
+        migrations.RunPython(use_bytewise_collation, use_default_collation),
+    ]
@@ -2,9 +2,17 @@ from pathlib import Path
 
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models import F, Max, Value
+from django.db.models.functions import Concat, Length, Substr
+from django.utils import timezone
 
 from backend.core.models import BaseModel
+from backend.zettle.card_cache import invalidate_cards
+from backend.zettle.ranking import hot_score
+from backend.zettle.spatial import grid_cell
+from backend.zettle.storage import get_blob_storage
 
 
 def format_filename_as_title(filename: str) -> str:
@@ -20,6 +28,18 @@ def get_image_upload_path(instance, filename):
     return f"images/{instance.uuid}{ext}"
 
 
+def path_range(path: str) -> dict:
+    """Lookups matching every materialized path that starts with ``path``.
+
+    Paths only contain digits and slashes, so the prefix is expressed as a
+    range that any B-tree index can serve (LIKE prefixes are not indexable on
+    SQLite). The range relies on paths comparing bytewise, where "/" sorts
+    before the digits; migration 0016 gives the column such a collation on
+    databases whose default is a locale one.
+    """
+    return {"path__gte": path, "path__lt": path[:-1] + "0"}
+
+
 def get_file_upload_path(instance, filename):
     if not instance.title:
         instance.title = format_filename_as_title(filename)
@@ -27,6 +47,30 @@ def get_file_upload_path(instance, filename):
     return f"files/{instance.uuid}{ext}"
 
 
+# Longest materialized path the column holds, which limits how deeply trees
+# nest: about 100 levels while ids have 9 digits.
+PATH_LENGTH = 1023
+
+# A new card's id is only known once it's saved, so its path keeps room for
+# the longest id.
+NEW_ID_LENGTH = len(str(2**63 - 1))
+
+# Columns rewritten in bulk by queryset updates rather than through save().
+BULK_MAINTAINED_FIELDS = {
+    "path",
+    "depth",
+    "sequence_id",
+    "sequence_key",
+    "next_id",
+    "votes",
+    "hot_score",
+    "thumbnails",
+    "tag_count",
+    "child_count",
+    "reply_count",
+}
+
+
 class ZettleCard(BaseModel):
     class CardType(models.TextChoices):
         TEXT = "text", "Text Card"
@@ -48,6 +92,7 @@ class ZettleCard(BaseModel):
     )
     title = models.CharField(max_length=1023, blank=True)
     votes = models.IntegerField(default=1)
+    hot_score = models.FloatField(default=0, editable=False)
 
     # Content of various types
     text = models.TextField(blank=True)
@@ -56,9 +101,16 @@ class ZettleCard(BaseModel):
         null=True,
         blank=True,
         upload_to=get_image_upload_path,
+        storage=get_blob_storage,
     )
+    # Resized copies of ``image``, as {format: {width: name}}
+    thumbnails = models.JSONField(default=dict, blank=True, editable=False)
     document = models.FileField(
-        max_length=1023, upload_to=get_file_upload_path, null=True, blank=True
+        max_length=1023,
+        upload_to=get_file_upload_path,
+        storage=get_blob_storage,
+        null=True,
+        blank=True,
     )
     url = models.URLField(max_length=1023, blank=True)
     content_type = models.ForeignKey(
@@ -92,12 +144,223 @@ class ZettleCard(BaseModel):
         null=True,
         blank=True,
     )
+    # Number of cards with this one as parent and reply_to, kept by signals.
+    child_count = models.PositiveIntegerField(default=0, editable=False)
+    reply_count = models.PositiveIntegerField(default=0, editable=False)
+
+    # Ordered sequences: ``next`` links mirrored as sort keys within a sequence
+    sequence_id = models.UUIDField(null=True, blank=True, editable=False)
+    sequence_key = models.CharField(max_length=255, blank=True, editable=False)
 
     # Location
     tags = models.ManyToManyField("self", blank=True)
+    # Number of cards tagged with this one, kept by the tag signals.
+    tag_count = models.PositiveIntegerField(default=0, editable=False)
     slug = models.SlugField(max_length=255, blank=True)
     x = models.IntegerField(null=True, blank=True)
     y = models.IntegerField(null=True, blank=True)
+    grid_x = models.IntegerField(null=True, blank=True, editable=False)
+    grid_y = models.IntegerField(null=True, blank=True, editable=False)
+
+    # Hierarchy index: ids from the root down to this card, e.g. "3/17/42/"
+    path = models.CharField(max_length=PATH_LENGTH, blank=True, editable=False)
+    depth = models.PositiveIntegerField(default=0, editable=False)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def get_loaded_value(self, attname):
+        """Value of a field as of the last load from or save to the database."""
+        loaded_values = getattr(self, "_loaded_values", {})
+        if attname in loaded_values:
+            return loaded_values[attname]
+        return getattr(self, attname)
+
+    def has_changed(self, *attnames):
+        """Whether any of the fields differ from their loaded values."""
+        if not hasattr(self, "_loaded_values"):
+            return True
+        return any(
+            self.get_loaded_value(attname) != getattr(self, attname)
+            for attname in attnames
+        )
+
+    def save(self, *args, **kwargs):
+        self.grid_x, self.grid_y = grid_cell(self.x, self.y)
+        self.hot_score = hot_score(self.votes, self.created_at)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and {"x", "y"} & set(update_fields):
+            kwargs["update_fields"] = {*update_fields, "grid_x", "grid_y"}
+        if update_fields is not None and "votes" in update_fields:
+            kwargs["update_fields"] = {*kwargs["update_fields"], "hot_score"}
+
+        if not (self._state.adding or self.has_changed("parent_id")):
+            super().save(*args, **kwargs)
+            self._snapshot_loaded_values()
+            return
+
+        with transaction.atomic():
+            old_path = ""
+            if not self._state.adding:
+                # The instance may be stale, so move the subtree from the path
+                # stored now, locked until the move commits.
+                old_path = self._lock_move()
+            self.check_parent(self.parent_id, old_path)
+            super().save(*args, **kwargs)
+            self._move_subtree(old_path)
+        self._snapshot_loaded_values()
+
+    def _lock_move(self) -> str:
+        """Lock this card and its new parent's ancestors, returning its path.
+
+        Two moves can only make a cycle together if each card is an ancestor
+        of the other's new parent. Both then lock both cards, so the second
+        waits for the first and checks its parent against the paths it left.
+        """
+        while True:
+            parent_path = ""
+            if self.parent_id:
+                parent_path = (
+                    ZettleCard.objects.filter(pk=self.parent_id)
+                    .values_list("path", flat=True)
+                    .first()
+                ) or ""
+            chain = [int(pk) for pk in parent_path.split("/")[:-1]]
+            paths = dict(
+                ZettleCard.objects.select_for_update()
+                .filter(pk__in={self.pk, self.parent_id, *chain})
+                .order_by("pk")
+                .values_list("pk", "path")
+            )
+            # The chain may have moved before it was locked.
+            if (paths.get(self.parent_id) or "") == parent_path:
+                return paths.get(self.pk) or ""
+
+    def _move_subtree(self, old_path):
+        """Rewrite the path of this card and of its descendants after a re-parent."""
+        parent_path = ""
+        if self.parent_id:
+            parent_path = (
+                ZettleCard.objects.filter(pk=self.parent_id)
+                .values_list("path", flat=True)
+                .get()
+            )
+        self.path = f"{parent_path}{self.pk}/"
+        self.depth = self.path.count("/") - 1
+
+        if not old_path:
+            ZettleCard.objects.filter(pk=self.pk).update(
+                path=self.path, depth=self.depth
+            )
+            return
+        ZettleCard.objects.filter(**path_range(old_path)).update(
+            path=Concat(Value(self.path), Substr("path", len(old_path) + 1)),
+            depth=F("depth") + (self.depth - (old_path.count("/") - 1)),
+        )
+
+    def add_votes(self, delta):
+        """Add ``delta`` to the vote count and refresh the hot score.
+
+        The count is incremented in the database rather than written back, so
+        concurrent votes never overwrite each other. The row stays locked until
+        the surrounding transaction ends, which should therefore be short.
+        """
+        with transaction.atomic():
+            ZettleCard.objects.filter(pk=self.pk).update(
+                votes=F("votes") + delta, updated_at=timezone.now()
+            )
+            self.refresh_from_db(fields=["votes", "updated_at"])
+            self.hot_score = hot_score(self.votes, self.created_at)
+            ZettleCard.objects.filter(pk=self.pk).update(hot_score=self.hot_score)
+        invalidate_cards([self.uuid])
+        self._snapshot_loaded_values(["hot_score"])
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        """Leave stale bulk-maintained columns out of a full save's UPDATE.
+
+        Saves naming ``update_fields`` write exactly those columns. A full save
+        keeps its usual semantics, but the columns in ``BULK_MAINTAINED_FIELDS``
+        may be stale in memory, so they're only written when changed on purpose.
+        """
+        if update_fields is None:
+            values = [
+                value
+                for value in values
+                if value[0].attname not in BULK_MAINTAINED_FIELDS
+                or self.has_changed(value[0].attname)
+            ]
+        return super()._do_update(
+            base_qs, using, pk_val, values, update_fields, forced_update
+        )
+
+    def check_parent(self, parent_id, path=None):
+        """Raise ValidationError if ``parent_id`` would put this card in a cycle.
+
+        Also raised if the paths of the card and its descendants would grow
+        longer than the column holds under the new parent. ``path`` is this
+        card's stored path, by default as last loaded.
+        """
+        if parent_id is None:
+            return
+        if parent_id == self.pk:
+            raise ValidationError({"parent": "A card cannot be its own parent."})
+        if path is None:
+            path = self.get_loaded_value("path") if self.pk is not None else ""
+        parent_path = (
+            ZettleCard.objects.filter(pk=parent_id)
+            .values_list("path", flat=True)
+            .first()
+        ) or ""
+        if path and parent_path.startswith(path):
+            raise ValidationError(
+                {"parent": "A card cannot be moved under its own descendant."}
+            )
+
+        if self.pk is None:
+            subtree = NEW_ID_LENGTH + 1
+        else:
+            subtree = len(f"{self.pk}/")
+            if path:
+                longest = ZettleCard.objects.filter(**path_range(path)).aggregate(
+                    longest=Max(Length("path"))
+                )["longest"]
+                subtree += (longest or len(path)) - len(path)
+        if len(parent_path) + subtree > PATH_LENGTH:
+            raise ValidationError(
+                {"parent": "The tree would nest too deeply under this parent."}
+            )
+
+    def clean(self):
+        super().clean()
+        self.check_parent(self.parent_id)
+
+    def get_ancestors(self):
+        """Ancestors from the root down to the parent, in one query."""
+        ancestor_ids = [int(pk) for pk in self.path.split("/")[:-2]]
+        return ZettleCard.objects.filter(pk__in=ancestor_ids).order_by("depth")
+
+    def get_descendants(self):
+        return ZettleCard.objects.filter(**path_range(self.path)).exclude(pk=self.pk)
+
+    def is_descendant_of(self, other):
+        return self.pk != other.pk and self.path.startswith(other.path)
+
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        super().refresh_from_db(using, fields, from_queryset)
+        self._snapshot_loaded_values(fields)
+
+    def _snapshot_loaded_values(self, fields=None):
+        deferred_fields = self.get_deferred_fields()
+        loaded_values = getattr(self, "_loaded_values", {})
+        for field in self._meta.concrete_fields:
+            if field.attname in deferred_fields:
+                continue
+            if fields is None or field.attname in fields or field.name in fields:
+                loaded_values[field.attname] = getattr(self, field.attname)
+        self._loaded_values = loaded_values
 
     @property
     def template_name(self):
@@ -109,6 +372,19 @@ class ZettleCard(BaseModel):
             models.Index(fields=["card_type"]),
             models.Index(fields=["slug"]),
             models.Index(fields=["content_type", "object_id"]),
+            models.Index(fields=["grid_x", "grid_y"]),
+            models.Index(fields=["path"]),
+            models.Index(fields=["sequence_id", "sequence_key"]),
+            models.Index(fields=["reply_to", "-hot_score", "-id"]),
+            models.Index(fields=["reply_to", "-votes", "-id"]),
+            models.Index(fields=["reply_to", "-created_at", "-id"]),
+            models.Index(fields=["created_at", "id"]),
+            models.Index(fields=["updated_at", "id"]),
+            models.Index(fields=["votes", "id"]),
+            models.Index(fields=["title", "id"]),
+            models.Index(fields=["child_count", "id"]),
+            models.Index(fields=["reply_count", "id"]),
+            models.Index(fields=["tag_count", "id"]),
         ]
 
         verbose_name = "Zettle Card"
@@ -117,3 +393,96 @@ class ZettleCard(BaseModel):
 
     def __str__(self):
         return f"{self.title or 'Untitled'} ({self.get_card_type_display()})"
+
+
+class ZettleTile(models.Model):
+    """Pre-aggregated cluster of the cards inside one tile of a zoomed-out level."""
+
+    level = models.PositiveSmallIntegerField()
+    tile_x = models.IntegerField()
+    tile_y = models.IntegerField()
+    card_count = models.PositiveIntegerField(default=0)
+    sum_x = models.BigIntegerField(default=0)
+    sum_y = models.BigIntegerField(default=0)
+    type_counts = models.JSONField(default=dict)
+    top_cards = models.JSONField(default=list)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["level", "tile_x", "tile_y"], name="unique_zettle_tile"
+            ),
+        ]
+
+    def __str__(self):
+        return f"Tile {self.tile_x},{self.tile_y} @ level {self.level}"
+
+
+class Vote(models.Model):
+    """One user's vote on a card; the card's ``votes`` is the sum of these."""
+
+    class Value(models.IntegerChoices):
+        UP = 1, "Upvote"
+        DOWN = -1, "Downvote"
+
+    card = models.ForeignKey(
+        ZettleCard, related_name="vote_set", on_delete=models.CASCADE
+    )
+    user = models.ForeignKey(
+        "users.User", related_name="votes", on_delete=models.CASCADE
+    )
+    value = models.SmallIntegerField(choices=Value.choices, default=Value.UP)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["card", "user"], name="unique_card_vote"),
+        ]
+
+    def __str__(self):
+        return f"{self.user} {self.get_value_display().lower()}d {self.card}"
+
+
+class CardTombstone(models.Model):
+    """Record of a deleted card, so syncing clients can evict it."""
+
+    uuid = models.UUIDField()
+    deleted_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"Card {self.uuid} deleted at {self.deleted_at}"
+
+
+class Blob(models.Model):
+    """A stored file, shared by every card whose image or document has its content."""
+
+    sha256 = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=1023)
+    size = models.BigIntegerField()
+    # Card fields pointing at the file; unreferenced blobs are collected.
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+    # When the last reference went away, or the blob was stored without one.
+    unreferenced_since = models.DateTimeField(null=True, default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=["ref_count", "unreferenced_since"])]
+
+    def __str__(self):
+        return f"{self.name} ({self.ref_count} references)"
+
+
+class UploadSession(BaseModel):
+    """A resumable upload, received in chunks into a partial file."""
+
+    user = models.ForeignKey(
+        "users.User", related_name="upload_sessions", on_delete=models.CASCADE
+    )
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    # Checked against the received file when given.
+    sha256 = models.CharField(max_length=64, blank=True)
+
+    def __str__(self):
+        return f"Upload of {self.filename} ({self.offset}/{self.size} bytes)"
@@ -0,0 +1,182 @@
+import base64
+import json
+
+from django.core.exceptions import ValidationError
+from django.core.paginator import InvalidPage
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.filters import OrderingFilter
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+# Orderings the keyset paginator can seek on. Each one is broken by id, and
+# has a matching (field, id) index.
+KEYSET_FIELDS = [
+    "created_at",
+    "updated_at",
+    "votes",
+    "title",
+    "child_count",
+    "reply_count",
+    "tag_count",
+]
+DATETIME_FIELDS = {"created_at", "updated_at"}
+
+
+class KeysetPagination(BasePagination):
+    """Forward-only pagination that seeks past the last ``(field, id)`` seen.
+
+    Unlike page numbers, no count is taken and no rows are skipped, so every
+    page costs the same however deep it is. The sort field comes from the
+    request's ``ordering`` (first term) and defaults to ``-created_at``.
+    """
+
+    cursor_query_param = "cursor"
+    page_size = api_settings.PAGE_SIZE
+    default_ordering = "-created_at"
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.set_page(list(self.page_queryset(queryset, request)))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """``paginate_queryset`` for async views."""
+        queryset = self.page_queryset(queryset, request)
+        chunk_size = self.page_size + 1
+        return self.set_page([card async for card in queryset.aiterator(chunk_size)])
+
+    def page_queryset(self, queryset, request):
+        """The rows of the requested page, plus one to tell if there's another."""
+        self.request = request
+        self.ordering = self.get_ordering(request)
+        field = self.ordering.lstrip("-")
+        descending = self.ordering.startswith("-")
+        prefix = "-" if descending else ""
+        queryset = queryset.order_by(f"{prefix}{field}", f"{prefix}id")
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            value, pk = self.decode_cursor(cursor, queryset.model, field)
+            lookup = "lt" if descending else "gt"
+            # The bound alone lets the database seek into the (field, id)
+            # index; the OR on its own would scan it from the start.
+            queryset = queryset.filter(
+                Q(**{f"{field}__{lookup[0]}te": value}),
+                Q(**{f"{field}__{lookup}": value})
+                | Q(**{field: value, f"id__{lookup}": pk}),
+            )
+
+        return queryset[: self.page_size + 1]
+
+    def set_page(self, page):
+        self.has_next = len(page) > self.page_size
+        self.page = page[: self.page_size]
+        return self.page
+
+    def get_ordering(self, request):
+        params = request.query_params.get(OrderingFilter.ordering_param, "")
+        ordering = params.split(",")[0].strip()
+        if ordering.lstrip("-") in KEYSET_FIELDS:
+            return ordering
+        return self.default_ordering
+
+    def encode_cursor(self, card):
+        """Cursor past ``card``, a model instance or a ``values()`` row."""
+        field = self.ordering.lstrip("-")
+        if isinstance(card, dict):
+            value, pk = card[field], card["id"]
+        else:
+            value, pk = getattr(card, field), card.pk
+        if field in DATETIME_FIELDS:
+            value = value.isoformat()
+        payload = json.dumps([value, pk]).encode()
+        return base64.urlsafe_b64encode(payload).decode()
+
+    def decode_cursor(self, cursor, model, field):
+        """The ``(value, id)`` of a cursor, converted to the types of ``model``."""
+        try:
+            value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            model_field = model._meta.get_field(field)
+            value = model_field.to_python(value)
+            model_field.run_validators(value)
+            if value is None or not isinstance(pk, int):
+                raise ValueError
+        except (TypeError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        return value, pk
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(
+            url, self.cursor_query_param, self.encode_cursor(self.page[-1])
+        )
+
+    def get_paginated_response(self, data):
+        return Response({"next": self.get_next_link(), "results": data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "required": ["results"],
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
+
+
+class CardPagination(PageNumberPagination):
+    """Page numbers by default, keyset pagination for requests with ``?cursor=``.
+
+    Clients opt in per request by passing an empty ``cursor`` for the first
+    page and following ``next`` from there.
+    """
+
+    keyset_class = KeysetPagination
+    page_size_query_param = "page_size"
+    max_page_size = 10_000
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if self.keyset_class.cursor_query_param in request.query_params:
+            self.keyset = self.keyset_class()
+            self.keyset.page_size = self.get_page_size(request)
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """``paginate_queryset`` for async views, counting with ``acount()``."""
+        self.keyset = None
+        if self.keyset_class.cursor_query_param in request.query_params:
+            self.keyset = self.keyset_class()
+            self.keyset.page_size = self.get_page_size(request)
+            return await self.keyset.apaginate_queryset(queryset, request, view)
+
+        page_size = self.get_page_size(request)
+        paginator = self.django_paginator_class(queryset, page_size)
+        # Set the cached count, which the paginator would otherwise take
+        # synchronously.
+        paginator.count = await queryset.acount()
+        page_number = self.get_page_number(request, paginator)
+        try:
+            self.page = paginator.page(page_number)
+        except InvalidPage as exc:
+            raise NotFound(
+                self.invalid_page_message.format(
+                    page_number=page_number, message=str(exc)
+                )
+            )
+        self.page.object_list = [
+            card async for card in self.page.object_list.aiterator(page_size)
+        ]
+        self.request = request
+        return list(self.page)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
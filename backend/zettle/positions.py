@@ -0,0 +1,114 @@
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from backend.zettle.card_cache import invalidate_cards
+from backend.zettle.clusters import STATE_FIELDS, card_state, update_tiles
+from backend.zettle.models import ZettleCard
+from backend.zettle.realtime import card_payload, publish_cards, region_of
+from backend.zettle.spatial import check_coordinate, grid_cell, grid_cell_expression
+
+# Most cards a single bulk move may touch.
+MAX_MOVED_CARDS = 5000
+
+MOVED_FIELDS = ["x", "y", "grid_x", "grid_y", "updated_at"]
+
+
+@transaction.atomic
+def move_cards(positions: dict) -> list[ZettleCard]:
+    """Move cards to new ``(x, y)`` positions, keyed by uuid, in a bulk update.
+
+    Only the position columns are written, no save() or per-card signals
+    run, and the cluster tiles are updated once for the whole batch. The
+    moves are broadcast to the canvas regions the cards left and entered.
+    Returns the cards with their new positions, raising ValueError if any is
+    unknown or would leave the range of the position columns.
+
+    The update is a single statement on PostgreSQL. SQLite caps the
+    parameters of a statement, so there it is split into batches of a few
+    hundred cards.
+    """
+    cards = _lock_cards(positions)
+    _apply_moves(
+        cards,
+        lambda card: positions[card.uuid],
+        lambda moved: ZettleCard.objects.bulk_update(moved, MOVED_FIELDS),
+    )
+    return cards
+
+
+@transaction.atomic
+def shift_cards(uuids, dx: int, dy: int) -> list[ZettleCard]:
+    """Move the cards with ``uuids`` by ``(dx, dy)`` in a single UPDATE.
+
+    The new positions are computed by the database, so the statement is the
+    same however many cards move. Cards without a position stay unplaced.
+    Otherwise as ``move_cards``.
+    """
+
+    def shift(card):
+        if card.x is None or card.y is None:
+            return None
+        return card.x + dx, card.y + dy
+
+    def write(moved):
+        ZettleCard.objects.filter(pk__in=[card.pk for card in moved]).update(
+            x=F("x") + dx,
+            y=F("y") + dy,
+            grid_x=grid_cell_expression(F("x") + dx),
+            grid_y=grid_cell_expression(F("y") + dy),
+            updated_at=moved[0].updated_at,
+        )
+
+    cards = _lock_cards(uuids)
+    _apply_moves(cards, shift, write)
+    return cards
+
+
+def _lock_cards(uuids) -> list[ZettleCard]:
+    """Lock the cards with ``uuids``, raising ValueError if any is unknown."""
+    cards = list(
+        ZettleCard.objects.select_for_update()
+        .filter(uuid__in=uuids)
+        .only("pk", *STATE_FIELDS)
+        .order_by("pk")
+    )
+    missing = set(uuids) - {card.uuid for card in cards}
+    if missing:
+        raise ValueError(f"Unknown cards: {', '.join(sorted(map(str, missing)))}.")
+    return cards
+
+
+def _apply_moves(cards, position_of, write):
+    """Set the new positions of ``cards``, write them and account for the moves.
+
+    ``position_of`` gives a card's new ``(x, y)``, or None to leave it, and
+    ``write`` is called with the cards that moved, if any, to update their
+    rows. The tiles, cached cards and canvas broadcasts then follow.
+    """
+    now = timezone.now()
+    moved, removed, added, events = [], [], [], []
+    for card in cards:
+        position = position_of(card)
+        if position is None or position == (card.x, card.y):
+            continue
+        x, y = map(check_coordinate, position)
+        removed.append(card_state(card))
+        old_region = region_of(card.x, card.y)
+        card.x, card.y = x, y
+        card.grid_x, card.grid_y = grid_cell(card.x, card.y)
+        card.updated_at = now
+        added.append(card_state(card))
+        moved.append(card)
+        events.append(
+            (
+                card_payload(card, ["x", "y"]),
+                [old_region, region_of(card.x, card.y)],
+            )
+        )
+
+    if moved:
+        write(moved)
+    invalidate_cards(card.uuid for card in moved)
+    update_tiles(removed, added)
+    publish_cards("card.moved", events)
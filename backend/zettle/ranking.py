@@ -0,0 +1,15 @@
+from datetime import datetime
+from math import log10
+
+# Reddit's "hot" ranking: every factor of ten in votes is worth as much as
+# HOT_GRAVITY seconds of recency. Scores only depend on a card's own votes and
+# creation time, so they can be stored and indexed.
+HOT_EPOCH = 1134028003
+HOT_GRAVITY = 45000
+
+
+def hot_score(votes: int, created_at: datetime) -> float:
+    order = log10(max(abs(votes), 1))
+    sign = 1 if votes > 0 else -1 if votes < 0 else 0
+    seconds = created_at.timestamp() - HOT_EPOCH
+    return round(sign * order + seconds / HOT_GRAVITY, 7)
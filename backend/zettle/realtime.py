@@ -0,0 +1,240 @@
+import asyncio
+import json
+import threading
+from abc import ABC, abstractmethod
+from functools import cache
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+try:
+    import redis
+    import redis.asyncio
+except ImportError:  # pragma: no cover - only needed for RedisBroker
+    redis = None
+
+DEFAULT_BACKEND = "backend.zettle.realtime.LocalBroker"
+
+# Canvas regions are squares of this many units, one channel each. A client
+# subscribes to the regions its viewport overlaps.
+REGION_SIZE = 4096
+
+# Most regions one connection may watch. Zoomed-out views should poll the
+# clusters endpoint instead.
+MAX_REGIONS = 64
+
+# Messages queued for a connection before newer ones are dropped, so a slow
+# client can't hold a worker's memory.
+MAX_PENDING_MESSAGES = 1000
+
+# How long an idle Redis subscription waits before checking for channels.
+IDLE_POLL_INTERVAL = 0.05
+
+# Fields sent for created and updated cards, enough to draw them.
+EVENT_FIELDS = ["uuid", "card_type", "title", "x", "y"]
+
+
+def region_of(x, y):
+    """The channel of the region holding ``(x, y)``, or None if unplaced."""
+    if x is None or y is None:
+        return None
+    return f"canvas.{int(x) // REGION_SIZE}.{int(y) // REGION_SIZE}"
+
+
+def regions_in(bbox) -> set:
+    """The channels of every region a ``(minx, miny, maxx, maxy)`` box overlaps."""
+    min_x, min_y, max_x, max_y = (int(value) // REGION_SIZE for value in bbox)
+    count = (max_x - min_x + 1) * (max_y - min_y + 1)
+    if count > MAX_REGIONS:
+        raise ValueError(f"bbox covers {count} regions, at most {MAX_REGIONS}.")
+    return {
+        f"canvas.{x}.{y}"
+        for x in range(min_x, max_x + 1)
+        for y in range(min_y, max_y + 1)
+    }
+
+
+class Subscription(ABC):
+    """Messages from a set of channels, read with ``async for``."""
+
+    @abstractmethod
+    async def update(self, channels):
+        """Receive messages from ``channels`` only, from now on."""
+
+    @abstractmethod
+    async def close(self):
+        pass
+
+    def __aiter__(self):
+        return self
+
+    @abstractmethod
+    async def __anext__(self) -> dict:
+        pass
+
+
+class Broker(ABC):
+    """Carries card events to the connections watching their regions.
+
+    ``publish`` may be called from sync code, such as signal handlers, and
+    ``subscribe`` from the event loop serving the connections.
+    """
+
+    @abstractmethod
+    def publish(self, channel, message: dict):
+        pass
+
+    @abstractmethod
+    def subscribe(self) -> Subscription:
+        pass
+
+
+class LocalSubscription(Subscription):
+    def __init__(self, broker):
+        self.broker = broker
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.channels = set()
+
+    async def update(self, channels):
+        self.broker.move(self, self.channels, set(channels))
+        self.channels = set(channels)
+
+    async def close(self):
+        await self.update(())
+
+    def deliver(self, message):
+        # Publishers may run on other threads than the subscriber's loop.
+        try:
+            self.loop.call_soon_threadsafe(self._put, message)
+        except RuntimeError:
+            pass  # The loop has closed.
+
+    def _put(self, message):
+        if self.queue.qsize() < MAX_PENDING_MESSAGES:
+            self.queue.put_nowait(message)
+
+    async def __anext__(self):
+        return await self.queue.get()
+
+
+class LocalBroker(Broker):
+    """Delivers messages to subscribers in this process only.
+
+    Enough for a single ASGI worker, and for tests. Several workers need a
+    shared broker, such as ``RedisBroker``.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}
+
+    def publish(self, channel, message):
+        with self.lock:
+            subscribers = list(self.subscribers.get(channel, ()))
+        for subscription in subscribers:
+            subscription.deliver(message)
+
+    def subscribe(self):
+        return LocalSubscription(self)
+
+    def move(self, subscription, old_channels, new_channels):
+        with self.lock:
+            for channel in old_channels - new_channels:
+                subscribers = self.subscribers.get(channel, set())
+                subscribers.discard(subscription)
+                if not subscribers:
+                    self.subscribers.pop(channel, None)
+            for channel in new_channels - old_channels:
+                self.subscribers.setdefault(channel, set()).add(subscription)
+
+
+class RedisSubscription(Subscription):
+    def __init__(self, client):
+        self.pubsub = client.pubsub(ignore_subscribe_messages=True)
+        self.channels = set()
+
+    async def update(self, channels):
+        channels = set(channels)
+        if self.channels - channels:
+            await self.pubsub.unsubscribe(*(self.channels - channels))
+        if channels - self.channels:
+            await self.pubsub.subscribe(*(channels - self.channels))
+        self.channels = channels
+
+    async def close(self):
+        await self.pubsub.aclose()
+
+    async def __anext__(self):
+        while True:
+            if not self.channels:
+                # Reading an unsubscribed pubsub fails, so wait for channels.
+                await asyncio.sleep(IDLE_POLL_INTERVAL)
+                continue
+            message = await self.pubsub.get_message(timeout=None)
+            if message is not None:
+                return json.loads(message["data"])
+
+
+class RedisBroker(Broker):
+    """Shares messages between workers through Redis pub/sub.
+
+    Needs the ``redis`` package. Configure it with::
+
+        ZETTLE_REALTIME_BROKER = {
+            "BACKEND": "backend.zettle.realtime.RedisBroker",
+            "OPTIONS": {"url": "redis://localhost:6379/0"},
+        }
+    """
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError("RedisBroker needs the redis package.")
+        self.url = url
+        self.client = redis.Redis.from_url(url)
+
+    def publish(self, channel, message):
+        self.client.publish(channel, json.dumps(message, default=str))
+
+    def subscribe(self):
+        # One connection per subscriber, on the subscriber's own loop.
+        return RedisSubscription(redis.asyncio.Redis.from_url(self.url))
+
+
+@cache
+def get_broker() -> Broker:
+    """The broker configured by ``ZETTLE_REALTIME_BROKER``, in-process by default.
+
+    The setting is a dict with the ``BACKEND`` class path and its ``OPTIONS``.
+    """
+    config = getattr(settings, "ZETTLE_REALTIME_BROKER", {})
+    backend = import_string(config.get("BACKEND", DEFAULT_BACKEND))
+    return backend(**config.get("OPTIONS", {}))
+
+
+def card_payload(card, fields=EVENT_FIELDS) -> dict:
+    payload = {name: getattr(card, name) for name in fields}
+    payload["uuid"] = str(card.uuid)
+    return payload
+
+
+def publish_cards(event, cards):
+    """Send ``event`` to the regions of ``cards`` once the change commits.
+
+    ``cards`` holds ``(payload, regions)`` pairs. A moved card is sent to the
+    region it left as well as the one it's in, so viewers of either see it.
+    """
+    by_region = {}
+    for payload, regions in cards:
+        for region in set(regions) - {None}:
+            by_region.setdefault(region, []).append(payload)
+    if not by_region:
+        return
+
+    def send():
+        broker = get_broker()
+        for region, region_cards in by_region.items():
+            broker.publish(region, {"type": event, "cards": region_cards})
+
+    transaction.on_commit(send)
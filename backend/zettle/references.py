@@ -0,0 +1,79 @@
+from asgiref.sync import sync_to_async
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import aprefetch_related_objects, prefetch_related_objects
+
+# Longest label kept in a reference summary.
+MAX_LABEL_LENGTH = 255
+
+# The models cards may point to, as ``app_label.model``. Anything else, such
+# as votes, admin log entries or permissions, isn't theirs to show.
+REFERENCEABLE_MODELS = {"zettle.zettlecard", "users.user"}
+
+
+def is_referenceable(content_type) -> bool:
+    return f"{content_type.app_label}.{content_type.model}" in REFERENCEABLE_MODELS
+
+
+def _referencing(cards):
+    """The cards pointing to an object of a referenceable model."""
+    return [
+        card
+        for card in cards
+        if card.content_type_id is not None
+        and is_referenceable(ContentType.objects.get_for_id(card.content_type_id))
+    ]
+
+
+def resolve_references(cards):
+    """Load the objects model cards point to, one ``IN`` query per content type.
+
+    Cards are grouped by ``content_type`` and each target model is read in a
+    single query, after which ``card.content_object`` is served from the
+    cache. Content types come from ContentType's own cache.
+    """
+    prefetch_related_objects(_referencing(cards), "content_object")
+
+
+async def aresolve_references(cards):
+    """``resolve_references`` for async views.
+
+    Content types missing from ContentType's cache are loaded with a sync
+    query, so the cards are picked out in a sync thread.
+    """
+    cards = await sync_to_async(_referencing)(cards)
+    await aprefetch_related_objects(cards, "content_object")
+
+
+def summarize_reference(card) -> dict | None:
+    """A compact description of the object a card points to.
+
+    None when the card points to nothing, to an object since deleted, or to
+    a model cards may not point to.
+    """
+    if card.content_type_id is None or card.object_id is None:
+        return None
+    content_type = ContentType.objects.get_for_id(card.content_type_id)
+    if not is_referenceable(content_type):
+        return None
+    target = card.content_object
+    if target is None:
+        return None
+    return {
+        "type": f"{content_type.app_label}.{content_type.model}",
+        "id": target.pk,
+        "label": str(target)[:MAX_LABEL_LENGTH],
+    }
+
+
+def parse_reference(value):
+    """The content type and object id of an ``app_label.model:id`` reference."""
+    label, _, object_id = value.partition(":")
+    app_label, _, model = label.lower().partition(".")
+    try:
+        object_id = int(object_id)
+        content_type = ContentType.objects.get_by_natural_key(app_label, model)
+    except (ValueError, ContentType.DoesNotExist):
+        raise ValueError("Expected app_label.model:id, e.g. users.user:3.")
+    if not is_referenceable(content_type):
+        raise ValueError(f"Cards can't point to {label.lower()}.")
+    return content_type, object_id
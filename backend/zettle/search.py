@@ -0,0 +1,321 @@
+import re
+from abc import ABC, abstractmethod
+from functools import cache
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils.html import escape
+from django.utils.module_loading import import_string
+
+from backend.zettle.models import ZettleCard
+
+# Ranked ids fetched for a search on the card list. Results past this are
+# dropped rather than ranking every match of a very common term.
+SEARCH_LIMIT = 1000
+
+# How strongly votes lift a result when ranking with ``rank=votes``.
+VOTE_WEIGHT = 0.5
+
+# Words shown in a snippet of the fallback backend.
+SNIPPET_WORDS = 16
+
+# Snippet highlight markers, swapped for <mark> tags once the text is escaped.
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+
+WORD_RE = re.compile(r"\w+")
+
+CARD_TABLE = "zettle_zettlecard"
+TAGS_TABLE = "zettle_zettlecard_tags"
+
+
+def search_words(query: str) -> list[str]:
+    return WORD_RE.findall(query.lower())
+
+
+def highlight(snippet: str) -> str:
+    return escape(snippet).replace(MATCH_START, "<mark>").replace(MATCH_END, "</mark>")
+
+
+class SearchBackend(ABC):
+    """Full-text index over card titles, text and tag titles."""
+
+    @abstractmethod
+    def index(self, card_ids):
+        """(Re)index the given cards from their current database rows."""
+
+    @abstractmethod
+    def remove(self, card_ids):
+        pass
+
+    @abstractmethod
+    def search(self, query, limit, by_votes=False):
+        """Return ``(card_id, score, snippet)`` tuples, best match first."""
+
+    @abstractmethod
+    def rebuild(self):
+        pass
+
+    def _documents(self, cursor, card_ids):
+        placeholders = ", ".join(["%s"] * len(card_ids))
+        cursor.execute(
+            f"""
+            SELECT ct.from_zettlecard_id, t.title FROM {TAGS_TABLE} ct
+            JOIN {CARD_TABLE} t ON t.id = ct.to_zettlecard_id
+            WHERE ct.from_zettlecard_id IN ({placeholders})
+            """,
+            card_ids,
+        )
+        tags = {}
+        for card_id, title in cursor.fetchall():
+            tags.setdefault(card_id, []).append(title)
+        cursor.execute(
+            f"SELECT id, title, text FROM {CARD_TABLE} WHERE id IN ({placeholders})",
+            card_ids,
+        )
+        return [
+            (card_id, title, text, " ".join(tags.get(card_id, [])))
+            for card_id, title, text in cursor.fetchall()
+        ]
+
+
+class SQLiteSearchBackend(SearchBackend):
+    """FTS5 virtual table whose rowid is the card id."""
+
+    table = "zettle_search"
+
+    def index(self, card_ids):
+        card_ids = list(card_ids)
+        if not card_ids:
+            return
+        with connection.cursor() as cursor:
+            self._delete(cursor, card_ids)
+            cursor.executemany(
+                f"INSERT INTO {self.table} (rowid, title, text, tags) "
+                "VALUES (%s, %s, %s, %s)",
+                self._documents(cursor, card_ids),
+            )
+
+    def remove(self, card_ids):
+        card_ids = list(card_ids)
+        if card_ids:
+            with connection.cursor() as cursor:
+                self._delete(cursor, card_ids)
+
+    def _delete(self, cursor, card_ids):
+        cursor.execute(
+            f"DELETE FROM {self.table} WHERE rowid IN "
+            f"({', '.join(['%s'] * len(card_ids))})",
+            card_ids,
+        )
+
+    def match_expression(self, query):
+        return " ".join(f'"{word}"*' for word in search_words(query))
+
+    def search(self, query, limit, by_votes=False):
+        match = self.match_expression(query)
+        if not match:
+            return []
+        # bm25() is lower-is-better; title matches weigh most, then tags.
+        score = f"bm25({self.table}, 10.0, 1.0, 5.0)"
+        if by_votes:
+            score = f"{score} - %s * LN(1 + MAX(c.votes, 0))"
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT s.rowid, {score} AS score,
+                    snippet({self.table}, -1, %s, %s, '…', 16)
+                FROM {self.table} s
+                JOIN {CARD_TABLE} c ON c.id = s.rowid
+                WHERE {self.table} MATCH %s
+                ORDER BY score
+                LIMIT %s
+                """,
+                [
+                    *([VOTE_WEIGHT] if by_votes else []),
+                    MATCH_START,
+                    MATCH_END,
+                    match,
+                    limit,
+                ],
+            )
+            return [
+                (card_id, -score, highlight(snippet))
+                for card_id, score, snippet in cursor.fetchall()
+            ]
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table}")
+            cursor.execute(
+                f"""
+                INSERT INTO {self.table} (rowid, title, text, tags)
+                SELECT c.id, c.title, c.text, COALESCE((
+                    SELECT group_concat(t.title, ' ') FROM {TAGS_TABLE} ct
+                    JOIN {CARD_TABLE} t ON t.id = ct.to_zettlecard_id
+                    WHERE ct.from_zettlecard_id = c.id
+                ), '')
+                FROM {CARD_TABLE} c
+                """
+            )
+            return cursor.rowcount
+
+
+class PostgresSearchBackend(SearchBackend):
+    """Weighted tsvector per card in a side table with a GIN index."""
+
+    table = "zettle_search"
+    config = "simple"
+
+    def _vector_sql(self, title, text, tags):
+        return (
+            f"setweight(to_tsvector('{self.config}', {title}), 'A') || "
+            f"setweight(to_tsvector('{self.config}', {tags}), 'B') || "
+            f"setweight(to_tsvector('{self.config}', {text}), 'C')"
+        )
+
+    def index(self, card_ids):
+        card_ids = list(card_ids)
+        if not card_ids:
+            return
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"""
+                INSERT INTO {self.table} (card_id, document)
+                VALUES (%s, {self._vector_sql("%s", "%s", "%s")})
+                ON CONFLICT (card_id) DO UPDATE SET document = EXCLUDED.document
+                """,
+                self._documents(cursor, card_ids),
+            )
+
+    def remove(self, card_ids):
+        card_ids = list(card_ids)
+        if card_ids:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"DELETE FROM {self.table} WHERE card_id = ANY(%s)", [card_ids]
+                )
+
+    def tsquery(self, query):
+        return " & ".join(f"{word}:*" for word in search_words(query))
+
+    def search(self, query, limit, by_votes=False):
+        tsquery = self.tsquery(query)
+        if not tsquery:
+            return []
+        score = "ts_rank_cd(s.document, q)"
+        if by_votes:
+            score = f"{score} * (1 + %s * LN(1 + GREATEST(c.votes, 0)))"
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT ranked.card_id, ranked.score, ts_headline(
+                    '{self.config}', c.title || ' ' || c.text, ranked.q,
+                    %s
+                )
+                FROM (
+                    SELECT s.card_id, {score} AS score, q
+                    FROM {self.table} s
+                    JOIN {CARD_TABLE} c ON c.id = s.card_id,
+                        to_tsquery('{self.config}', %s) q
+                    WHERE s.document @@ q
+                    ORDER BY score DESC
+                    LIMIT %s
+                ) ranked
+                JOIN {CARD_TABLE} c ON c.id = ranked.card_id
+                ORDER BY ranked.score DESC
+                """,
+                [
+                    f"StartSel={MATCH_START}, StopSel={MATCH_END}, MaxWords=16",
+                    *([VOTE_WEIGHT] if by_votes else []),
+                    tsquery,
+                    limit,
+                ],
+            )
+            return [
+                (card_id, score, highlight(snippet))
+                for card_id, score, snippet in cursor.fetchall()
+            ]
+
+    def rebuild(self):
+        tags = f"""COALESCE((
+            SELECT string_agg(t.title, ' ') FROM {TAGS_TABLE} ct
+            JOIN {CARD_TABLE} t ON t.id = ct.to_zettlecard_id
+            WHERE ct.from_zettlecard_id = c.id
+        ), '')"""
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table}")
+            cursor.execute(
+                f"""
+                INSERT INTO {self.table} (card_id, document)
+                SELECT c.id, {self._vector_sql("c.title", "c.text", tags)}
+                FROM {CARD_TABLE} c
+                """
+            )
+            return cursor.rowcount
+
+
+class ContainsSearchBackend(SearchBackend):
+    """Case-insensitive substring matching, for databases without an index.
+
+    Nothing is indexed, so every search scans the cards. Results are the
+    newest matches, or the most voted with ``by_votes``, all scored 1.
+    """
+
+    def index(self, card_ids):
+        pass
+
+    def remove(self, card_ids):
+        pass
+
+    def search(self, query, limit, by_votes=False):
+        words = search_words(query)
+        if not words:
+            return []
+        cards = ZettleCard.objects.all()
+        for word in words:
+            cards = cards.filter(
+                Q(title__icontains=word)
+                | Q(text__icontains=word)
+                | Q(tags__title__icontains=word)
+            )
+        ordering = ["-votes", "-created_at"] if by_votes else ["-created_at"]
+        rows = cards.distinct().order_by(*ordering).values_list("pk", "title", "text")
+        return [
+            (card_id, 1.0, highlight(contains_snippet(f"{title} {text}", words)))
+            for card_id, title, text in rows[:limit]
+        ]
+
+    def rebuild(self):
+        return 0
+
+
+def contains_snippet(document: str, words) -> str:
+    """The start of ``document``, with the words holding a match marked."""
+    tokens = document.split()
+    marked = [
+        f"{MATCH_START}{token}{MATCH_END}"
+        if any(word in token.lower() for word in words)
+        else token
+        for token in tokens[:SNIPPET_WORDS]
+    ]
+    return " ".join(marked) + ("…" if len(tokens) > SNIPPET_WORDS else "")
+
+
+BACKENDS = {
+    "sqlite": SQLiteSearchBackend,
+    "postgresql": PostgresSearchBackend,
+}
+
+
+@cache
+def get_search_backend() -> SearchBackend:
+    """The backend named by ``ZETTLE_SEARCH_BACKEND``, or the one for the database.
+
+    Databases without a full-text backend fall back to ``ContainsSearchBackend``.
+    """
+    backend_path = getattr(settings, "ZETTLE_SEARCH_BACKEND", None)
+    if backend_path:
+        return import_string(backend_path)()
+    return BACKENDS.get(connection.vendor, ContainsSearchBackend)()
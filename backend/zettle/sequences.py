@@ -0,0 +1,263 @@
+from uuid import uuid4
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from backend.zettle.card_cache import invalidate_cards
+from backend.zettle.models import ZettleCard
+
+# Sort keys are strings over this alphabet, compared character by character.
+# Digits and lowercase letters sort the same under every database collation.
+KEY_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+# Longest key the column holds. Repeated appends, prepends or inserts at one
+# spot make keys a character longer every few cards, so a sequence whose new
+# keys would outgrow this is re-keyed evenly instead.
+MAX_KEY_LENGTH = ZettleCard._meta.get_field("sequence_key").max_length
+
+# Upper bound on the hops followed when walking a legacy ``next`` chain.
+MAX_CHAIN_LENGTH = 100_000
+
+
+def _midpoint(a: str, b: str | None) -> str:
+    # Neither key may end in the zero digit, which keeps room below every key.
+    if b is not None:
+        n = 0
+        while n < len(b) and (a[n] if n < len(a) else KEY_DIGITS[0]) == b[n]:
+            n += 1
+        if n > 0:
+            return b[:n] + _midpoint(a[n:], b[n:])
+    digit_a = KEY_DIGITS.index(a[0]) if a else 0
+    digit_b = KEY_DIGITS.index(b[0]) if b is not None else len(KEY_DIGITS)
+    if digit_b - digit_a > 1:
+        return KEY_DIGITS[(digit_a + digit_b) // 2]
+    if b is not None and len(b) > 1:
+        return b[:1]
+    return KEY_DIGITS[digit_a] + _midpoint(a[1:], None)
+
+
+def key_between(before: str | None, after: str | None) -> str:
+    """A sort key strictly between two keys, either of which may be open (None)."""
+    if before is not None and after is not None and before >= after:
+        raise ValueError(f"{before!r} does not sort before {after!r}")
+    return _midpoint(before or "", after)
+
+
+def keys_between(before: str | None, after: str | None, count: int) -> list[str]:
+    """``count`` ascending keys between two keys, kept as short as possible."""
+    if count <= 0:
+        return []
+    middle = key_between(before, after)
+    left = (count - 1) // 2
+    return [
+        *keys_between(before, middle, left),
+        middle,
+        *keys_between(middle, after, count - 1 - left),
+    ]
+
+
+def get_sequence(card: ZettleCard):
+    """The ordered cards of ``card``'s sequence, as one indexed query."""
+    if card.sequence_id is None:
+        return ZettleCard.objects.filter(pk=card.pk)
+    return ZettleCard.objects.filter(sequence_id=card.sequence_id).order_by(
+        "sequence_key"
+    )
+
+
+def _set_links(links):
+    """Point each card id in ``links`` at its new ``next`` id.
+
+    Every affected ``next`` is cleared first, so the new values never clash
+    with old ones on the one-to-one constraint.
+    """
+    now = timezone.now()
+    ZettleCard.objects.filter(pk__in=links).update(next=None)
+    ZettleCard.objects.bulk_update(
+        [
+            ZettleCard(pk=pk, next_id=next_id, updated_at=now)
+            for pk, next_id in links.items()
+        ],
+        ["next", "updated_at"],
+    )
+    invalidate_cards(card_ids=links)
+
+
+def _set_keys(keys, sequence_id):
+    now = timezone.now()
+    ZettleCard.objects.bulk_update(
+        [
+            ZettleCard(pk=pk, sequence_id=sequence_id, sequence_key=key, updated_at=now)
+            for pk, key in keys.items()
+        ],
+        ["sequence_id", "sequence_key", "updated_at"],
+    )
+    invalidate_cards(card_ids=keys)
+
+
+@transaction.atomic
+def place_cards(anchor: ZettleCard, cards, after=None, at_end=False):
+    """Insert or move ``cards`` into ``anchor``'s sequence, in the given order.
+
+    The cards are placed right after ``after`` (a card of the sequence), at
+    the start when ``after`` is None, or at the end with ``at_end``. Cards are
+    taken out of whatever sequence they were in, and the ``next`` links of
+    every sequence touched are kept consistent. The cost depends on the
+    number of cards placed, not on the length of the sequence, except on the
+    rare placements whose keys would grow too long, which re-key it all.
+    """
+    moving = {card.pk: card for card in cards}
+    if anchor.sequence_id is None:
+        anchor.sequence_id = uuid4()
+        anchor.sequence_key = key_between(None, None)
+        ZettleCard.objects.filter(pk=anchor.pk).update(
+            sequence_id=anchor.sequence_id,
+            sequence_key=anchor.sequence_key,
+            updated_at=timezone.now(),
+        )
+        invalidate_cards([anchor.uuid])
+    sequence = ZettleCard.objects.filter(sequence_id=anchor.sequence_id).exclude(
+        pk__in=moving
+    )
+    if at_end:
+        after = sequence.order_by("-sequence_key").first()
+    if after is not None and (
+        after.pk in moving or after.sequence_id != anchor.sequence_id
+    ):
+        raise ValueError("Cards must be placed after another card of the sequence")
+
+    # Close the gaps the moving cards leave behind.
+    links = {}
+    for prev in ZettleCard.objects.filter(next__in=moving).exclude(pk__in=moving):
+        successor, hops = prev.next_id, 0
+        while successor in moving and hops <= len(moving):
+            successor, hops = moving[successor].next_id, hops + 1
+        links[prev.pk] = None if successor in moving else successor
+
+    if after is None:
+        before = sequence.order_by("sequence_key").first()
+    else:
+        before = (
+            sequence.filter(sequence_key__gt=after.sequence_key)
+            .order_by("sequence_key")
+            .first()
+        )
+    ordered = list(moving)
+    keys = keys_between(
+        after.sequence_key if after else None,
+        before.sequence_key if before else None,
+        len(ordered),
+    )
+
+    new_keys = dict(zip(ordered, keys))
+    if max(map(len, keys)) > MAX_KEY_LENGTH:
+        members = list(sequence.order_by("sequence_key").values_list("pk", flat=True))
+        start = members.index(after.pk) + 1 if after is not None else 0
+        members[start:start] = ordered
+        new_keys = dict(zip(members, keys_between(None, None, len(members))))
+
+    if after is not None:
+        links[after.pk] = ordered[0]
+    for pk, next_pk in zip(ordered, [*ordered[1:], before.pk if before else None]):
+        links[pk] = next_pk
+    _set_links(links)
+    _set_keys(new_keys, anchor.sequence_id)
+
+
+@transaction.atomic
+def reorder_sequence(anchor: ZettleCard, cards):
+    """Rewrite the order of ``anchor``'s whole sequence to ``cards``."""
+    members = set(get_sequence(anchor).values_list("pk", flat=True))
+    ordered = [card.pk for card in cards]
+    if set(ordered) != members or len(ordered) != len(members):
+        raise ValueError("The new order must contain every card of the sequence")
+    anchor.sequence_id = anchor.sequence_id or uuid4()
+    _set_links(dict(zip(ordered, [*ordered[1:], None])))
+    _set_keys(
+        dict(zip(ordered, keys_between(None, None, len(ordered)))), anchor.sequence_id
+    )
+
+
+def sequence_position(card_id):
+    """The ``(sequence_id, sequence_key)`` stored for a card."""
+    return (
+        ZettleCard.objects.filter(pk=card_id)
+        .values_list("sequence_id", "sequence_key")
+        .first()
+    )
+
+
+def relink_after_delete(position):
+    """Bridge the gap a deleted card leaves in its sequence.
+
+    ``position`` is the card's ``sequence_position`` read before the delete.
+    The ``next`` of its predecessor is nulled by the database cascade; point
+    it at the closest surviving successor instead.
+    """
+    if position is None or position[0] is None:
+        return
+    sequence_id, sequence_key = position
+    sequence = ZettleCard.objects.filter(sequence_id=sequence_id)
+    prev = (
+        sequence.filter(sequence_key__lt=sequence_key, next=None)
+        .order_by("-sequence_key")
+        .first()
+    )
+    successor = (
+        sequence.filter(sequence_key__gt=sequence_key).order_by("sequence_key").first()
+    )
+    if (
+        prev is not None
+        and successor is not None
+        and not ZettleCard.objects.filter(next=successor).exists()
+    ):
+        ZettleCard.objects.filter(pk=prev.pk).update(next=successor)
+        invalidate_cards([prev.uuid])
+
+
+CHAIN_SQL = """
+    WITH RECURSIVE head(id, hops) AS (
+        SELECT id, 0 FROM zettle_zettlecard WHERE id = %s
+        UNION ALL
+        SELECT c.id, h.hops + 1 FROM zettle_zettlecard c
+        JOIN head h ON c.next_id = h.id
+        WHERE h.hops < %s
+    ),
+    chain(id, next_id, hops) AS (
+        SELECT id, next_id, 0 FROM zettle_zettlecard
+        WHERE id = (SELECT id FROM head ORDER BY hops DESC LIMIT 1)
+        UNION ALL
+        SELECT c.id, c.next_id, ch.hops + 1 FROM zettle_zettlecard c
+        JOIN chain ch ON c.id = ch.next_id
+        WHERE ch.hops < %s
+    )
+    SELECT id FROM chain ORDER BY hops
+"""
+
+
+def sync_chain(card_id, new_sequence=False):
+    """Re-key the ``next`` chain containing ``card_id`` after a legacy edit.
+
+    Clients that write ``next`` directly bypass the sort keys, so the whole
+    chain is walked (one recursive query) and re-keyed in order. The chain
+    keeps its head's sequence id unless ``new_sequence`` is set.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(CHAIN_SQL, [card_id, MAX_CHAIN_LENGTH, MAX_CHAIN_LENGTH])
+        chain = list(dict.fromkeys(pk for (pk,) in cursor.fetchall()))
+
+    if len(chain) == 1:
+        ZettleCard.objects.filter(pk=card_id).update(
+            sequence_id=None, sequence_key="", updated_at=timezone.now()
+        )
+        invalidate_cards(card_ids=[card_id])
+        return
+    sequence_id = None
+    if not new_sequence:
+        sequence_id = (
+            ZettleCard.objects.filter(pk=chain[0])
+            .values_list("sequence_id", flat=True)
+            .get()
+        )
+    sequence_id = sequence_id or uuid4()
+    _set_keys(dict(zip(chain, keys_between(None, None, len(chain)))), sequence_id)
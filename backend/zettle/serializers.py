@@ -1,38 +1,204 @@
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import models
 from rest_framework import serializers
 
-from backend.zettle.models import ZettleCard
+from backend.core.serializers import (
+    BatchedPrimaryKeyRelatedField,
+    TimedListSerializer,
+    TimedSerializerMixin,
+)
+from backend.zettle.models import Blob, UploadSession, ZettleCard
+from backend.zettle.positions import MAX_MOVED_CARDS
+from backend.zettle.references import (
+    is_referenceable,
+    resolve_references,
+    summarize_reference,
+)
+from backend.zettle.spatial import MAX_COORDINATE, MIN_COORDINATE
+from backend.zettle.thumbnails import srcset
+from backend.zettle.uploads import MAX_UPLOAD_SIZE
 
 
-class ZettleCardSerializer(serializers.ModelSerializer):
+def sparse_fields(query_params, available):
+    """The names in ``available`` kept by the ``?fields=`` and ``?omit=`` lists."""
+    kept = list(available)
+    if query_params.get("fields"):
+        requested = set(query_params["fields"].split(","))
+        kept = [name for name in kept if name in requested]
+    if query_params.get("omit"):
+        omitted = set(query_params["omit"].split(","))
+        kept = [name for name in kept if name not in omitted]
+    return kept
+
+
+class SparseFieldsMixin:
+    """Trim read responses to the request's ``?fields=`` / ``?omit=`` lists."""
+
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get("request")
+        if request is None or request.method not in ("GET", "HEAD"):
+            return fields
+        kept = sparse_fields(request.query_params, fields)
+        return {name: fields[name] for name in kept}
+
+
+class ZettleCardListSerializer(TimedListSerializer):
+    """Resolves the page's model references together before serializing it."""
+
+    def to_representation(self, data):
+        cards = list(data.all() if isinstance(data, models.Manager) else data)
+        if "reference" in self.child.fields:
+            resolve_references(cards)
+        return super().to_representation(cards)
+
+
+class ZettleCardSerializer(
+    TimedSerializerMixin, SparseFieldsMixin, serializers.ModelSerializer
+):
     author = serializers.PrimaryKeyRelatedField(
         read_only=True, default=serializers.CurrentUserDefault()
     )
-    tags = serializers.PrimaryKeyRelatedField(
+    tags = BatchedPrimaryKeyRelatedField(
         many=True, queryset=ZettleCard.objects.all(), required=False
     )
+    thumbnails = serializers.SerializerMethodField()
+    # What ``content_type`` and ``object_id`` point to, for model cards.
+    reference = serializers.SerializerMethodField()
+    # Already stored files, by SHA-256, instead of uploading them again.
+    image_blob = serializers.SlugRelatedField(
+        slug_field="sha256",
+        queryset=Blob.objects.all(),
+        write_only=True,
+        required=False,
+    )
+    document_blob = serializers.SlugRelatedField(
+        slug_field="sha256",
+        queryset=Blob.objects.all(),
+        write_only=True,
+        required=False,
+    )
 
     class Meta:
         model = ZettleCard
+        list_serializer_class = ZettleCardListSerializer
         fields = [
             "uuid",
             "card_type",
             "author",
             "title",
             "votes",
+            "hot_score",
             "text",
             "image",
+            "image_blob",
+            "thumbnails",
             "document",
+            "document_blob",
             "url",
             "content_type",
             "object_id",
+            "reference",
             "parent",
             "next",
             "reply_to",
             "tags",
+            "tag_count",
+            "child_count",
+            "reply_count",
+            "sequence_id",
+            "sequence_key",
             "slug",
             "x",
             "y",
             "created_at",
             "updated_at",
         ]
-        read_only_fields = ["uuid", "votes", "created_at", "updated_at"]
+        read_only_fields = [
+            "uuid",
+            "votes",
+            "hot_score",
+            "tag_count",
+            "child_count",
+            "reply_count",
+            "sequence_id",
+            "sequence_key",
+            "created_at",
+            "updated_at",
+        ]
+
+    def validate_parent(self, parent):
+        if parent is not None:
+            card = ZettleCard() if self.instance is None else self.instance
+            try:
+                card.check_parent(parent.pk)
+            except DjangoValidationError as e:
+                raise serializers.ValidationError(e.message_dict["parent"])
+        return parent
+
+    def validate_content_type(self, content_type):
+        if content_type is not None and not is_referenceable(content_type):
+            raise serializers.ValidationError(
+                f"Cards can't point to {content_type.app_label}.{content_type.model}."
+            )
+        return content_type
+
+    def validate(self, attrs):
+        for field in ["image", "document"]:
+            blob = attrs.pop(f"{field}_blob", None)
+            if blob is None:
+                continue
+            if attrs.get(field):
+                raise serializers.ValidationError(
+                    {f"{field}_blob": [f"Send either {field} or {field}_blob."]}
+                )
+            attrs[field] = blob.name
+        return attrs
+
+    def get_reference(self, card) -> dict | None:
+        """The referenced object's ``type``, ``id`` and ``label``."""
+        return summarize_reference(card)
+
+    def get_thumbnails(self, card) -> dict:
+        """A ``srcset`` of the image's resized copies for each format."""
+        request = self.context.get("request")
+        return {
+            format: srcset(request, names)
+            for format, names in card.thumbnails.items()
+            if names
+        }
+
+
+class CardPositionSerializer(serializers.Serializer):
+    uuid = serializers.UUIDField()
+    x = serializers.IntegerField(min_value=MIN_COORDINATE, max_value=MAX_COORDINATE)
+    y = serializers.IntegerField(min_value=MIN_COORDINATE, max_value=MAX_COORDINATE)
+
+
+class CardOffsetSerializer(serializers.Serializer):
+    uuids = serializers.ListField(
+        child=serializers.UUIDField(), allow_empty=False, max_length=MAX_MOVED_CARDS
+    )
+    # The widest shift that can land a card back on the canvas.
+    dx = serializers.IntegerField(
+        min_value=MIN_COORDINATE - MAX_COORDINATE,
+        max_value=MAX_COORDINATE - MIN_COORDINATE,
+    )
+    dy = serializers.IntegerField(
+        min_value=MIN_COORDINATE - MAX_COORDINATE,
+        max_value=MAX_COORDINATE - MIN_COORDINATE,
+    )
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    size = serializers.IntegerField(min_value=1, max_value=MAX_UPLOAD_SIZE)
+    sha256 = serializers.RegexField(r"^[0-9a-f]{64}$", required=False)
+    complete = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UploadSession
+        fields = ["uuid", "filename", "size", "offset", "sha256", "complete"]
+        read_only_fields = ["uuid", "offset"]
+
+    def get_complete(self, session) -> bool:
+        return session.offset == session.size
@@ -0,0 +1,358 @@
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from backend.zettle.blobs import BLOB_FIELDS, acquire_blobs, release_blobs
+from backend.zettle.card_cache import invalidate_cards
+from backend.zettle.clusters import card_state, update_tiles
+from backend.zettle.counters import LINK_COUNTERS, recount_links
+from backend.zettle.fragments import get_fragment_cache
+from backend.zettle.hierarchy import reroot_subtrees
+from backend.zettle.models import CardTombstone, ZettleCard
+from backend.zettle.realtime import (
+    EVENT_FIELDS,
+    card_payload,
+    publish_cards,
+    region_of,
+)
+from backend.zettle.search import get_search_backend
+from backend.zettle.sequences import (
+    relink_after_delete,
+    sequence_position,
+    sync_chain,
+)
+from backend.zettle.tags import count_added_tags, recount_tags
+from backend.zettle.thumbnails import delete_thumbnails, schedule_thumbnails
+
+
+@receiver(post_save, sender=ZettleCard)
+def update_tiles_on_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    old_state = None if created else card_state(instance, loaded=True)
+    new_state = card_state(instance)
+    if old_state != new_state:
+        update_tiles(removed=[old_state], added=[new_state])
+
+
+@receiver(post_delete, sender=ZettleCard)
+def update_tiles_on_delete(sender, instance, **kwargs):
+    update_tiles(removed=[card_state(instance, loaded=True)])
+
+
+@receiver(post_save, sender=ZettleCard)
+def update_search_on_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        get_search_backend().index([instance.pk])
+    elif instance.has_changed("title"):
+        # Cards tagged with this one index its title as a tag.
+        tagged_ids = instance.tags.values_list("pk", flat=True)
+        get_search_backend().index([instance.pk, *tagged_ids])
+    elif instance.has_changed("text"):
+        get_search_backend().index([instance.pk])
+
+
+@receiver(pre_delete, sender=ZettleCard)
+def collect_tagged_cards_on_delete(sender, instance, **kwargs):
+    instance._tagged_ids = list(instance.tags.values_list("pk", flat=True))
+
+
+@receiver(post_delete, sender=ZettleCard)
+def update_search_on_delete(sender, instance, **kwargs):
+    backend = get_search_backend()
+    backend.remove([instance.pk])
+    backend.index(getattr(instance, "_tagged_ids", []))
+
+
+@receiver(m2m_changed, sender=ZettleCard.tags.through)
+def update_search_on_tags_changed(sender, instance, action, pk_set, **kwargs):
+    if action == "pre_clear":
+        instance._tagged_ids = list(instance.tags.values_list("pk", flat=True))
+    elif action == "post_clear":
+        get_search_backend().index([instance.pk, *instance._tagged_ids])
+    elif action in ("post_add", "post_remove"):
+        # Tags are symmetrical, so both ends of each link changed.
+        get_search_backend().index([instance.pk, *pk_set])
+
+
+@receiver(m2m_changed, sender=ZettleCard.tags.through)
+def count_tags_on_tags_changed(sender, instance, action, pk_set, **kwargs):
+    # ``update_search_on_tags_changed`` collected the cleared tags.
+    if action == "post_add":
+        count_added_tags(instance.pk, pk_set)
+    elif action == "post_remove":
+        recount_tags([instance.pk, *pk_set])
+    elif action == "post_clear":
+        recount_tags([instance.pk, *instance._tagged_ids])
+    else:
+        return
+    instance.refresh_from_db(fields=["tag_count"])
+
+
+@receiver(post_delete, sender=ZettleCard)
+def count_tags_on_delete(sender, instance, **kwargs):
+    recount_tags(getattr(instance, "_tagged_ids", []))
+
+
+@receiver(post_save, sender=ZettleCard)
+def count_links_on_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    for counter, link in LINK_COUNTERS.items():
+        attname = f"{link}_id"
+        if created or instance.has_changed(attname):
+            old_id = None if created else instance.get_loaded_value(attname)
+            recount_links([old_id, getattr(instance, attname)], [counter])
+
+
+@receiver(pre_delete, sender=ZettleCard)
+def collect_linked_cards_on_delete(sender, instance, **kwargs):
+    # Links may have been rewritten in bulk, so the instance may be stale.
+    instance._linked_ids = (
+        ZettleCard.objects.filter(pk=instance.pk)
+        .values_list("parent_id", "reply_to_id")
+        .first()
+    )
+
+
+@receiver(post_delete, sender=ZettleCard)
+def count_links_on_delete(sender, instance, **kwargs):
+    recount_links(getattr(instance, "_linked_ids", None) or [])
+
+
+@receiver(pre_delete, sender=ZettleCard)
+def collect_children_on_delete(sender, instance, **kwargs):
+    instance._child_ids = list(instance.children.values_list("pk", flat=True))
+
+
+@receiver(post_delete, sender=ZettleCard)
+def reroot_children_on_delete(sender, instance, **kwargs):
+    reroot_subtrees(getattr(instance, "_child_ids", []))
+
+
+@receiver(post_save, sender=ZettleCard)
+def sync_sequence_on_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if not (instance.next_id if created else instance.has_changed("next_id")):
+        return
+    old_next_id = None if created else instance.get_loaded_value("next_id")
+    if old_next_id:
+        sync_chain(old_next_id, new_sequence=True)
+    sync_chain(instance.pk)
+    instance.refresh_from_db(fields=["sequence_id", "sequence_key"])
+
+
+@receiver(pre_delete, sender=ZettleCard)
+def collect_sequence_on_delete(sender, instance, **kwargs):
+    # Sequence fields are rewritten in bulk, so the instance may be stale.
+    instance._sequence_position = sequence_position(instance.pk)
+
+
+@receiver(post_delete, sender=ZettleCard)
+def relink_sequence_on_delete(sender, instance, **kwargs):
+    relink_after_delete(getattr(instance, "_sequence_position", None))
+
+
+@receiver(pre_delete, sender=ZettleCard)
+def touch_referencing_cards_on_delete(sender, instance, **kwargs):
+    # The links to the card are cleared without a save, so stamp the cards
+    # that hold them for the changes feed, and drop their cached payloads.
+    card_ids = list(
+        ZettleCard.objects.filter(
+            Q(parent=instance)
+            | Q(next=instance)
+            | Q(reply_to=instance)
+            | Q(tags=instance)
+        ).values_list("pk", flat=True)
+    )
+    ZettleCard.objects.filter(pk__in=card_ids).update(updated_at=timezone.now())
+    invalidate_cards(card_ids=card_ids)
+
+
+@receiver(post_delete, sender=ZettleCard)
+def record_tombstone_on_delete(sender, instance, **kwargs):
+    CardTombstone.objects.create(uuid=instance.uuid)
+
+
+@receiver(m2m_changed, sender=ZettleCard.tags.through)
+def touch_cards_on_tags_changed(sender, instance, action, pk_set, **kwargs):
+    if action == "pre_clear":
+        cards = ZettleCard.objects.filter(Q(pk=instance.pk) | Q(tags=instance))
+    elif action in ("post_add", "post_remove"):
+        cards = ZettleCard.objects.filter(pk__in=[instance.pk, *pk_set])
+    else:
+        return
+    cards.update(updated_at=timezone.now())
+
+
+def invalidate_fragments(uuids=(), card_ids=()):
+    """Drop the cached renderings of the given cards once the change commits."""
+    uuids = set(uuids)
+    card_ids = {pk for pk in card_ids if pk is not None}
+    if card_ids:
+        uuids.update(
+            ZettleCard.objects.filter(pk__in=card_ids).values_list("uuid", flat=True)
+        )
+    if uuids:
+        transaction.on_commit(lambda: get_fragment_cache().invalidate(uuids))
+
+
+@receiver(post_save, sender=ZettleCard)
+def invalidate_fragments_on_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    # Parents list their children, and tagged cards show this card's title.
+    card_ids = set()
+    if created or instance.has_changed("parent_id"):
+        card_ids.add(instance.parent_id)
+    if not created and instance.has_changed("parent_id"):
+        card_ids.add(instance.get_loaded_value("parent_id"))
+    if not created and instance.has_changed("title"):
+        card_ids.update(instance.tags.values_list("pk", flat=True))
+    invalidate_fragments([instance.uuid], card_ids)
+
+
+@receiver(pre_delete, sender=ZettleCard)
+def invalidate_fragments_on_delete(sender, instance, **kwargs):
+    # Cards linking to this one render differently once the links are gone.
+    card_ids = ZettleCard.objects.filter(
+        Q(pk=instance.parent_id) | Q(parent=instance) | Q(tags=instance)
+    ).values_list("pk", flat=True)
+    invalidate_fragments([instance.uuid], card_ids)
+
+
+@receiver(m2m_changed, sender=ZettleCard.tags.through)
+def invalidate_fragments_on_tags_changed(sender, instance, action, pk_set, **kwargs):
+    if action == "pre_clear":
+        invalidate_fragments(
+            [instance.uuid], instance.tags.values_list("pk", flat=True)
+        )
+    elif action in ("post_add", "post_remove"):
+        invalidate_fragments([instance.uuid], pk_set)
+
+
+@receiver(post_save, sender=ZettleCard)
+def invalidate_card_on_save(sender, instance, **kwargs):
+    invalidate_cards([instance.uuid])
+
+
+@receiver(post_delete, sender=ZettleCard)
+def invalidate_card_on_delete(sender, instance, **kwargs):
+    invalidate_cards([instance.uuid])
+
+
+def invalidate_referencing_cards(instance):
+    """Drop the cached payloads of the model cards pointing to ``instance``."""
+    content_type = ContentType.objects.get_for_model(instance)
+    invalidate_cards(
+        card_ids=ZettleCard.objects.filter(
+            content_type=content_type, object_id=instance.pk
+        ).values_list("pk", flat=True)
+    )
+
+
+@receiver(post_save, sender=ZettleCard)
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def invalidate_referencing_cards_on_save(
+    sender, instance, created, raw=False, **kwargs
+):
+    # Their payloads hold the object's label, which a card takes from its
+    # title and type. Users have no loaded values to compare.
+    if raw or created:
+        return
+    if sender is not ZettleCard or instance.has_changed("title", "card_type"):
+        invalidate_referencing_cards(instance)
+
+
+@receiver(post_delete, sender=ZettleCard)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def invalidate_referencing_cards_on_delete(sender, instance, **kwargs):
+    invalidate_referencing_cards(instance)
+
+
+@receiver(m2m_changed, sender=ZettleCard.tags.through)
+def invalidate_cards_on_tags_changed(sender, instance, action, pk_set, **kwargs):
+    # Tags are symmetrical, so the cards at both ends list the link.
+    if action == "pre_clear":
+        invalidate_cards([instance.uuid], instance.tags.values_list("pk", flat=True))
+    elif action in ("post_add", "post_remove"):
+        invalidate_cards([instance.uuid], pk_set)
+
+
+@receiver(post_save, sender=ZettleCard)
+def update_thumbnails_on_save(sender, instance, created, raw=False, **kwargs):
+    if raw or not (instance.image if created else instance.has_changed("image")):
+        return
+    if not created:
+        # Thumbnails are written in the background, so the instance may not
+        # have the current ones.
+        cards = ZettleCard.objects.filter(pk=instance.pk)
+        old_thumbnails = cards.values_list("thumbnails", flat=True).get()
+        if old_thumbnails:
+            cards.update(thumbnails={})
+            transaction.on_commit(lambda: delete_thumbnails(old_thumbnails))
+        instance.thumbnails = {}
+    if instance.image:
+        schedule_thumbnails(instance.pk)
+
+
+@receiver(pre_delete, sender=ZettleCard)
+def delete_thumbnails_on_delete(sender, instance, **kwargs):
+    thumbnails = (
+        ZettleCard.objects.filter(pk=instance.pk)
+        .values_list("thumbnails", flat=True)
+        .first()
+    )
+    if thumbnails:
+        transaction.on_commit(lambda: delete_thumbnails(thumbnails))
+
+
+@receiver(post_save, sender=ZettleCard)
+def count_blob_references_on_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    for field in BLOB_FIELDS:
+        name = getattr(instance, field).name
+        old_name = None if created else instance.get_loaded_value(field)
+        # Loaded values are the stored names, or files once saved back.
+        old_name = getattr(old_name, "name", old_name)
+        if name != old_name:
+            release_blobs([old_name] if old_name else [])
+            acquire_blobs([name] if name else [])
+
+
+@receiver(post_delete, sender=ZettleCard)
+def release_blobs_on_delete(sender, instance, **kwargs):
+    release_blobs(
+        [name for field in BLOB_FIELDS if (name := getattr(instance, field).name)]
+    )
+
+
+@receiver(post_save, sender=ZettleCard)
+def publish_card_on_save(sender, instance, created, raw=False, **kwargs):
+    if raw or not (created or instance.has_changed(*EVENT_FIELDS)):
+        return
+    regions = [region_of(instance.x, instance.y)]
+    if not created:
+        regions.append(
+            region_of(instance.get_loaded_value("x"), instance.get_loaded_value("y"))
+        )
+    publish_cards(
+        "card.created" if created else "card.updated",
+        [(card_payload(instance), regions)],
+    )
+
+
+@receiver(post_delete, sender=ZettleCard)
+def publish_card_on_delete(sender, instance, **kwargs):
+    old_region = region_of(
+        instance.get_loaded_value("x"), instance.get_loaded_value("y")
+    )
+    publish_cards("card.deleted", [(card_payload(instance, ["uuid"]), [old_region])])
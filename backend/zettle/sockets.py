@@ -0,0 +1,220 @@
+import asyncio
+import json
+import logging
+import time
+from importlib import import_module
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlsplit
+from uuid import UUID
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import aget_user
+from django.http import parse_cookie
+from django.utils.http import is_same_domain
+
+from backend.zettle.models import ZettleCard
+from backend.zettle.positions import move_cards
+from backend.zettle.realtime import get_broker, region_of, regions_in
+from backend.zettle.spatial import check_coordinate, parse_bbox
+
+logger = logging.getLogger(__name__)
+
+# Drags are broadcast at most this often per card...
+MOVE_INTERVAL = 1 / 20
+
+# ...and written to the database at most this often, or once they stop.
+PERSIST_INTERVAL = 1.0
+
+# Close codes, in the range left to applications.
+CLOSE_FORBIDDEN = 4403
+
+
+class MoveCoalescer:
+    """Merges the drag events of a worker's connections.
+
+    Only the latest position of each card is kept. Positions are broadcast
+    every ``move_interval``, so a card moves at most 20 times a second however
+    fast the mouse events come. They're written in one bulk update every
+    ``persist_interval``, or as soon as the drags stop. Writing broadcasts
+    the moves once more, to the regions the cards left too.
+    """
+
+    def __init__(self, move_interval=MOVE_INTERVAL, persist_interval=PERSIST_INTERVAL):
+        self.move_interval = move_interval
+        self.persist_interval = persist_interval
+        self.pending = {}
+        self.unsaved = {}
+        self.regions = {}
+        self.task = None
+
+    def submit(self, uuid, x, y):
+        self.pending[uuid] = (x, y)
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        last_persist = time.monotonic()
+        while self.pending or self.unsaved:
+            await asyncio.sleep(self.move_interval)
+            dragging = bool(self.pending)
+            self.broadcast()
+            now = time.monotonic()
+            if self.unsaved and (
+                not dragging or now - last_persist >= self.persist_interval
+            ):
+                last_persist = now
+                await self.persist()
+
+    async def idle(self):
+        """Wait until every pending move is broadcast and written."""
+        if self.task is not None:
+            await self.task
+
+    def broadcast(self):
+        pending, self.pending = self.pending, {}
+        by_region = {}
+        for uuid, (x, y) in pending.items():
+            payload = {"uuid": str(uuid), "x": x, "y": y}
+            region = region_of(x, y)
+            # Viewers of the region the card was last broadcast in see it leave.
+            for channel in {region, self.regions.get(uuid, region)}:
+                by_region.setdefault(channel, []).append(payload)
+            self.regions[uuid] = region
+        broker = get_broker()
+        for region, cards in by_region.items():
+            broker.publish(region, {"type": "card.moved", "cards": cards})
+        self.unsaved.update(pending)
+
+    async def persist(self):
+        unsaved, self.unsaved = self.unsaved, {}
+        for uuid in unsaved:
+            self.regions.pop(uuid, None)
+        try:
+            await sync_to_async(save_positions)(unsaved)
+        except Exception:
+            logger.exception("Couldn't save %d dragged cards", len(unsaved))
+
+
+def save_positions(positions):
+    """Write dragged positions in one bulk move, skipping cards since deleted."""
+    existing = ZettleCard.objects.filter(uuid__in=positions).values_list(
+        "uuid", flat=True
+    )
+    move_cards({uuid: positions[uuid] for uuid in existing})
+
+
+class CanvasSocket:
+    """The ``/ws/canvas/`` WebSocket, an ASGI app of its own.
+
+    A connection watches the canvas regions overlapping a viewport, given as
+    ``?bbox=`` or sent later as ``{"type": "subscribe", "bbox": "..."}``, and
+    receives ``card.created``, ``card.updated``, ``card.moved`` and
+    ``card.deleted`` events for them. Signed-in users drag cards by sending
+    ``{"type": "move", "uuid": ..., "x": ..., "y": ...}`` for each mouse event.
+    """
+
+    def __init__(self, coalescer=None):
+        self.coalescer = coalescer or MoveCoalescer()
+
+    async def __call__(self, scope, receive, send):
+        if (await receive())["type"] != "websocket.connect":
+            return
+        if not allowed_origin(scope):
+            await send({"type": "websocket.close", "code": CLOSE_FORBIDDEN})
+            return
+        user = await get_user(scope)
+        await send({"type": "websocket.accept"})
+
+        subscription = get_broker().subscribe()
+        forward = asyncio.create_task(self.forward(subscription, send))
+        try:
+            bbox = parse_qs(scope.get("query_string", b"").decode()).get("bbox")
+            if bbox:
+                await self.reply(send, await self.subscribe(subscription, bbox[0]))
+            while True:
+                message = await receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                if message["type"] == "websocket.receive":
+                    await self.reply(
+                        send, await self.handle(subscription, user, message)
+                    )
+        finally:
+            forward.cancel()
+            await subscription.close()
+
+    async def forward(self, subscription, send):
+        async for message in subscription:
+            await self.reply(send, message)
+
+    async def reply(self, send, message):
+        if message is not None:
+            await send({"type": "websocket.send", "text": json.dumps(message)})
+
+    async def handle(self, subscription, user, message):
+        try:
+            data = json.loads(message.get("text") or message.get("bytes") or "")
+        except ValueError:
+            return error("Messages must be JSON.")
+        if not isinstance(data, dict):
+            return error("Messages must be JSON objects.")
+        if data.get("type") == "subscribe":
+            return await self.subscribe(subscription, str(data.get("bbox", "")))
+        if data.get("type") == "move":
+            if not user.is_authenticated:
+                return error("Sign in to move cards.")
+            try:
+                uuid = UUID(str(data["uuid"]))
+                x, y = check_coordinate(data["x"]), check_coordinate(data["y"])
+            except (KeyError, TypeError, ValueError, OverflowError):
+                return error("A move needs a uuid and integer x and y on the canvas.")
+            self.coalescer.submit(uuid, x, y)
+            return None
+        return error("Unknown message type.")
+
+    async def subscribe(self, subscription, bbox):
+        try:
+            regions = regions_in(parse_bbox(bbox))
+        except ValueError as e:
+            return error(str(e))
+        await subscription.update(regions)
+        return {"type": "subscribed", "regions": len(regions)}
+
+
+def error(detail):
+    return {"type": "error", "detail": detail}
+
+
+async def get_user(scope):
+    """The user signed in with the session cookie, or an anonymous user."""
+    headers = dict(scope.get("headers", []))
+    cookies = parse_cookie(headers.get(b"cookie", b"").decode("latin-1"))
+    engine = import_module(settings.SESSION_ENGINE)
+    session = engine.SessionStore(cookies.get(settings.SESSION_COOKIE_NAME))
+    return await aget_user(SimpleNamespace(session=session))
+
+
+def allowed_origin(scope) -> bool:
+    """Whether a browser's ``Origin`` is this site or in ``CSRF_TRUSTED_ORIGINS``.
+
+    Browsers send cookies with cross-site WebSocket requests, so other sites
+    must not be able to open one as the user. The check is the one
+    ``CsrfViewMiddleware`` makes for unsafe requests.
+    """
+    headers = dict(scope.get("headers", []))
+    origin = headers.get(b"origin")
+    if origin is None:
+        return True
+    origin = origin.decode("latin-1")
+    host = headers.get(b"host", b"").decode("latin-1")
+    if host and origin in (f"http://{host}", f"https://{host}"):
+        return True
+    if origin in settings.CSRF_TRUSTED_ORIGINS:
+        return True
+    scheme, netloc = urlsplit(origin)[:2]
+    return any(
+        trusted.startswith(f"{scheme}://*")
+        and is_same_domain(netloc, urlsplit(trusted).netloc[1:])
+        for trusted in settings.CSRF_TRUSTED_ORIGINS
+    )
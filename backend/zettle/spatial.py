@@ -0,0 +1,86 @@
+import math
+
+from django.db.models import IntegerField, QuerySet
+from django.db.models.functions import Cast, Floor
+
+# Cards are bucketed into square grid cells of this many canvas units. The
+# (grid_x, grid_y) pair is indexed, so a viewport query becomes a handful of
+# index range scans instead of a scan over x or y alone.
+GRID_SIZE = 512
+
+# Above this many grid columns a viewport is scanned as a single range rather
+# than one index seek per column.
+MAX_GRID_SEEKS = 64
+
+# The range of the integer x and y columns.
+MIN_COORDINATE = -(2**31)
+MAX_COORDINATE = 2**31 - 1
+
+
+def grid_cell(x, y):
+    if x is None or y is None:
+        return None, None
+    return int(x) // GRID_SIZE, int(y) // GRID_SIZE
+
+
+def grid_cell_expression(coordinate):
+    """``grid_cell`` of one coordinate expression, computed by the database.
+
+    Integer division truncates towards zero in SQL, so the cell is floored
+    explicitly to match ``//`` for negative coordinates.
+    """
+    return Cast(Floor(coordinate / float(GRID_SIZE)), IntegerField())
+
+
+def parse_bbox(value: str) -> tuple[int, int, int, int]:
+    """Parse a ``minx,miny,maxx,maxy`` string, raising ValueError if malformed.
+
+    Fractional bounds are narrowed to the integer coordinates inside them, and
+    bounds past the range of the columns are clamped to it.
+    """
+    parts = [part.strip() for part in value.split(",")]
+    if len(parts) != 4:
+        raise ValueError("bbox must have the form minx,miny,maxx,maxy")
+    bounds = [float(part) for part in parts]
+    if not all(math.isfinite(bound) for bound in bounds):
+        raise ValueError("bbox bounds must be finite numbers")
+    min_x, min_y, max_x, max_y = bounds
+    if min_x > max_x or min_y > max_y:
+        raise ValueError("bbox minimums must not exceed its maximums")
+    min_x, min_y = (clamp(math.ceil(bound)) for bound in (min_x, min_y))
+    max_x, max_y = (clamp(math.floor(bound)) for bound in (max_x, max_y))
+    return min_x, min_y, max_x, max_y
+
+
+def check_coordinate(value) -> int:
+    """An x or y as an integer, raising ValueError if the columns can't hold it.
+
+    Infinite values raise OverflowError, as ``int()`` does.
+    """
+    coordinate = int(value)
+    if not MIN_COORDINATE <= coordinate <= MAX_COORDINATE:
+        raise ValueError(
+            f"Coordinates must be between {MIN_COORDINATE} and {MAX_COORDINATE}."
+        )
+    return coordinate
+
+
+def clamp(coordinate: int) -> int:
+    return min(max(coordinate, MIN_COORDINATE), MAX_COORDINATE)
+
+
+def filter_bbox(queryset: QuerySet, bbox: tuple[int, int, int, int]) -> QuerySet:
+    min_x, min_y, max_x, max_y = bbox
+    min_gx, min_gy = grid_cell(min_x, min_y)
+    max_gx, max_gy = grid_cell(max_x, max_y)
+
+    if max_gx - min_gx < MAX_GRID_SEEKS:
+        queryset = queryset.filter(grid_x__in=range(min_gx, max_gx + 1))
+    else:
+        queryset = queryset.filter(grid_x__range=(min_gx, max_gx))
+
+    return queryset.filter(
+        grid_y__range=(min_gy, max_gy),
+        x__range=(min_x, max_x),
+        y__range=(min_y, max_y),
+    )
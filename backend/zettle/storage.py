@@ -0,0 +1,115 @@
+import hashlib
+from functools import cache
+from pathlib import PurePosixPath
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.utils.module_loading import import_string
+
+BLOB_DIR = "blobs"
+
+DEFAULT_BACKEND = "backend.zettle.storage.ContentAddressedStorage"
+
+
+def blob_name(digest: str, extension: str = "") -> str:
+    """Where the content with this SHA-256 is stored, e.g. ``blobs/ab/cd/abcd….pdf``."""
+    return f"{BLOB_DIR}/{digest[:2]}/{digest[2:4]}/{digest}{extension}"
+
+
+def is_blob_name(name: str) -> bool:
+    """Whether ``name`` (or a file derived from it) is shared content."""
+    return bool(name) and name.startswith(f"{BLOB_DIR}/")
+
+
+def blob_digest(name: str) -> str | None:
+    """The SHA-256 a blob name was stored under, or None for other files."""
+    if not is_blob_name(name):
+        return None
+    return PurePosixPath(name).name.partition(".")[0]
+
+
+def file_sha256(content) -> str:
+    """Hash a file chunk by chunk, leaving it at the start."""
+    digest = hashlib.sha256()
+    content.seek(0)
+    for chunk in content.chunks():
+        digest.update(chunk)
+    content.seek(0)
+    return digest.hexdigest()
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """Stores each distinct file once, named by the SHA-256 of its content.
+
+    Saving content that is already stored writes nothing and returns the
+    existing name, whatever name the content was saved under. Only the
+    extension of the first name is kept. Uploads hashed on the way in by
+    ``HashingFileUploadHandler`` are not read again, and temporary uploads are
+    moved into place rather than copied.
+    """
+
+    def __init__(self, **kwargs):
+        # Concurrent saves of the same content write the same bytes.
+        kwargs.setdefault("allow_overwrite", True)
+        super().__init__(**kwargs)
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, "chunks"):
+            content = File(content, name)
+        digest = getattr(content, "sha256", None) or file_sha256(content)
+        existing = self.find(digest)
+        if existing is not None:
+            return existing
+        return self._save(
+            blob_name(digest, PurePosixPath(name).suffix.lower()), content
+        )
+
+    def save_as(self, name, content):
+        """Store ``content`` under exactly ``name``, replacing any file there.
+
+        For files derived from a blob, such as thumbnails, which are named
+        after the blob rather than their own content.
+        """
+        return super().save(name, content)
+
+    def find(self, digest: str) -> str | None:
+        """The stored name of the content with this SHA-256, if any."""
+        directory = str(PurePosixPath(blob_name(digest)).parent)
+        if not self.exists(directory):
+            return None
+        _, files = self.listdir(directory)
+        for filename in files:
+            if filename.partition(".")[0] == digest:
+                return f"{directory}/{filename}"
+        return None
+
+
+@cache
+def get_blob_storage():
+    """The storage configured by ``ZETTLE_BLOB_STORAGE``, for card files."""
+    return import_string(getattr(settings, "ZETTLE_BLOB_STORAGE", DEFAULT_BACKEND))()
+
+
+class HashingFileUploadHandler(TemporaryFileUploadHandler):
+    """Streams uploads to a temporary file, hashing each chunk as it arrives.
+
+    The upload's ``sha256`` lets ``ContentAddressedStorage`` skip a second
+    pass over the file.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.digest = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.digest.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        file.sha256 = self.digest.hexdigest()
+        return file
@@ -0,0 +1,117 @@
+import base64
+import hashlib
+import json
+from datetime import timedelta
+
+from django.db.models import Max, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from backend.zettle.models import CardTombstone, ZettleCard
+
+# Changes are stamped before their transaction commits, so a change can become
+# visible slightly after a later-stamped one. Sync tokens never get closer
+# than this to the present, and changes inside the window are sent again.
+SYNC_LAG = timedelta(seconds=5)
+
+# How long deleted cards are remembered. Clients whose token is older than
+# this must download the garden again.
+TOMBSTONE_RETENTION = timedelta(days=30)
+
+MAX_CHANGES = 1000
+
+
+class SyncTokenExpired(Exception):
+    pass
+
+
+def encode_token(changed_at, pk=0) -> str:
+    payload = json.dumps([changed_at.isoformat(), pk]).encode()
+    return base64.urlsafe_b64encode(payload).decode()
+
+
+def decode_token(token: str) -> tuple:
+    """The ``(changed_at, id)`` a token resumes after, raising ValueError if malformed.
+
+    Tokens without a UTC offset are malformed too.
+    """
+    try:
+        changed_at, pk = json.loads(base64.urlsafe_b64decode(token.encode()))
+        changed_at = parse_datetime(changed_at)
+    except (TypeError, ValueError) as e:
+        raise ValueError("Invalid sync token.") from e
+    if changed_at is None or timezone.is_naive(changed_at) or not isinstance(pk, int):
+        raise ValueError("Invalid sync token.")
+    return changed_at, pk
+
+
+def get_changes(queryset, token=None, limit=MAX_CHANGES):
+    """Cards of ``queryset`` changed after ``token``, and uuids deleted since.
+
+    Cards come in ``(updated_at, id)`` order, at most ``limit`` of them, so a
+    large backlog is fetched over several calls. Returns ``(cards, deleted,
+    next_token, more)``; raises SyncTokenExpired when the token predates the
+    tombstones still kept.
+    """
+    now = timezone.now()
+    if token is None:
+        since, since_pk = None, 0
+    else:
+        since, since_pk = decode_token(token)
+        if since < now - TOMBSTONE_RETENTION:
+            raise SyncTokenExpired
+
+    cards = queryset.order_by("updated_at", "id")
+    if since is not None:
+        # The bound lets the database seek into the (updated_at, id) index.
+        cards = cards.filter(
+            Q(updated_at__gte=since),
+            Q(updated_at__gt=since) | Q(updated_at=since, id__gt=since_pk),
+        )
+    cards = list(cards[: limit + 1])
+    more = len(cards) > limit
+    cards = cards[:limit]
+
+    # Deletions are reported up to the end of this page of changes.
+    horizon = now - SYNC_LAG
+    if more:
+        next_token = encode_token(cards[-1].updated_at, cards[-1].pk)
+        until = cards[-1].updated_at
+    else:
+        until = now
+        next_token = encode_token(horizon)
+        if cards and cards[-1].updated_at < horizon:
+            next_token = encode_token(cards[-1].updated_at, cards[-1].pk)
+    deleted = []
+    if since is not None:
+        deleted = list(
+            CardTombstone.objects.filter(
+                deleted_at__gte=since, deleted_at__lte=until
+            ).values_list("uuid", flat=True)
+        )
+    return cards, deleted, next_token, more
+
+
+def garden_version() -> tuple:
+    """The latest change and deletion times, which move on any card write."""
+    changed = ZettleCard.objects.aggregate(changed=Max("updated_at"))["changed"]
+    deleted = CardTombstone.objects.aggregate(deleted=Max("deleted_at"))["deleted"]
+    return changed, deleted
+
+
+async def agarden_version() -> tuple:
+    """``garden_version`` for async views."""
+    changed = await ZettleCard.objects.aaggregate(changed=Max("updated_at"))
+    deleted = await CardTombstone.objects.aaggregate(deleted=Max("deleted_at"))
+    return changed["changed"], deleted["deleted"]
+
+
+def make_etag(*parts) -> str:
+    digest = hashlib.md5(":".join(map(str, parts)).encode()).hexdigest()
+    return f'"{digest}"'
+
+
+def prune_tombstones():
+    cutoff = timezone.now() - TOMBSTONE_RETENTION
+    deleted, _ = CardTombstone.objects.filter(deleted_at__lt=cutoff).delete()
+    return deleted
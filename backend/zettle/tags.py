@@ -0,0 +1,77 @@
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from backend.zettle.card_cache import clear_cards, invalidate_cards
+from backend.zettle.models import ZettleCard
+
+# Tag links are stored in both directions, one row per direction, so the
+# cards tagged with a card are the rows *from* it, and the unique
+# (from, to) index serves lookups by tag.
+TagLink = ZettleCard.tags.through
+
+
+def tag_count_subquery():
+    """The number of cards tagged with the outer card, counted from the links."""
+    links = (
+        TagLink.objects.filter(from_zettlecard_id=OuterRef("pk"))
+        .values("from_zettlecard_id")
+        .annotate(count=Count("*"))
+        .values("count")
+    )
+    return Coalesce(Subquery(links), 0)
+
+
+def recount_tags(card_ids=None) -> int:
+    """Recount ``tag_count`` for the given cards, or every card.
+
+    Only cards whose stored count is off are written, with a fresh
+    ``updated_at``, as in ``recount_links``. Returns how many.
+    """
+    cards = ZettleCard.objects.all()
+    if card_ids is not None:
+        card_ids = {pk for pk in card_ids if pk is not None}
+        if not card_ids:
+            return 0
+        cards = cards.filter(pk__in=card_ids)
+    count = tag_count_subquery()
+    fixed = cards.exclude(tag_count=count).update(
+        tag_count=count, updated_at=timezone.now()
+    )
+    if fixed and card_ids is None:
+        clear_cards()
+    elif fixed:
+        invalidate_cards(card_ids=card_ids)
+    return fixed
+
+
+def count_added_tags(card_id, tag_ids):
+    """Count new links from ``card_id`` to each of ``tag_ids``.
+
+    ``m2m_changed`` sends ``post_add`` before the reverse rows are inserted,
+    so the links can't be recounted yet. ``tag_ids`` only holds new links.
+    """
+    tag_ids = set(tag_ids)
+    ZettleCard.objects.filter(pk=card_id).update(
+        tag_count=F("tag_count") + len(tag_ids)
+    )
+    # A card tagged with itself has a single link row, counted once.
+    ZettleCard.objects.filter(pk__in=tag_ids - {card_id}).update(
+        tag_count=F("tag_count") + 1
+    )
+    invalidate_cards(card_ids={card_id, *tag_ids})
+
+
+def filter_by_tags(queryset, tag_ids, match_all=True):
+    """Cards tagged with all (or any) of ``tag_ids``.
+
+    Matches are found on the link table alone, through its index, and
+    joined back as a single ``IN`` subquery, so no card is repeated.
+    """
+    tag_ids = set(tag_ids)
+    links = TagLink.objects.filter(from_zettlecard_id__in=tag_ids).values(
+        "to_zettlecard_id"
+    )
+    if match_all and len(tag_ids) > 1:
+        links = links.annotate(matched=Count("*")).filter(matched=len(tag_ids))
+    return queryset.filter(pk__in=links.values("to_zettlecard_id"))
@@ -0,0 +1,12 @@
+from django import template
+from django.utils.safestring import mark_safe
+
+from backend.zettle.fragments import render_card
+
+register = template.Library()
+
+
+@register.simple_tag
+def card_fragment(card):
+    """Render a card through its card type template, via the fragment cache."""
+    return mark_safe(render_card(card))
@@ -1,8 +1,73 @@
-from django.urls import reverse
+import asyncio
+import base64
+import hashlib
+import json
+import re
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
+from uuid import uuid4
+
+from asgiref.sync import sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.db.models.signals import post_save
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+from django.utils import timezone
+from PIL import Image
 from rest_framework import status
-from rest_framework.test import APITestCase
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory, APITestCase
+from rest_framework_api_key.models import APIKey
 
-from backend.zettle.models import ZettleCard
+from backend.core.metrics import REGISTRY
+from backend.core.renderers import FastJSONRenderer
+from backend.users.factories import UserFactory
+from backend.zettle.benchmarks import REFERENCE_TYPES, Benchmark, QueryCounter
+from backend.zettle.blobs import collect_blobs, count_references
+from backend.zettle.card_cache import CardCache, get_card_cache
+from backend.zettle.clusters import rebuild_tiles
+from backend.zettle.fragments import (
+    FileFragmentCache,
+    LocMemFragmentCache,
+    fragment_key,
+    get_fragment_cache,
+    render_card,
+)
+from backend.zettle.generator import GardenGenerator, update_indexes
+from backend.zettle.hierarchy import rebuild_paths
+from backend.zettle.models import (
+    PATH_LENGTH,
+    Blob,
+    CardTombstone,
+    UploadSession,
+    Vote,
+    ZettleCard,
+    ZettleTile,
+)
+from backend.zettle.pagination import CardPagination, KeysetPagination
+from backend.zettle.positions import MOVED_FIELDS, move_cards
+from backend.zettle.ranking import hot_score
+from backend.zettle.references import summarize_reference
+from backend.zettle.search import ContainsSearchBackend, get_search_backend
+from backend.zettle.sequences import key_between, keys_between, place_cards
+from backend.zettle.sockets import CanvasSocket, MoveCoalescer
+from backend.zettle.spatial import parse_bbox
+from backend.zettle.sync import decode_token, encode_token
+from backend.zettle.tags import recount_tags
+from backend.zettle.threads import fetch_thread
+from backend.zettle.thumbnails import thumbnail_dir
 
 
 class CardPositioningTests(APITestCase):
@@ -82,3 +147,2694 @@ class CardPositioningTests(APITestCase):
         self.assertIn("y", first_card)
         self.assertIsNotNone(first_card["x"])
         self.assertIsNotNone(first_card["y"])
+
+
+class SpatialIndexTests(APITestCase):
+    def setUp(self):
+        self.list_url = reverse("zettle:zettlecard-list")
+        self.inside = ZettleCard.objects.create(title="Inside", x=100, y=-100)
+        self.edge = ZettleCard.objects.create(title="Edge", x=1000, y=0)
+        self.outside = ZettleCard.objects.create(title="Outside", x=5000, y=5000)
+        self.unplaced = ZettleCard.objects.create(title="Unplaced")
+
+    def test_grid_cell_kept_in_sync_on_save(self):
+        """Saving a card should recompute its grid cell"""
+        self.assertEqual((self.inside.grid_x, self.inside.grid_y), (0, -1))
+        self.assertEqual((self.unplaced.grid_x, self.unplaced.grid_y), (None, None))
+
+        self.inside.x = -600
+        self.inside.save(update_fields=["x"])
+        self.inside.refresh_from_db()
+        self.assertEqual((self.inside.grid_x, self.inside.grid_y), (-2, -1))
+
+    def test_bbox_returns_cards_in_viewport(self):
+        """Should only return cards inside the bounding box, edges included"""
+        response = self.client.get(self.list_url, {"bbox": "-200,-200,1000,1000"})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        card_uuids = {card["uuid"] for card in response.data["results"]}
+        self.assertEqual(card_uuids, {str(self.inside.uuid), str(self.edge.uuid)})
+
+    def test_invalid_bbox(self):
+        """Should reject a malformed bounding box"""
+        for bbox in ["0,0,inf,1", "nan,0,1,1", "2,0,1,1", "a,0,1,1"]:
+            with self.subTest(bbox=bbox), self.assertRaises(ValueError):
+                parse_bbox(bbox)
+        response = self.client.get(self.list_url, {"bbox": "1,2,3"})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("bbox", response.data)
+
+    def test_bbox_bounds_are_rounded_inward_and_clamped(self):
+        """Fractional bounds should only take in the coordinates inside them"""
+        self.assertEqual(parse_bbox("1.5,-1.5,2.5,-0.5"), (2, -1, 2, -1))
+        self.assertEqual(parse_bbox("-1e30,0,1e30,0"), (-(2**31), 0, 2**31 - 1, 0))
+
+        response = self.client.get(self.list_url, {"bbox": "99.5,-1e30,1e30,1e30"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        card_uuids = {card["uuid"] for card in response.data["results"]}
+        self.assertEqual(
+            card_uuids,
+            {str(self.inside.uuid), str(self.edge.uuid), str(self.outside.uuid)},
+        )
+        response = self.client.get(self.list_url, {"bbox": "100.5,-100,1000,0"})
+        card_uuids = {card["uuid"] for card in response.data["results"]}
+        self.assertEqual(card_uuids, {str(self.edge.uuid)})
+
+
+class ClusterTests(APITestCase):
+    def setUp(self):
+        self.clusters_url = reverse("zettle:zettlecard-clusters")
+        self.topic = ZettleCard.objects.create(
+            title="Topic", card_type=ZettleCard.CardType.TOPIC, x=100, y=100, votes=9
+        )
+        self.text = ZettleCard.objects.create(title="Text", x=300, y=500, votes=5)
+        self.far = ZettleCard.objects.create(title="Far", x=3000, y=100)
+
+    def get_clusters(self, **params):
+        params.setdefault("bbox", "0,0,4095,2047")
+        response = self.client.get(self.clusters_url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return {(c["tile_x"], c["tile_y"]): c for c in response.data}
+
+    def test_clusters_aggregate_cards(self):
+        """Clusters should carry count, centroid, dominant type and top titles"""
+        clusters = self.get_clusters()
+
+        self.assertEqual(set(clusters), {(0, 0), (1, 0)})
+        cluster = clusters[(0, 0)]
+        self.assertEqual(cluster["count"], 2)
+        self.assertEqual((cluster["x"], cluster["y"]), (200, 300))
+        self.assertEqual(cluster["type_counts"], {"topic": 1, "text": 1})
+        self.assertEqual(
+            [card["title"] for card in cluster["top_cards"]], ["Topic", "Text"]
+        )
+
+    def test_rebuilt_tiles_rank_ties_like_incremental_ones(self):
+        """Cards tied on votes should rank the same however tiles were built"""
+        for i in range(4):
+            ZettleCard.objects.create(title=f"Tie {i}", x=200 + i, y=200, votes=5)
+        self.topic.delete()
+        incremental = self.get_clusters()[(0, 0)]["top_cards"]
+        rebuild_tiles()
+        self.assertEqual(self.get_clusters()[(0, 0)]["top_cards"], incremental)
+        self.assertEqual(
+            [card["uuid"] for card in incremental],
+            sorted(card["uuid"] for card in incremental),
+        )
+
+    def test_clusters_follow_moves_and_deletes(self):
+        """Moving and deleting cards should update the tiles incrementally"""
+        self.text.x = 3100
+        self.text.save()
+        self.topic.delete()
+
+        clusters = self.get_clusters()
+        self.assertEqual(set(clusters), {(1, 0)})
+        self.assertEqual(clusters[(1, 0)]["count"], 2)
+        self.assertEqual(clusters[(1, 0)]["card_type"], "text")
+        self.assertEqual(clusters[(1, 0)]["top_cards"][0]["title"], "Text")
+
+    def test_rebuild_matches_incremental_tiles(self):
+        """Rebuilding from scratch should produce the same clusters"""
+        self.topic.votes = 1
+        self.topic.save()
+        expected = self.get_clusters(zoom=0.5)
+
+        rebuild_tiles()
+
+        self.assertEqual(self.get_clusters(zoom=0.5), expected)
+        self.assertEqual(expected[(0, 0)]["top_cards"][0]["title"], "Text")
+
+    def test_unclustered_zoom(self):
+        """Should reject zoom levels that are not clustered"""
+        response = self.client.get(self.clusters_url, {"bbox": "0,0,1,1", "zoom": 1})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("zoom", response.data)
+
+
+class SearchTests(APITestCase):
+    def setUp(self):
+        self.list_url = reverse("zettle:zettlecard-list")
+        self.search_url = reverse("zettle:zettlecard-search")
+        self.title_match = ZettleCard.objects.create(
+            title="Gardening basics", text="Soil and water."
+        )
+        self.text_match = ZettleCard.objects.create(
+            title="Weekend notes", text="Spent the weekend gardening.", votes=50
+        )
+        self.tagged = ZettleCard.objects.create(title="Compost", text="Layers.")
+        self.tag = ZettleCard.objects.create(
+            title="Horticulture", card_type=ZettleCard.CardType.TOPIC
+        )
+        self.tagged.tags.add(self.tag)
+
+    def search(self, **params):
+        response = self.client.get(self.list_url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [card["title"] for card in response.data["results"]]
+
+    def test_results_in_relevance_order(self):
+        """Title matches should rank above text matches, with prefix matching"""
+        self.assertEqual(
+            self.search(search="garden"), ["Gardening basics", "Weekend notes"]
+        )
+
+    def test_votes_blending(self):
+        """rank=votes should let heavily voted cards climb"""
+        self.assertEqual(
+            self.search(search="garden", rank="votes"),
+            ["Weekend notes", "Gardening basics"],
+        )
+
+    def test_explicit_ordering_wins(self):
+        """An explicit ordering should override relevance order"""
+        self.assertEqual(
+            self.search(search="garden", ordering="-votes"),
+            ["Weekend notes", "Gardening basics"],
+        )
+
+    def test_index_follows_writes(self):
+        """Edits, tag changes and deletes should be reflected immediately"""
+        self.assertEqual(
+            self.search(search="horticulture"), ["Horticulture", "Compost"]
+        )
+
+        self.tag.title = "Permaculture"
+        self.tag.save()
+        self.assertEqual(self.search(search="horticulture"), [])
+        self.assertEqual(self.search(search="perma"), ["Permaculture", "Compost"])
+
+        self.tagged.tags.clear()
+        self.title_match.delete()
+        self.assertEqual(self.search(search="perma"), ["Permaculture"])
+        self.assertEqual(self.search(search="garden"), ["Weekend notes"])
+
+    def test_search_action_returns_snippets(self):
+        """The search action should return scores and escaped snippets"""
+        ZettleCard.objects.create(title="Markup", text="<b>gardening</b> tips")
+        response = self.client.get(self.search_url, {"q": "gardening tips"})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(response.data[0]["title"], "Markup")
+        self.assertIn("&lt;b&gt;<mark>gardening</mark>", response.data[0]["snippet"])
+
+    def test_search_limit_is_clamped(self):
+        """A limit below one should still return a single result"""
+        response = self.client.get(self.search_url, {"q": "garden", "limit": -5})
+        self.assertEqual(len(response.data), 1)
+
+    def test_other_databases_fall_back_to_substring_search(self):
+        """Vendors without a full-text backend should search with icontains"""
+        get_search_backend.cache_clear()
+        self.addCleanup(get_search_backend.cache_clear)
+        with mock.patch.object(connection, "vendor", "oracle"):
+            backend = get_search_backend()
+        self.assertIsInstance(backend, ContainsSearchBackend)
+
+        backend.index([self.title_match.pk])
+        results = backend.search("GARDEN", 10, by_votes=True)
+        self.assertEqual(
+            [card_id for card_id, _, _ in results],
+            [self.text_match.pk, self.title_match.pk],
+        )
+        self.assertEqual(results[1][2], "<mark>Gardening</mark> basics Soil and water.")
+        self.assertEqual(
+            [card_id for card_id, _, _ in backend.search("horticulture", 10)],
+            [self.tag.pk, self.tagged.pk],
+        )
+
+
+class SubtreeTests(APITestCase):
+    def setUp(self):
+        self.root = ZettleCard.objects.create(title="Root")
+        self.b = ZettleCard.objects.create(title="B", parent=self.root, votes=1)
+        self.a = ZettleCard.objects.create(title="A", parent=self.root, votes=5)
+        self.a1 = ZettleCard.objects.create(title="A1", parent=self.a)
+        self.a1x = ZettleCard.objects.create(title="A1x", parent=self.a1)
+        self.a1.tags.add(self.b)
+        self.tree_url = reverse(
+            "zettle:zettlecard-tree", kwargs={"uuid": self.root.uuid}
+        )
+
+    def test_tree_nests_descendants(self):
+        """Should return the whole subtree nested, with child counts"""
+        response = self.client.get(self.tree_url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["title"], "Root")
+        self.assertEqual(response.data["child_count"], 2)
+        b, a = response.data["children"]
+        self.assertEqual((a["title"], b["title"]), ("A", "B"))
+        self.assertEqual(a["children"][0]["title"], "A1")
+        self.assertEqual(a["children"][0]["depth"], 2)
+        self.assertEqual(a["children"][0]["tags"], [self.b.pk])
+        self.assertEqual(a["children"][0]["children"][0]["title"], "A1x")
+
+    def test_tree_depth_and_ordering(self):
+        """Depth should cut the tree while child counts stay complete"""
+        response = self.client.get(self.tree_url, {"depth": 2, "ordering": "-votes"})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        a, b = response.data["children"]
+        self.assertEqual((a["title"], b["title"]), ("A", "B"))
+        a1 = a["children"][0]
+        self.assertEqual(a1["children"], [])
+        self.assertEqual(a1["child_count"], 1)
+
+    def test_tree_query_count_is_independent_of_depth(self):
+        """Fetching a subtree should not issue a query per level"""
+        # Card lookup, subtree and tags; reads skip the request's transaction.
+        with self.assertNumQueries(3):
+            self.client.get(self.tree_url)
+
+    def test_tree_rejects_bad_depth(self):
+        """Should reject depths outside the supported range"""
+        response = self.client.get(self.tree_url, {"depth": -1})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class HierarchyIndexTests(APITestCase):
+    def setUp(self):
+        self.root = ZettleCard.objects.create(title="Root")
+        self.child = ZettleCard.objects.create(title="Child", parent=self.root)
+        self.grandchild = ZettleCard.objects.create(
+            title="Grandchild", parent=self.child
+        )
+        self.other = ZettleCard.objects.create(title="Other")
+
+    def paths(self):
+        return dict(ZettleCard.objects.values_list("title", "path"))
+
+    def test_paths_maintained_on_create(self):
+        """New cards should get their root-to-self path and depth"""
+        root, child = self.root.pk, self.child.pk
+        self.assertEqual(self.grandchild.path, f"{root}/{child}/{self.grandchild.pk}/")
+        self.assertEqual(self.grandchild.depth, 2)
+        self.assertTrue(self.grandchild.is_descendant_of(self.root))
+        self.assertFalse(self.root.is_descendant_of(self.grandchild))
+
+    def test_prefix_ids_are_not_descendants(self):
+        """Card 7 should not count cards 70 or 700 as descendants, nor theirs"""
+        seven = ZettleCard.objects.create(pk=7, title="Seven")
+        seventy = ZettleCard.objects.create(pk=70, title="Seventy")
+        under_seven = ZettleCard.objects.create(title="Under seven", parent=seven)
+        under_seventy = ZettleCard.objects.create(title="Under seventy", parent=seventy)
+        sibling = ZettleCard.objects.create(pk=700, title="Seven hundred")
+        self.assertEqual(list(seven.get_descendants()), [under_seven])
+        self.assertEqual(list(seventy.get_descendants()), [under_seventy])
+        self.assertFalse(sibling.get_descendants().exists())
+
+        seven.parent = under_seven
+        with self.assertRaises(ValidationError):
+            seven.save()
+        seventy.parent = under_seven
+        seventy.save()
+        under_seventy.refresh_from_db()
+        self.assertEqual(
+            under_seventy.path, f"7/{under_seven.pk}/70/{under_seventy.pk}/"
+        )
+
+    def test_reparent_moves_subtree(self):
+        """Re-parenting should rewrite the paths of the whole subtree"""
+        self.child.parent = self.other
+        self.child.save()
+
+        self.grandchild.refresh_from_db()
+        self.assertEqual(
+            self.grandchild.path,
+            f"{self.other.pk}/{self.child.pk}/{self.grandchild.pk}/",
+        )
+        self.assertEqual(self.root.get_descendants().count(), 0)
+        self.assertEqual(self.other.get_descendants().count(), 2)
+
+    def test_stale_instance_reparents_from_stored_path(self):
+        """A re-parent through a stale instance should move the current subtree"""
+        stale = ZettleCard.objects.get(pk=self.child.pk)
+        self.child.parent = self.other
+        self.child.save()
+        third = ZettleCard.objects.create(title="Third")
+
+        stale.parent = third
+        stale.save()
+        self.grandchild.refresh_from_db()
+        self.assertEqual(
+            self.paths(),
+            {
+                "Root": f"{self.root.pk}/",
+                "Other": f"{self.other.pk}/",
+                "Third": f"{third.pk}/",
+                "Child": f"{third.pk}/{self.child.pk}/",
+                "Grandchild": f"{third.pk}/{self.child.pk}/{self.grandchild.pk}/",
+            },
+        )
+
+    def test_delete_reroots_children(self):
+        """Deleting a card should turn its children into roots"""
+        self.root.delete()
+
+        self.grandchild.refresh_from_db()
+        self.assertEqual(self.grandchild.path, f"{self.child.pk}/{self.grandchild.pk}/")
+        self.assertEqual(self.grandchild.depth, 1)
+
+    def test_delete_subtree_together(self):
+        """Deleting a parent with its child should re-root the grandchildren"""
+        ZettleCard.objects.filter(pk__in=[self.root.pk, self.child.pk]).delete()
+
+        self.grandchild.refresh_from_db()
+        self.assertEqual(self.grandchild.path, f"{self.grandchild.pk}/")
+        self.assertEqual(self.grandchild.depth, 0)
+
+    def test_reparent_cycle_rejected(self):
+        """Moving a card under its own descendant should be rejected"""
+        url = reverse("zettle:zettlecard-detail", kwargs={"uuid": self.root.uuid})
+        response = self.client.patch(url, {"parent": self.grandchild.pk})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("parent", response.data)
+
+    def test_too_deep_trees_rejected(self):
+        """Creating or moving cards past the longest path should be rejected"""
+        deep = ZettleCard.objects.create(title="Deep")
+        # Room left for the grandchild's id alone, as if deep in a real tree.
+        length = PATH_LENGTH - len(f"{self.grandchild.pk}/")
+        head = length - len(f"{deep.pk}/")
+        path = "9/" * (head // 2 - head % 2) + "99/" * (head % 2) + f"{deep.pk}/"
+        ZettleCard.objects.filter(pk=deep.pk).update(path=path, depth=path.count("/"))
+
+        response = self.client.post(
+            reverse("zettle:zettlecard-list"), {"title": "New", "parent": deep.pk}
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("parent", response.data)
+        url = reverse("zettle:zettlecard-detail", kwargs={"uuid": self.child.uuid})
+        response = self.client.patch(url, {"parent": deep.pk})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("parent", response.data)
+
+        self.grandchild.parent = deep
+        self.grandchild.save()
+        self.assertEqual(len(self.grandchild.path), PATH_LENGTH)
+
+    def test_ancestors_and_descendants_endpoints(self):
+        """Breadcrumbs and descendant counts should come from the path index"""
+        url = reverse(
+            "zettle:zettlecard-ancestors", kwargs={"uuid": self.grandchild.uuid}
+        )
+        with self.assertNumQueries(3):
+            response = self.client.get(url)
+        self.assertEqual([card["title"] for card in response.data], ["Root", "Child"])
+
+        url = reverse("zettle:zettlecard-descendants", kwargs={"uuid": self.root.uuid})
+        response = self.client.get(url)
+        self.assertEqual(response.data["count"], 2)
+
+    def test_rebuild_matches_incremental_paths(self):
+        """Rebuilding should reproduce the incrementally maintained paths"""
+        self.child.parent = self.other
+        self.child.save()
+        expected = self.paths()
+        ZettleCard.objects.update(path="", depth=0)
+
+        rebuild_paths()
+
+        self.assertEqual(self.paths(), expected)
+
+
+class SequenceTests(APITestCase):
+    def setUp(self):
+        self.a = ZettleCard.objects.create(title="A")
+        self.b = ZettleCard.objects.create(title="B")
+        self.c = ZettleCard.objects.create(title="C")
+        self.d = ZettleCard.objects.create(title="D")
+        place_cards(self.a, [self.b, self.c], at_end=True)
+        self.url = reverse("zettle:zettlecard-sequence", kwargs={"uuid": self.a.uuid})
+
+    def chain(self, head):
+        titles = []
+        while head is not None:
+            titles.append(head.title)
+            head = head.next
+        return titles
+
+    def assertSequence(self, titles):
+        # Card lookup, sequence and tags.
+        with self.assertNumQueries(3):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([card["title"] for card in response.data], titles)
+        head = ZettleCard.objects.get(uuid=response.data[0]["uuid"])
+        self.assertEqual(self.chain(head), titles)
+
+    def test_keys_between(self):
+        """Generated keys should sort strictly between their bounds"""
+        keys = keys_between(None, None, 100)
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(set(keys)), 100)
+        self.assertTrue("a" < key_between("a", "a1") < "a1")
+        self.assertTrue("zz" < key_between("zz", None))
+
+    def test_keys_stay_short_at_the_ends(self):
+        """Thousands of appends and prepends should keep keys within the column"""
+        cards = ZettleCard.objects.bulk_create(
+            ZettleCard(title=f"Card {i}") for i in range(2000)
+        )
+        for card in cards[:1600]:
+            place_cards(self.a, [card], at_end=True)
+        for card in cards[1600:]:
+            place_cards(self.a, [card])
+
+        max_length = ZettleCard._meta.get_field("sequence_key").max_length
+        keys = ZettleCard.objects.filter(sequence_id=self.a.sequence_id).order_by(
+            "sequence_key"
+        )
+        self.assertLessEqual(
+            max(len(key) for key in keys.values_list("sequence_key", flat=True)),
+            max_length,
+        )
+        expected = [*reversed(cards[1600:]), self.a, self.b, self.c, *cards[:1600]]
+        self.assertEqual(list(keys), expected)
+        self.assertEqual(
+            [card.next_id for card in keys],
+            [card.pk for card in expected[1:]] + [None],
+        )
+
+    def test_sequence_read_in_one_query(self):
+        """The whole chain should be read through the sequence index"""
+        self.assertSequence(["A", "B", "C"])
+
+    def test_insert_in_the_middle(self):
+        """Inserting should only touch the neighbours, keeping next consistent"""
+        response = self.client.post(
+            self.url,
+            {"cards": [str(self.d.uuid)], "after": str(self.a.uuid)},
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertSequence(["A", "D", "B", "C"])
+
+    def test_move_and_reorder(self):
+        """Moving and reordering should rewrite keys and links"""
+        self.client.post(self.url, {"cards": [str(self.a.uuid)], "after": None})
+        self.assertSequence(["A", "B", "C"])
+        self.client.post(self.url, {"cards": [str(self.a.uuid)]})
+        self.assertSequence(["B", "C", "A"])
+
+        response = self.client.put(
+            self.url, {"order": [str(self.c.uuid), str(self.a.uuid), str(self.b.uuid)]}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertSequence(["C", "A", "B"])
+
+    def test_reorder_requires_every_card(self):
+        """A reorder missing cards of the sequence should be rejected"""
+        response = self.client.put(self.url, {"order": [str(self.a.uuid)]})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_rejects_bodies_that_are_not_objects(self):
+        """A placement or reorder whose body is a list should be rejected"""
+        for method in [self.client.post, self.client.put]:
+            with self.subTest(method=method.__name__):
+                response = method(self.url, [str(self.a.uuid)])
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertSequence(["A", "B", "C"])
+
+    def test_delete_bridges_the_gap(self):
+        """Deleting a card should link its neighbours"""
+        self.b.delete()
+
+        self.assertSequence(["A", "C"])
+
+    def test_stale_save_keeps_sequence(self):
+        """Saving a card loaded before a reorder should keep its new place"""
+        stale = ZettleCard.objects.get(pk=self.c.pk)
+        self.client.put(
+            self.url, {"order": [str(self.c.uuid), str(self.a.uuid), str(self.b.uuid)]}
+        )
+        saved = mock.Mock()
+        post_save.connect(saved, sender=ZettleCard)
+        self.addCleanup(post_save.disconnect, saved, sender=ZettleCard)
+
+        stale.title = "Renamed"
+        stale.save()
+
+        # Still a full save to signal receivers, without the stale columns.
+        self.assertIsNone(saved.call_args.kwargs["update_fields"])
+        self.assertSequence(["Renamed", "A", "B"])
+
+    def test_legacy_next_writes_are_mirrored(self):
+        """Setting next directly should still update the sequence"""
+        self.c.next = self.d
+        self.c.save()
+        self.assertSequence(["A", "B", "C", "D"])
+
+        self.a.refresh_from_db()
+        self.a.next = None
+        self.a.save()
+        self.assertEqual(self.a.sequence_id, None)
+        self.url = reverse("zettle:zettlecard-sequence", kwargs={"uuid": self.b.uuid})
+        self.assertSequence(["B", "C", "D"])
+
+
+class ThreadTests(APITestCase):
+    def setUp(self):
+        self.root = ZettleCard.objects.create(title="Root")
+        now = timezone.now()
+        self.replies = [
+            ZettleCard.objects.create(
+                title=f"Reply {i}",
+                reply_to=self.root,
+                votes=i,
+                created_at=now - timedelta(hours=i),
+            )
+            for i in range(5)
+        ]
+        self.nested = ZettleCard.objects.create(
+            title="Nested", reply_to=self.replies[4]
+        )
+        self.url = reverse("zettle:zettlecard-thread", kwargs={"uuid": self.root.uuid})
+
+    def titles(self, node):
+        return [reply["title"] for reply in node["replies"]]
+
+    def test_hot_score_is_stored(self):
+        """Saving a card should store its hot score, and refresh it with its votes"""
+        card = self.replies[1]
+        self.assertEqual(card.hot_score, hot_score(card.votes, card.created_at))
+        card.votes = 50
+        card.save(update_fields=["votes"])
+        card.refresh_from_db()
+        self.assertEqual(card.hot_score, hot_score(50, card.created_at))
+
+    def test_thread_sorts(self):
+        """Replies should be ranked by the requested sort"""
+        response = self.client.get(self.url, {"sort": "top"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            self.titles(response.data), [f"Reply {i}" for i in range(4, -1, -1)]
+        )
+        self.assertEqual(self.titles(response.data["replies"][0]), ["Nested"])
+
+        response = self.client.get(self.url, {"sort": "new"})
+        self.assertEqual(self.titles(response.data), [f"Reply {i}" for i in range(5)])
+
+        response = self.client.get(self.url, {"sort": "bogus"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_load_more_per_branch(self):
+        """Branches cut by the limit should link to their next page"""
+        response = self.client.get(self.url, {"sort": "top", "limit": 2, "depth": 1})
+        self.assertEqual(self.titles(response.data), ["Reply 4", "Reply 3"])
+        self.assertEqual(response.data["reply_count"], 5)
+        top = response.data["replies"][0]
+        self.assertEqual(top["replies"], [])
+        self.assertIsNotNone(top["next"])
+        self.assertIsNone(response.data["replies"][1]["next"])
+
+        titles = self.titles(response.data)
+        next_url = response.data["next"]
+        while next_url:
+            response = self.client.get(next_url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            titles += self.titles(response.data)
+            next_url = response.data["next"]
+        self.assertEqual(titles, [f"Reply {i}" for i in range(4, -1, -1)])
+
+        response = self.client.get(self.url, {"cursor": "garbage"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_large_thread_in_one_query(self):
+        """A large thread's first page should cost one query plus tags"""
+        ZettleCard.objects.bulk_create(
+            ZettleCard(title=f"Bulk {i}", reply_to=self.replies[i % 5], votes=i)
+            for i in range(500)
+        )
+        # Thread and tags.
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url, {"limit": 10})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data["replies"]), 5)
+        self.assertEqual(len(response.data["replies"][0]["replies"]), 10)
+        self.assertIsNotNone(response.data["replies"][0]["next"])
+
+    def test_cut_branches_are_not_read(self):
+        """The query should stop at the limit per branch instead of pruning later"""
+        ZettleCard.objects.bulk_create(
+            ZettleCard(title=f"Deep {i}", reply_to=reply)
+            for reply in self.replies
+            for i in range(5)
+        )
+        raw = ZettleCard.objects.raw
+        rows = []
+        with mock.patch.object(
+            ZettleCard.objects,
+            "raw",
+            side_effect=lambda *args: rows.extend(raw(*args)) or rows,
+        ):
+            root = fetch_thread(self.root.uuid, sort="top", limit=2)
+
+        # The root, two replies with two of theirs each, and a spare per branch.
+        self.assertEqual(len(rows), 1 + 3 + 2 * 3)
+        self.assertEqual(
+            [reply.title for reply in root.thread_replies], ["Reply 4", "Reply 3"]
+        )
+        self.assertTrue(root.thread_has_more)
+        self.assertTrue(root.thread_replies[0].thread_has_more)
+
+
+class VoteTests(APITestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.card = ZettleCard.objects.create(title="Trending", x=10, y=10)
+        self.url = reverse("zettle:zettlecard-vote", kwargs={"uuid": self.card.uuid})
+        self.client.force_authenticate(self.user)
+
+    def assertVotes(self, votes):
+        self.card.refresh_from_db()
+        self.assertEqual(self.card.votes, votes)
+        self.assertEqual(self.card.hot_score, hot_score(votes, self.card.created_at))
+
+    def test_votes_are_idempotent(self):
+        """Voting twice should count once, and switching sides should move by two"""
+        response = self.client.post(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["votes"], 2)
+        self.client.post(self.url, {"value": 1})
+        self.assertVotes(2)
+
+        response = self.client.post(self.url, {"value": -1})
+        self.assertEqual(response.data["votes"], 0)
+        self.assertVotes(0)
+
+        self.client.delete(self.url)
+        self.client.delete(self.url)
+        self.assertVotes(1)
+        self.assertFalse(Vote.objects.exists())
+
+    def test_rejects_bodies_that_are_not_objects(self):
+        """A vote whose body is a list or a scalar should be refused"""
+        for body in [[1], 1, "up"]:
+            # The view runs outside the request transaction, so DRF's rollback
+            # on errors would otherwise hit the test's own atomic block.
+            with self.subTest(body=body), transaction.atomic():
+                response = self.client.post(self.url, body, format="json")
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertIn("non_field_errors", response.data)
+        self.assertVotes(1)
+
+    def test_votes_from_many_users(self):
+        """Every user should get their own vote"""
+        for user in UserFactory.create_batch(3):
+            self.client.force_authenticate(user)
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(self.url)
+        self.assertVotes(4)
+        self.assertEqual(ZettleTile.objects.first().top_cards[0]["votes"], 4)
+
+    def test_stale_save_keeps_votes(self):
+        """Saving a card loaded before a vote should not undo the vote"""
+        stale = ZettleCard.objects.get(pk=self.card.pk)
+        self.client.post(self.url)
+        stale.title = "Renamed"
+        stale.save()
+        self.assertVotes(2)
+
+    # An error response rolls back the test case's own transaction, since the
+    # vote view runs outside a request transaction; so one error per test.
+    def test_rejects_bad_values(self):
+        """Should reject values other than 1 and -1"""
+        response = self.client.post(self.url, {"value": 5})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_rejects_anonymous_voters(self):
+        """Should require an authenticated user"""
+        self.client.force_authenticate(None)
+        response = self.client.post(self.url)
+        self.assertIn(
+            response.status_code,
+            [status.HTTP_401_UNAUTHORIZED, status.HTTP_403_FORBIDDEN],
+        )
+
+    def test_vote_runs_outside_the_request_transaction(self):
+        """The card row should only be locked while the vote is recorded"""
+        match = resolve(self.url)
+        self.assertIn("default", getattr(match.func, "_non_atomic_requests", set()))
+
+
+class BulkMoveTests(APITestCase):
+    def setUp(self):
+        self.url = reverse("zettle:zettlecard-move")
+        self.cards = [
+            ZettleCard.objects.create(title=f"Card {i}", x=100 * i, y=100)
+            for i in range(3)
+        ]
+        self.unplaced = ZettleCard.objects.create(title="Unplaced")
+
+    def assertTilesMatchRebuild(self):
+        tiles = list(
+            ZettleTile.objects.values_list("level", "tile_x", "tile_y", "card_count")
+        )
+        rebuild_tiles()
+        rebuilt = ZettleTile.objects.values_list(
+            "level", "tile_x", "tile_y", "card_count"
+        )
+        self.assertCountEqual(tiles, rebuilt)
+
+    def test_move_to_positions(self):
+        """Should move every listed card with one bulk update"""
+        moves = [
+            {"uuid": str(card.uuid), "x": 5000 + i, "y": -5000}
+            for i, card in enumerate(self.cards)
+        ]
+        response = self.client.post(self.url, moves)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 3)
+        for i, card in enumerate(self.cards):
+            card.refresh_from_db()
+            self.assertEqual((card.x, card.y), (5000 + i, -5000))
+            self.assertEqual((card.grid_x, card.grid_y), (9, -10))
+        self.assertTilesMatchRebuild()
+
+    def test_move_by_offset(self):
+        """Should shift a selection, leaving unplaced cards alone"""
+        uuids = [str(card.uuid) for card in [*self.cards, self.unplaced]]
+        response = self.client.post(self.url, {"uuids": uuids, "dx": 10, "dy": -20})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [(card["x"], card["y"]) for card in response.data],
+            [(10, 80), (110, 80), (210, 80), (None, None)],
+        )
+        self.assertTilesMatchRebuild()
+
+    def test_too_many_moves_are_rejected_up_front(self):
+        """Should reject too long a list before validating its items"""
+        moves = [{"uuid": "bogus"}] * 3
+        with mock.patch("backend.zettle.views.MAX_MOVED_CARDS", 2):
+            response = self.client.post(self.url, moves)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            response.data["non_field_errors"],
+            ["Ensure this field has no more than 2 elements."],
+        )
+
+    def card_updates(self, data):
+        """The UPDATEs of the card table made to move cards as ``data`` says."""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url, data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [
+            query
+            for query in queries
+            if query["sql"].startswith('UPDATE "zettle_zettlecard"')
+        ]
+
+    def test_single_statement_shift(self):
+        """A shift should be written by one UPDATE, however many cards move"""
+        ZettleCard.objects.bulk_create(
+            ZettleCard(title=f"Bulk {i}", x=i, y=-i) for i in range(500)
+        )
+        uuids = [
+            str(uuid) for uuid in ZettleCard.objects.values_list("uuid", flat=True)
+        ]
+        updates = self.card_updates({"uuids": uuids, "dx": -600, "dy": 600})
+        self.assertEqual(len(updates), 1)
+        card = ZettleCard.objects.get(title="Bulk 499")
+        self.assertEqual((card.x, card.y), (-101, 101))
+        self.assertEqual((card.grid_x, card.grid_y), (-1, 0))
+        self.assertTilesMatchRebuild()
+
+    def test_positions_are_batched_by_the_database(self):
+        """Positions should take one UPDATE per batch the database allows"""
+        cards = ZettleCard.objects.bulk_create(
+            ZettleCard(title=f"Bulk {i}", x=i, y=i) for i in range(500)
+        )
+        updates = self.card_updates(
+            [{"uuid": str(card.uuid), "x": 1, "y": 1} for card in cards]
+        )
+        batch_size = connection.ops.bulk_batch_size(["pk", *MOVED_FIELDS], cards)
+        self.assertEqual(len(updates), -(-len(cards) // batch_size))
+
+    def test_positions_off_the_canvas_are_rejected(self):
+        """Should reject positions and shifts the columns can't hold"""
+        uuid = str(self.cards[1].uuid)
+        for data in [
+            [{"uuid": uuid, "x": 10**19, "y": 1}],
+            [{"uuid": uuid, "x": 1, "y": 2**31}],
+            {"uuids": [uuid], "dx": 2**32, "dy": 0},
+            {"uuids": [uuid], "dx": 0, "dy": 2**31 - 1},
+        ]:
+            with self.subTest(data=data):
+                response = self.client.post(self.url, data)
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.cards[1].refresh_from_db()
+        self.assertEqual((self.cards[1].x, self.cards[1].y), (100, 100))
+
+    def test_unknown_cards_are_rejected(self):
+        """Should reject moves naming unknown cards without moving anything"""
+        moves = [
+            {"uuid": str(self.cards[0].uuid), "x": 1, "y": 1},
+            {"uuid": "00000000-0000-0000-0000-000000000000", "x": 1, "y": 1},
+        ]
+        response = self.client.post(self.url, moves)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.cards[0].refresh_from_db()
+        self.assertEqual(self.cards[0].x, 0)
+
+
+@mock.patch.object(CardPagination, "page_size", 10)
+class KeysetPaginationTests(APITestCase):
+    def setUp(self):
+        now = timezone.now()
+        ZettleCard.objects.bulk_create(
+            ZettleCard(
+                title=f"Card {i:02}",
+                votes=i % 3,
+                created_at=now - timedelta(minutes=i // 2),
+            )
+            for i in range(25)
+        )
+        self.list_url = reverse("zettle:zettlecard-list")
+
+    def walk(self, **params):
+        titles = []
+        response = self.client.get(self.list_url, {"cursor": "", **params})
+        while True:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn("count", response.data)
+            titles += [card["title"] for card in response.data["results"]]
+            if response.data["next"] is None:
+                return titles
+            # The two version lookups for the ETag, one seek and tags.
+            with self.assertNumQueries(4):
+                response = self.client.get(response.data["next"])
+
+    def test_keyset_pages_follow_the_ordering(self):
+        """Every card should appear once, in order, for each keyset ordering"""
+        for ordering in ["-created_at", "created_at", "votes", "-votes", "title"]:
+            with self.subTest(ordering=ordering):
+                titles = self.walk(ordering=ordering)
+                expected = ZettleCard.objects.order_by(
+                    ordering, f"{'-' if ordering.startswith('-') else ''}id"
+                )
+                self.assertEqual(titles, [card.title for card in expected])
+
+    def test_page_numbers_remain_the_default(self):
+        """Requests without a cursor should keep page numbers and the count"""
+        response = self.client.get(self.list_url, {"page": 2})
+        self.assertEqual(response.data["count"], 25)
+        self.assertEqual(len(response.data["results"]), 10)
+
+    def test_invalid_cursor(self):
+        """A malformed cursor should be a 404, like an out of range page"""
+        response = self.client.get(self.list_url, {"cursor": "nonsense"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_cursor_seeks_into_the_index(self):
+        """A deep page should seek into the (field, id) index, not scan up to it"""
+        cursor = base64.urlsafe_b64encode(b"[1, 5]").decode()
+        request = Request(
+            APIRequestFactory().get("/", {"cursor": cursor, "ordering": "votes"})
+        )
+        page = KeysetPagination().page_queryset(ZettleCard.objects.all(), request)
+        if connection.vendor == "sqlite":
+            self.assertIn("SEARCH zettle_zettlecard USING INDEX", page.explain())
+        self.assertIn('"votes" >= 1', str(page.query))
+
+    def test_cursor_of_the_wrong_type(self):
+        """A cursor whose value doesn't fit the ordering field should be a 404"""
+        for cursor, ordering in [
+            (["abc", 1], "votes"),
+            ([2**70, 1], "votes"),
+            (["abc", 1], "-created_at"),
+        ]:
+            payload = base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+            for url in [self.list_url, reverse("zettle:async-card-list")]:
+                # DRF rolls back the innermost atomic block on errors, which
+                # would otherwise be the test's own.
+                with self.subTest(cursor=cursor, url=url), transaction.atomic():
+                    response = self.client.get(
+                        url, {"cursor": payload, "ordering": ordering}
+                    )
+                    self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class SyncTests(APITestCase):
+    def setUp(self):
+        self.changes_url = reverse("zettle:zettlecard-changes")
+        self.list_url = reverse("zettle:zettlecard-list")
+        self.card = ZettleCard.objects.create(title="Kept")
+        self.doomed = ZettleCard.objects.create(title="Doomed", parent=self.card)
+        response = self.client.get(self.changes_url)
+        self.assertEqual(len(response.data["cards"]), 2)
+
+    def age(self, seconds):
+        """Pretend everything so far happened ``seconds`` ago."""
+        past = timezone.now() - timedelta(seconds=seconds)
+        ZettleCard.objects.update(updated_at=past)
+        CardTombstone.objects.update(deleted_at=past)
+        return encode_token(past + timedelta(microseconds=1))
+
+    def test_changes_since_token(self):
+        """Only cards changed since the token, and deleted uuids, should be sent"""
+        ZettleCard.objects.create(title="Reply", reply_to=self.doomed)
+        token = self.age(60)
+        ZettleCard.objects.create(title="Fresh")
+        doomed_uuid = self.doomed.uuid
+        self.doomed.delete()
+
+        response = self.client.get(self.changes_url, {"since": token})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # The reply lost its reply_to link when its target was deleted, and
+        # the parent its child.
+        self.assertEqual(
+            {card["title"] for card in response.data["cards"]},
+            {"Fresh", "Reply", "Kept"},
+        )
+        self.assertEqual(response.data["deleted"], [doomed_uuid])
+        self.assertFalse(response.data["more"])
+
+    def test_tag_changes_touch_both_cards(self):
+        """Tagging should report both ends of the symmetrical link"""
+        token = self.age(60)
+        self.card.tags.add(self.doomed)
+        response = self.client.get(self.changes_url, {"since": token})
+        self.assertEqual(len(response.data["cards"]), 2)
+
+    def test_changes_are_paged(self):
+        """A large backlog should come in several pages that resume exactly"""
+        token = self.age(60)
+        ZettleCard.objects.bulk_create(ZettleCard(title=f"Bulk {i}") for i in range(7))
+        titles = []
+        more = True
+        while more:
+            response = self.client.get(self.changes_url, {"since": token, "limit": 3})
+            titles += [card["title"] for card in response.data["cards"]]
+            token, more = response.data["next"], response.data["more"]
+        self.assertCountEqual(titles, [f"Bulk {i}" for i in range(7)])
+
+    def test_changes_refuse_list_filters(self):
+        """Filtered syncs would miss cards leaving the filter, so are refused"""
+        token = self.age(60)
+        for params in [{"bbox": "0,0,10,10"}, {"search": "kept"}, {"title": "K"}]:
+            with self.subTest(params=params), transaction.atomic():
+                response = self.client.get(self.changes_url, {"since": token, **params})
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertEqual(list(response.data), list(params))
+
+    def test_changes_seek_into_the_index(self):
+        """The feed should start at the token in the updated_at index"""
+        token = self.age(60)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.changes_url, {"since": token})
+        self.assertTrue(
+            any('"updated_at" >= ' in query["sql"] for query in queries),
+        )
+
+    def test_bad_and_expired_tokens(self):
+        """Malformed tokens are rejected, and expired ones ask for a full sync"""
+        naive = base64.urlsafe_b64encode(b'["2024-01-01T00:00:00", 0]').decode()
+        with self.assertRaises(ValueError):
+            decode_token(naive)
+        response = self.client.get(self.changes_url, {"since": "garbage"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        expired = encode_token(timezone.now() - timedelta(days=365))
+        response = self.client.get(self.changes_url, {"since": expired})
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+
+    def test_conditional_get(self):
+        """Unchanged lists and cards should answer 304 Not Modified"""
+        detail_url = reverse(
+            "zettle:zettlecard-detail", kwargs={"uuid": self.card.uuid}
+        )
+        for url in [self.list_url, detail_url]:
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                etag = response["ETag"]
+                self.assertIn("Last-Modified", response)
+
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+                self.card.title = f"Changed for {url}"
+                self.card.save()
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_list_etag_changes_on_delete(self):
+        """Deleting a card should invalidate cached lists"""
+        etag = self.client.get(self.list_url)["ETag"]
+        self.doomed.delete()
+        response = self.client.get(self.list_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class SparseFieldsTests(APITestCase):
+    def setUp(self):
+        self.list_url = reverse("zettle:zettlecard-list")
+        tag = ZettleCard.objects.create(title="Tag", x=0, y=0)
+        for i in range(3):
+            card = ZettleCard.objects.create(
+                title=f"Card {i}", text="Long text", x=i, y=i
+            )
+            card.tags.add(tag)
+
+    def test_fields_and_omit(self):
+        """Responses should only carry the requested fields"""
+        response = self.client.get(self.list_url, {"fields": "uuid,title,bogus"})
+        self.assertEqual(set(response.data["results"][0]), {"uuid", "title"})
+
+        response = self.client.get(self.list_url, {"omit": "text,tags"})
+        card = response.data["results"][0]
+        self.assertNotIn("text", card)
+        self.assertNotIn("tags", card)
+        self.assertIn("x", card)
+
+    def test_sparse_lists_skip_unused_columns(self):
+        """Unrequested columns and relations should not be loaded"""
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.list_url, {"fields": "uuid,x,y"})
+        sql = "\n".join(query["sql"] for query in queries)
+        self.assertNotIn('"text"', sql)
+        self.assertNotIn("zettle_zettlecard_tags", sql)
+
+    def test_fields_do_not_limit_writes(self):
+        """Writes should accept and return every field"""
+        card = ZettleCard.objects.get(title="Card 0")
+        url = reverse("zettle:zettlecard-detail", kwargs={"uuid": card.uuid})
+        response = self.client.patch(f"{url}?fields=uuid", {"text": "Edited"})
+        self.assertEqual(response.data["text"], "Edited")
+
+    def test_canvas_projection(self):
+        """The canvas view should return plain rows of the canvas fields"""
+        response = self.client.get(
+            self.list_url, {"view": "canvas", "ordering": "title"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.data["results"][0],
+            {
+                "uuid": ZettleCard.objects.get(title="Card 0").uuid,
+                "card_type": "text",
+                "title": "Card 0",
+                "x": 0,
+                "y": 0,
+            },
+        )
+
+        response = self.client.get(
+            self.list_url, {"view": "canvas", "cursor": "", "page_size": 2}
+        )
+        self.assertEqual(len(response.data["results"]), 2)
+        response = self.client.get(response.data["next"])
+        self.assertEqual(len(response.data["results"]), 2)
+        self.assertIsNone(response.data["next"])
+
+    def test_fast_renderer_matches_stock_output(self):
+        """orjson output should be byte for byte what DRF would render"""
+        response = self.client.get(self.list_url)
+        data = {**response.data, "misc": {1: "\u2028", "when": timezone.now()}}
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+
+class FragmentCacheTests(APITestCase):
+    def setUp(self):
+        # A fresh cache per test, so entries and stats don't leak between them.
+        get_fragment_cache.cache_clear()
+        self.fragments = get_fragment_cache()
+        self.parent = ZettleCard.objects.create(title="Parent")
+        self.card = ZettleCard.objects.create(title="Card", parent=self.parent)
+        # Its child count was stored with a queryset update.
+        self.parent.refresh_from_db()
+
+    def cached(self, card):
+        card.refresh_from_db()
+        return self.fragments.get(fragment_key(card)) is not None
+
+    def test_lru_evicts_by_size(self):
+        """The least recently used entries should go once over the size limit"""
+        lru = LocMemFragmentCache(max_bytes=10)
+        lru.set("a:1", "aaaa")
+        lru.set("b:1", "bbbb")
+        lru.get("a:1")
+        lru.set("c:1", "cccc")
+        self.assertIsNone(lru.get("b:1"))
+        self.assertEqual(lru.get("a:1"), "aaaa")
+        self.assertEqual(lru.size, 8)
+        lru.invalidate(["a"])
+        self.assertIsNone(lru.get("a:1"))
+        stats = lru.stats()
+        self.assertEqual((stats["evictions"], stats["invalidations"]), (1, 1))
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 2))
+
+    def test_file_backend(self):
+        """The file backend should store, serve and drop fragments per card"""
+        with tempfile.TemporaryDirectory() as location:
+            files = FileFragmentCache(location)
+            files.set("a:1", "<p>a</p>")
+            self.assertEqual(files.get("a:1"), "<p>a</p>")
+            files.invalidate(["a"])
+            self.assertIsNone(files.get("a:1"))
+
+    def test_file_writes_survive_invalidation(self):
+        """A write racing an invalidation of its card should retry, not fail"""
+        mkstemp = tempfile.mkstemp
+
+        def invalidate_first(*args, **kwargs):
+            if not invalidated:
+                invalidated.append(True)
+                files.invalidate(["a"])
+            return mkstemp(*args, **kwargs)
+
+        invalidated = []
+        with tempfile.TemporaryDirectory() as location:
+            files = FileFragmentCache(location)
+            with mock.patch("tempfile.mkstemp", side_effect=invalidate_first):
+                files.set("a:1", "<p>a</p>")
+            self.assertEqual(files.get("a:1"), "<p>a</p>")
+
+    def test_keys_follow_parent_and_tags(self):
+        """Changes to the parent or tags should miss even without invalidation"""
+        tag = ZettleCard.objects.create(title="Tag")
+        self.card.tags.add(tag)
+        self.card.refresh_from_db()
+        render_card(self.card)
+        self.assertTrue(self.cached(self.card))
+
+        # As if written by another process, whose invalidation never got here.
+        for card in [self.parent, tag]:
+            key = fragment_key(ZettleCard.objects.get(pk=self.card.pk))
+            ZettleCard.objects.filter(pk=card.pk).update(
+                updated_at=timezone.now() + timedelta(seconds=1)
+            )
+            self.assertNotEqual(
+                fragment_key(ZettleCard.objects.get(pk=self.card.pk)), key
+            )
+        self.assertFalse(self.cached(self.card))
+
+    def test_render_card_is_cached(self):
+        """A second render should be a cache hit"""
+        render_card(self.card)
+        render_card(self.card)
+        stats = self.fragments.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+    def test_changes_invalidate_fragments(self):
+        """Saving a card, adding a child or tagging should drop stale renderings"""
+        for card in [self.parent, self.card]:
+            render_card(card)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ZettleCard.objects.create(title="Child", parent=self.card)
+        self.assertFalse(self.cached(self.card))
+        self.assertTrue(self.cached(self.parent))
+
+        render_card(self.card)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.parent.tags.add(self.card)
+        self.assertFalse(self.cached(self.card))
+        self.assertFalse(self.cached(self.parent))
+
+    def test_fragments_endpoint(self):
+        """The fragments endpoint should serve rendered HTML per card"""
+        response = self.client.get(reverse("zettle:zettlecard-fragments"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            {card["uuid"] for card in response.data["results"]},
+            {self.parent.uuid, self.card.uuid},
+        )
+        self.assertEqual(self.fragments.stats()["misses"], 2)
+
+
+SHARED_CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "cards": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "cards",
+    },
+}
+
+
+class CardCacheTests(APITestCase):
+    def setUp(self):
+        # A fresh cache per test, so entries and stats don't leak between them.
+        get_card_cache.cache_clear()
+        self.cards = get_card_cache()
+        self.tag = ZettleCard.objects.create(title="Tag")
+        self.card = ZettleCard.objects.create(title="Card", parent=self.tag)
+        self.card.tags.add(self.tag)
+
+    def detail(self, card, **params):
+        url = reverse("zettle:zettlecard-detail", args=[card.uuid])
+        return self.client.get(url, params)
+
+    def loader(self, pk, payload, calls, delay=0):
+        def load():
+            calls.append(pk)
+            time.sleep(delay)
+            return pk, payload
+
+        return load
+
+    def test_detail_reads_are_cached(self):
+        """A second detail read should be served without queries"""
+        first = self.detail(self.card)
+        with self.assertNumQueries(0):
+            second = self.detail(self.card)
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second["ETag"], first["ETag"])
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                reverse("zettle:zettlecard-detail", args=[self.card.uuid]),
+                headers={"If-None-Match": first["ETag"]},
+            )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # Sparse reads aren't cached, but revalidate against the same ETag.
+        sparse = self.detail(self.card, fields="title")
+        self.assertEqual(sparse.json(), {"title": "Card"})
+        self.assertEqual(sparse["ETag"], first["ETag"])
+        stats = self.cards.stats()
+        self.assertEqual((stats["local_hits"], stats["misses"]), (2, 1))
+        self.assertEqual(stats["hit_rate"], 2 / 3)
+
+        self.assertEqual(self.detail(ZettleCard(uuid=uuid4())).status_code, 404)
+        self.assertEqual(self.cards.stats()["entries"], 1)
+
+    def test_writes_invalidate(self):
+        """Saves, tag changes, moves, votes and deletes should drop cached cards"""
+        self.detail(self.card)
+        self.detail(self.tag)
+        self.client.force_authenticate(UserFactory())
+
+        url = reverse("zettle:zettlecard-detail", args=[self.card.uuid])
+        self.client.patch(url, {"title": "Renamed"})
+        self.assertEqual(self.detail(self.card).data["title"], "Renamed")
+
+        self.card.tags.remove(self.tag)
+        self.assertEqual(self.detail(self.card).data["tags"], [])
+        self.assertEqual(self.detail(self.tag).data["tag_count"], 0)
+
+        move_cards({self.card.uuid: (10, 20)})
+        self.assertEqual(self.detail(self.card).data["x"], 10)
+
+        self.card.add_votes(2)
+        self.assertEqual(self.detail(self.card).data["votes"], self.card.votes)
+
+        self.assertEqual(self.detail(self.tag).data["child_count"], 1)
+        self.tag.delete()
+        self.assertIsNone(self.detail(self.card).data["parent"])
+        self.assertEqual(self.detail(self.tag).status_code, 404)
+
+    def test_reference_changes_invalidate(self):
+        """Renaming or deleting a referenced card or user should drop its cards"""
+        user = UserFactory(username="ada")
+        to_card, to_user = (
+            ZettleCard.objects.create(
+                title=f"To {target}",
+                card_type=ZettleCard.CardType.MODEL,
+                content_object=target,
+            )
+            for target in [self.tag, user]
+        )
+        self.assertEqual(
+            self.detail(to_card).data["reference"]["label"], "Tag (Text Card)"
+        )
+        self.assertEqual(self.detail(to_user).data["reference"]["label"], "ada")
+
+        self.tag.title = "Renamed"
+        self.tag.save()
+        user.username = "lovelace"
+        user.save()
+        self.assertEqual(
+            self.detail(to_card).data["reference"]["label"], "Renamed (Text Card)"
+        )
+        self.assertEqual(self.detail(to_user).data["reference"]["label"], "lovelace")
+
+        self.tag.delete()
+        user.delete()
+        self.assertIsNone(self.detail(to_card).data["reference"])
+        self.assertIsNone(self.detail(to_user).data["reference"])
+
+    def test_concurrent_misses_load_once(self):
+        """Requests for a card being loaded should wait for that load"""
+        cards = CardCache()
+        calls = []
+        load = self.loader(1, {"title": "Hot"}, calls, delay=0.2)
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(cards.get_or_load("a", "o", load))
+            )
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, [{"title": "Hot"}] * 8)
+        stats = cards.stats()
+        self.assertEqual((stats["coalesced"], stats["misses"]), (7, 1))
+
+    def test_loads_racing_invalidations_are_not_stored(self):
+        """A load that overlaps an invalidation should be served but not cached"""
+        cards = CardCache()
+
+        def load():
+            cards.invalidate(card_ids=[1])
+            return 1, {"title": "Old"}
+
+        self.assertEqual(cards.get_or_load("a", "o", load), {"title": "Old"})
+        calls = []
+        cards.get_or_load("a", "o", self.loader(1, {"title": "New"}, calls))
+        self.assertEqual(calls, [1])
+
+    def test_lru_evicts_by_size(self):
+        """The least recently used cards should go once over the size limit"""
+        cards = CardCache(max_bytes=50)
+        calls = []
+        for uuid, pk in [("a", 1), ("b", 2), ("a", 1), ("c", 3), ("b", 2)]:
+            cards.get_or_load(uuid, "o", self.loader(pk, {"text": "x" * 10}, calls))
+        self.assertEqual(calls, [1, 2, 3, 2])
+        self.assertEqual(cards.size, 42)
+        self.assertEqual(cards.stats()["evictions"], 2)
+
+        # Other origins have their own URLs, so they miss.
+        cards.get_or_load("b", "other", self.loader(2, {}, calls))
+        self.assertEqual(calls, [1, 2, 3, 2, 2])
+
+    @override_settings(CACHES=SHARED_CACHES)
+    def test_shared_tier(self):
+        """Loads in one process should serve another until invalidated"""
+        first = CardCache(shared="cards")
+        second = CardCache(shared="cards", local_timeout=0)
+        calls = []
+        first.get_or_load("a", "o", self.loader(1, {"title": "A"}, calls))
+        second.get_or_load("a", "o", self.loader(1, {"title": "A"}, calls))
+        self.assertEqual(calls, [1])
+        self.assertEqual(second.stats()["shared_hits"], 1)
+
+        first.invalidate(card_ids=[1])
+        second.get_or_load("a", "o", self.loader(1, {"title": "B"}, calls))
+        self.assertEqual(calls, [1, 1])
+        self.assertEqual(
+            first.get_or_load("a", "o", self.loader(1, {}, calls)), {"title": "B"}
+        )
+
+        first.clear()
+        second.get_or_load("a", "o", self.loader(1, {"title": "C"}, calls))
+        self.assertEqual(calls, [1, 1, 1])
+
+    def test_stats_endpoint(self):
+        """Admins should see this process's hit rate"""
+        self.detail(self.card)
+        self.detail(self.card)
+        url = reverse("zettle:zettlecard-card-cache-stats")
+        self.client.force_authenticate(UserFactory(is_staff=True))
+        self.assertEqual(self.client.get(url).data["hit_rate"], 0.5)
+        self.client.force_authenticate(UserFactory())
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_tags_are_validated_in_one_query(self):
+        """Should look up any number of tags at once, and reject unknown ones"""
+        self.client.force_authenticate(UserFactory())
+        url = reverse("zettle:zettlecard-list")
+        tags = [ZettleCard.objects.create(title=f"Tag {i}").pk for i in range(5)]
+        queries = []
+        for tag_ids in [tags[:1], tags]:
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.post(url, {"title": "New", "tags": tag_ids})
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(sorted(response.data["tags"]), tag_ids)
+            queries.append(len(context.captured_queries))
+        self.assertEqual(queries[0], queries[1])
+
+        for tag_ids, error in [
+            ([tags[0], 0], 'Invalid pk "0" - object does not exist.'),
+            (["x"], "Incorrect type. Expected pk value, received str."),
+            ("x", 'Expected a list of items but got type "str".'),
+        ]:
+            response = self.client.post(url, {"title": "New", "tags": tag_ids})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(response.data["tags"], [error])
+
+
+class ThumbnailTests(APITestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings = self.settings(MEDIA_ROOT=media_root.name, ZETTLE_THUMBNAIL_WORKERS=0)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def upload(self, width, height, mode="RGB", name="shot.png"):
+        buffer = BytesIO()
+        Image.new(mode, (width, height)).save(buffer, "PNG")
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type="image/png")
+
+    def create_card(self, image):
+        with self.captureOnCommitCallbacks(execute=True):
+            card = ZettleCard.objects.create(card_type="image", image=image)
+        card.refresh_from_db()
+        return card
+
+    def test_thumbnails_on_upload(self):
+        """An upload should get WebP and JPEG copies at each width it can fill"""
+        card = self.create_card(self.upload(1200, 600))
+        self.assertEqual(set(card.thumbnails), {"webp", "jpg"})
+        self.assertEqual(list(card.thumbnails["webp"]), ["256", "512", "1024"])
+        name = card.thumbnails["jpg"]["512"]
+        self.assertEqual(name, f"{thumbnail_dir(card.image.name)}/512.jpg")
+        with default_storage.open(name) as f, Image.open(f) as thumbnail:
+            self.assertEqual(thumbnail.size, (512, 256))
+
+    def test_transparent_fallback_is_png(self):
+        """Transparent images should fall back to PNG rather than JPEG"""
+        card = self.create_card(self.upload(300, 300, mode="RGBA"))
+        self.assertEqual(
+            card.thumbnails["png"], {"256": f"{thumbnail_dir(card.image.name)}/256.png"}
+        )
+
+    def test_replacing_the_image(self):
+        """A new image should replace the thumbnails of the old one"""
+        card = self.create_card(self.upload(600, 600))
+        with self.captureOnCommitCallbacks(execute=True):
+            card.image = self.upload(300, 300, name="other.png")
+            card.save()
+        card.refresh_from_db()
+        self.assertEqual(
+            card.thumbnails["webp"],
+            {"256": f"{thumbnail_dir(card.image.name)}/256.webp"},
+        )
+
+    def test_shared_image_shares_thumbnails(self):
+        """Cards with the same image should reuse its thumbnails"""
+        card = self.create_card(self.upload(600, 300))
+        with mock.patch("backend.zettle.thumbnails.render_thumbnails") as render:
+            other = self.create_card(self.upload(600, 300, name="copy.png"))
+        render.assert_not_called()
+        self.assertEqual(other.image.name, card.image.name)
+        self.assertEqual(other.thumbnails, card.thumbnails)
+
+    def test_serializer_srcset(self):
+        """The API should list each format's thumbnails as a srcset"""
+        card = self.create_card(self.upload(600, 300))
+        url = reverse("zettle:zettlecard-detail", kwargs={"uuid": card.uuid})
+        response = self.client.get(url)
+        directory = f"http://testserver/media/{thumbnail_dir(card.image.name)}"
+        self.assertEqual(
+            response.data["thumbnails"]["webp"],
+            f"{directory}/256.webp 256w, {directory}/512.webp 512w",
+        )
+
+    def test_backfill_command(self):
+        """The command should only fill in cards that have no thumbnails"""
+        card = self.create_card(self.upload(600, 300))
+        ZettleCard.objects.filter(pk=card.pk).update(thumbnails={})
+        out = StringIO()
+        call_command("generate_thumbnails", "--workers", "1", stdout=out)
+        self.assertIn("Generated thumbnails for 1 of 1 cards", out.getvalue())
+        card.refresh_from_db()
+        self.assertEqual(list(card.thumbnails["jpg"]), ["256", "512"])
+
+    def test_regenerate_all(self):
+        """The command's --all should re-render thumbnails, shared ones included"""
+        card = self.create_card(self.upload(600, 300))
+        other = self.create_card(self.upload(600, 300, name="copy.png"))
+        with mock.patch("backend.zettle.thumbnails.THUMBNAIL_WIDTHS", [128, 256]):
+            call_command(
+                "generate_thumbnails", "--all", "--workers", "1", stdout=StringIO()
+            )
+        directory = thumbnail_dir(card.image.name)
+        for shared in [card, other]:
+            shared.refresh_from_db()
+            self.assertEqual(
+                shared.thumbnails["webp"],
+                {"128": f"{directory}/128.webp", "256": f"{directory}/256.webp"},
+            )
+        with default_storage.open(f"{directory}/128.jpg") as f, Image.open(f) as image:
+            self.assertEqual(image.size, (128, 64))
+
+
+class BlobStorageTests(APITestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings = self.settings(MEDIA_ROOT=media_root.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.user = UserFactory()
+        self.client.force_authenticate(self.user)
+
+    def create_card(self, content, name="notes.pdf"):
+        return ZettleCard.objects.create(document=SimpleUploadedFile(name, content))
+
+    def test_same_content_is_stored_once(self):
+        """Cards with the same file content should share one reference-counted blob"""
+        first = self.create_card(b"%PDF same")
+        second = self.create_card(b"%PDF same", name="copy.PDF")
+        other = self.create_card(b"%PDF other")
+        self.assertEqual(first.document.name, second.document.name)
+        self.assertNotEqual(first.document.name, other.document.name)
+        self.assertTrue(first.document.name.startswith("blobs/"))
+        blob = Blob.objects.get(name=first.document.name)
+        self.assertEqual((blob.ref_count, blob.size), (2, 9))
+        self.assertEqual(blob.sha256, hashlib.sha256(b"%PDF same").hexdigest())
+
+        first.delete()
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 1)
+
+    def test_collect_unreferenced_blobs(self):
+        """Unreferenced blobs past the grace period should be deleted"""
+        card = self.create_card(b"%PDF gone")
+        kept = self.create_card(b"%PDF kept")
+        name = card.document.name
+        card.document = None
+        card.save()
+        self.assertEqual(collect_blobs(), 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(collect_blobs(grace=timedelta(0)), 1)
+        self.assertFalse(default_storage.exists(name))
+        self.assertTrue(default_storage.exists(kept.document.name))
+
+    def test_recount_references(self):
+        """Recounting should fix drifted reference counts"""
+        card = self.create_card(b"%PDF counted")
+        Blob.objects.update(ref_count=5)
+        self.assertEqual(count_references(), 1)
+        self.assertEqual(Blob.objects.get(name=card.document.name).ref_count, 1)
+
+    def test_create_card_from_known_blob(self):
+        """A card should be creatable from the hash of a stored file"""
+        card = self.create_card(b"%PDF known")
+        blob = Blob.objects.get()
+        response = self.client.post(
+            reverse("zettle:zettlecard-list"),
+            {"title": "Copy", "document_blob": blob.sha256},
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        copy = ZettleCard.objects.get(uuid=response.data["uuid"])
+        self.assertEqual(copy.document.name, card.document.name)
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 2)
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=10)
+    def test_multipart_upload_is_hashed_while_streamed(self):
+        """Uploads should be hashed as they are received, not read again"""
+        content = b"%PDF " + b"x" * 100
+        with mock.patch("backend.zettle.storage.file_sha256") as rehash:
+            response = self.client.post(
+                reverse("zettle:zettlecard-list"),
+                {"document": SimpleUploadedFile("big.pdf", content)},
+                format="multipart",
+            )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        rehash.assert_not_called()
+        self.assertEqual(Blob.objects.get().sha256, hashlib.sha256(content).hexdigest())
+
+    def test_resumable_upload(self):
+        """A file sent in chunks should become a blob once complete"""
+        content = b"%PDF resumable upload"
+        response = self.client.post(
+            reverse("zettle:upload-list"), {"filename": "long.pdf", "size": 21}
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        url = response["Location"]
+
+        for offset, chunk in [(0, content[:10]), (10, content[10:])]:
+            response = self.client.patch(
+                url,
+                chunk,
+                content_type="application/offset+octet-stream",
+                headers={"Upload-Offset": str(offset)},
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data["offset"], offset + len(chunk))
+        self.assertTrue(response.data["complete"])
+        self.assertEqual(response.data["sha256"], hashlib.sha256(content).hexdigest())
+        blob = Blob.objects.get()
+        self.assertEqual((blob.ref_count, blob.size), (0, 21))
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_resumable_upload_offset_mismatch(self):
+        """A chunk sent for the wrong offset should be refused with the current one"""
+        response = self.client.post(
+            reverse("zettle:upload-list"), {"filename": "long.pdf", "size": 21}
+        )
+        response = self.client.patch(
+            response["Location"],
+            b"%PDF",
+            content_type="application/offset+octet-stream",
+            headers={"Upload-Offset": "4"},
+        )
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data["offset"], 0)
+
+    def test_resumable_upload_checksum_mismatch(self):
+        """A finished upload that doesn't match its hash should be discarded"""
+        response = self.client.post(
+            reverse("zettle:upload-list"),
+            {"filename": "long.pdf", "size": 4, "sha256": "0" * 64},
+        )
+        response = self.client.patch(
+            response["Location"],
+            b"%PDF",
+            content_type="application/offset+octet-stream",
+            headers={"Upload-Offset": "0"},
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("sha256", response.data)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertFalse(Blob.objects.exists())
+
+    def test_unreferenced_blobs_wait_from_their_last_reference(self):
+        """The grace period should start when a blob loses its last reference"""
+        card = self.create_card(b"%PDF old")
+        Blob.objects.update(created_at=timezone.now() - timedelta(days=30))
+        card.document = None
+        card.save()
+        self.assertEqual(collect_blobs(), 0)
+
+        Blob.objects.update(unreferenced_since=timezone.now() - timedelta(days=2))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(collect_blobs(), 1)
+
+    def test_known_upload_is_instant(self):
+        """Starting an upload of a stored file should complete it at once"""
+        self.create_card(b"%PDF known")
+        sha256 = hashlib.sha256(b"%PDF known").hexdigest()
+        response = self.client.post(
+            reverse("zettle:upload-list"),
+            {"filename": "again.pdf", "size": 10, "sha256": sha256},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data["complete"])
+        self.assertFalse(UploadSession.objects.exists())
+
+
+class GardenTransferTests(APITestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        settings = self.settings(MEDIA_ROOT=media_root.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.author = UserFactory()
+        self.root = ZettleCard.objects.create(
+            title="Root", author=self.author, x=10, y=20
+        )
+        self.child = ZettleCard.objects.create(
+            title="Child", text="zettelkasten", parent=self.root
+        )
+        self.second = ZettleCard.objects.create(title="Second", parent=self.root)
+        place_cards(self.child, [self.second], at_end=True)
+        self.reply = ZettleCard.objects.create(title="Reply", reply_to=self.child)
+        self.root.tags.add(self.reply)
+        self.export_path = f"{self.directory.name}/garden.ndjson"
+
+    def export(self):
+        call_command("export_garden", self.export_path, stdout=StringIO())
+
+    def import_(self):
+        out = StringIO()
+        call_command("import_garden", self.export_path, "--batch-size", "2", stdout=out)
+        return out.getvalue()
+
+    def test_round_trip(self):
+        """An exported garden should import with its links, tags and indexes"""
+        originals = {
+            card.uuid: card
+            for card in ZettleCard.objects.all().prefetch_related("tags")
+        }
+        self.export()
+        ZettleCard.objects.all().delete()
+        ZettleTile.objects.all().delete()
+
+        self.assertIn("Imported 4 cards", self.import_())
+        cards = {
+            card.uuid: card
+            for card in ZettleCard.objects.all().prefetch_related("tags")
+        }
+        self.assertEqual(cards.keys(), originals.keys())
+        root = cards[self.root.uuid]
+        child, second, reply = (
+            cards[card.uuid] for card in [self.child, self.second, self.reply]
+        )
+        self.assertEqual(root.author, self.author)
+        self.assertEqual(root.created_at, self.root.created_at)
+        self.assertEqual((child.parent, second.parent), (root, root))
+        self.assertEqual(child.next, second)
+        self.assertEqual(
+            (child.sequence_id, second.sequence_key),
+            (
+                originals[self.child.uuid].sequence_id,
+                originals[self.second.uuid].sequence_key,
+            ),
+        )
+        self.assertEqual(reply.reply_to, child)
+        self.assertEqual(list(reply.tags.all()), [root])
+        self.assertEqual(child.path, f"{root.pk}/{child.pk}/")
+        self.assertEqual(ZettleTile.objects.get(level=0).card_count, 1)
+        self.assertEqual(
+            [hit[0] for hit in get_search_backend().search("zettelkasten", 10)],
+            [child.pk],
+        )
+
+    def test_existing_cards_are_skipped(self):
+        """Cards already in the garden should be left as they are"""
+        self.export()
+        self.assertIn("Imported 0 cards, skipped 4", self.import_())
+        self.assertEqual(ZettleCard.objects.count(), 4)
+
+    def test_media_archive(self):
+        """The media archive should restore card files on another instance"""
+        ZettleCard.objects.create(
+            title="Paper", document=SimpleUploadedFile("paper.pdf", b"%PDF paper")
+        )
+        media_path = f"{self.directory.name}/media.tar"
+        call_command(
+            "export_garden",
+            self.export_path,
+            "--media",
+            media_path,
+            stdout=StringIO(),
+            stderr=StringIO(),
+        )
+        ZettleCard.objects.all().delete()
+
+        with (
+            tempfile.TemporaryDirectory() as other_root,
+            self.settings(MEDIA_ROOT=other_root),
+        ):
+            call_command(
+                "import_garden",
+                self.export_path,
+                "--media",
+                media_path,
+                stdout=StringIO(),
+            )
+            paper = ZettleCard.objects.get(title="Paper")
+            with paper.document.open() as f:
+                self.assertEqual(f.read(), b"%PDF paper")
+            self.assertEqual(Blob.objects.get(name=paper.document.name).ref_count, 1)
+
+    def test_references_by_natural_key(self):
+        """Model cards should point to cards by uuid and users by username"""
+        for title, target in [
+            ("To card", self.child),
+            ("To user", self.author),
+            ("To tile", ZettleTile.objects.first()),
+        ]:
+            ZettleCard.objects.create(
+                title=title, card_type="model", content_object=target
+            )
+        self.export()
+        with open(self.export_path) as f:
+            lines = {card["title"]: card for card in map(json.loads, list(f)[1:])}
+        self.assertEqual(lines["To card"]["object"], str(self.child.uuid))
+        self.assertEqual(lines["To user"]["object"], self.author.username)
+        self.assertEqual(
+            (lines["To tile"]["content_type"], lines["To tile"]["object"]),
+            (None, None),
+        )
+        self.assertNotIn("object_id", lines["To card"])
+
+        ZettleCard.objects.all().delete()
+        self.import_()
+        cards = {card.title: card for card in ZettleCard.objects.all()}
+        self.assertEqual(cards["To card"].content_object, cards["Child"])
+        self.assertEqual(cards["To user"].content_object, self.author)
+        self.assertIsNone(cards["To tile"].content_type)
+
+    def test_rejects_other_files(self):
+        """Files without an export header should be refused"""
+        with open(self.export_path, "w") as f:
+            f.write('{"title": "Not an export"}\n')
+        with self.assertRaises(CommandError):
+            self.import_()
+
+    def test_rejects_malformed_cards(self):
+        """Card lines with a missing or mistyped field should be refused"""
+        self.export()
+        with open(self.export_path) as f:
+            header, card = f.readline(), json.loads(f.readline())
+        for broken in [
+            {key: value for key, value in card.items() if key != "uuid"},
+            {**card, "created_at": None},
+            {**card, "uuid": "not a uuid"},
+            {**card, "votes": "many"},
+            {**card, "votes": True},
+            {**card, "x": 10**12},
+            {**card, "title": ["Root"]},
+            {**card, "slug": "s" * 256},
+            {**card, "tags": "topic"},
+            {**card, "tags": [1, 2]},
+            {**card, "parent": {"uuid": card["uuid"]}},
+            {**card, "reply_to": ["not a uuid"]},
+            {**card, "next": "not a uuid"},
+            {**card, "sequence_id": 7},
+            ["not", "a", "card"],
+        ]:
+            with open(self.export_path, "w") as f:
+                f.write(header + json.dumps(broken) + "\n")
+            with self.subTest(broken=broken), self.assertRaises(CommandError):
+                self.import_()
+
+    def test_repeated_uuids_are_imported_once(self):
+        """A card repeated in the file should be created once, as first written"""
+        self.export()
+        with open(self.export_path) as f:
+            lines = f.readlines()
+        ZettleCard.objects.all().delete()
+        repeat = json.loads(lines[1])
+        repeat.update(title="Repeat", uuid=repeat["uuid"].upper())
+        with open(self.export_path, "w") as f:
+            f.writelines([*lines, json.dumps(repeat) + "\n"])
+
+        self.assertIn("Imported 4 cards, skipped 1", self.import_())
+        self.assertEqual(ZettleCard.objects.count(), 4)
+        self.assertEqual(ZettleCard.objects.get(uuid=repeat["uuid"]).title, "Root")
+
+    def test_endpoints(self):
+        """Staff should be able to export and import through the API"""
+        self.client.force_authenticate(UserFactory(is_staff=True))
+        response = self.client.get(reverse("zettle:zettlecard-export"))
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        export = b"".join(response.streaming_content)
+        self.assertEqual(len(export.splitlines()), 5)
+
+        self.reply.delete()
+        response = self.client.post(
+            reverse("zettle:zettlecard-import-garden"),
+            {"file": SimpleUploadedFile("garden.ndjson", export)},
+            format="multipart",
+        )
+        self.assertEqual(response.data, {"created": 1, "skipped": 3})
+        self.assertEqual(
+            ZettleCard.objects.get(uuid=self.reply.uuid).reply_to, self.child
+        )
+
+        header, card = export.splitlines()[:2]
+        broken = json.dumps({**json.loads(card), "tags": {"a": 1}}).encode()
+        response = self.client.post(
+            reverse("zettle:zettlecard-import-garden"),
+            {"file": SimpleUploadedFile("garden.ndjson", header + b"\n" + broken)},
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.data["file"], ["Line 2 needs a list of uuids as tags."]
+        )
+
+
+class GardenGeneratorTests(APITestCase):
+    def generate(self, seed=7):
+        call_command(
+            "generate_garden",
+            "--cards",
+            "600",
+            "--seed",
+            str(seed),
+            "--users",
+            "3",
+            "--batch-size",
+            "250",
+            stdout=StringIO(),
+        )
+        return list(
+            ZettleCard.objects.order_by("pk").values_list(
+                "uuid", "title", "path", "sequence_key", "reply_to_id", "x"
+            )
+        )
+
+    def test_same_seed_same_garden(self):
+        """Should write the same cards for the same seed"""
+        gardens = []
+        for seed in [7, 7, 8]:
+            with transaction.atomic():
+                gardens.append(self.generate(seed))
+                transaction.set_rollback(True)
+        self.assertEqual(gardens[0], gardens[1])
+        self.assertNotEqual(gardens[0], gardens[2])
+
+    def test_generated_links_are_valid(self):
+        """Should write paths, sequences and tags the app would have written"""
+        self.generate()
+        self.assertEqual(ZettleCard.objects.count(), 600)
+        self.assertEqual(ZettleCard.objects.values("author").distinct().count(), 3)
+        self.assertTrue(ZettleCard.objects.filter(depth__gte=2).exists())
+        self.assertTrue(ZettleCard.objects.filter(reply_to__isnull=False).exists())
+
+        paths = dict(ZettleCard.objects.values_list("pk", "path"))
+        rebuild_paths()
+        self.assertEqual(dict(ZettleCard.objects.values_list("pk", "path")), paths)
+
+        sequence_ids = set(
+            ZettleCard.objects.exclude(sequence_id=None).values_list(
+                "sequence_id", flat=True
+            )
+        )
+        self.assertTrue(sequence_ids)
+        for sequence_id in sequence_ids:
+            members = list(ZettleCard.objects.filter(sequence_id=sequence_id))
+            first = ZettleCard.objects.get(sequence_id=sequence_id, prev=None)
+            chain = [first]
+            while chain[-1].next_id:
+                chain.append(chain[-1].next)
+            self.assertEqual(len(chain), len(members))
+            keys = [card.sequence_key for card in chain]
+            self.assertEqual(keys, sorted(keys))
+
+        tags = set(
+            ZettleCard.tags.through.objects.values_list(
+                "from_zettlecard_id", "to_zettlecard_id"
+            )
+        )
+        self.assertTrue(tags)
+        self.assertTrue(all((to_id, from_id) in tags for from_id, to_id in tags))
+
+
+class QueryBudgetTests(APITestCase):
+    def setUp(self):
+        GardenGenerator(seed=3, users=2).generate(300)
+        update_indexes()
+        self.benchmark = Benchmark(requests=1)
+
+    def test_scenarios_within_query_budget(self):
+        """Should answer each benchmarked request within its query budget"""
+        results = self.benchmark.run()
+        for name, result in results.items():
+            with self.subTest(name):
+                self.assertLess(result["status"], 400)
+                self.assertLessEqual(result["queries"], result["query_budget"])
+
+    def test_query_counts_do_not_grow_with_garden(self):
+        """Should make as many queries for a bigger garden"""
+        names = [name for name in self.benchmark.scenarios if name != "move"]
+        before = self.benchmark.run(names)
+        GardenGenerator(seed=4, users=2).generate(300)
+        update_indexes()
+        after = self.benchmark.run(names)
+        for name in names:
+            with self.subTest(name):
+                # Only the content types model cards point to may differ.
+                self.assertLessEqual(
+                    abs(after[name]["queries"] - before[name]["queries"]),
+                    REFERENCE_TYPES,
+                )
+
+    def test_command_against_an_existing_garden(self):
+        """Should keep to the budgets when benchmarking a garden generated earlier"""
+        options = ["--sizes", "300", "--requests", "1", "--scenarios", "list,tree"]
+        call_command("benchmark_api", *options, stdout=StringIO())
+        # As in a new process, which has yet to look up the content types.
+        ContentType.objects.clear_cache()
+        call_command("benchmark_api", *options, stdout=StringIO())
+
+
+class MetricsTests(APITestCase):
+    def setUp(self):
+        REGISTRY.clear()
+        self.card = ZettleCard.objects.create(title="Card", text="metrics")
+        self.admin = UserFactory(is_staff=True)
+
+    def metrics(self):
+        self.client.force_authenticate(self.admin)
+        response = self.client.get(reverse("metrics"))
+        self.client.force_authenticate(None)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        return response.content.decode()
+
+    def sample(self, text, name, view, action=""):
+        labels = f'view="{view}",action="{action}",method="GET",status="200"'
+        match = re.search(rf"^{name}\{{{labels}\}} (\S+)$", text, re.MULTILINE)
+        return float(match.group(1))
+
+    def test_records_requests_by_view_and_action(self):
+        """Should record each request's time, queries and size by view and action"""
+        self.client.get(reverse("zettle:zettlecard-list"))
+        for _ in range(2):
+            self.client.get(reverse("zettle:zettlecard-detail", args=[self.card.uuid]))
+        text = self.metrics()
+        detail = ["zettlecard-detail", "retrieve"]
+        self.assertEqual(
+            self.sample(text, "http_request_duration_seconds_count", *detail), 2
+        )
+        # The second read is served from the card cache.
+        self.assertEqual(self.sample(text, "http_request_db_queries_sum", *detail), 2)
+        self.assertGreater(
+            self.sample(text, "http_request_db_duration_seconds_sum", *detail), 0
+        )
+        self.assertGreater(
+            self.sample(text, "http_request_serialize_duration_seconds_sum", *detail),
+            0,
+        )
+        self.assertGreater(
+            self.sample(text, "http_response_size_bytes_sum", *detail), 0
+        )
+        self.assertEqual(
+            self.sample(
+                text, "http_request_duration_seconds_count", "zettlecard-list", "list"
+            ),
+            1,
+        )
+        # Scrapes aren't recorded.
+        self.assertNotIn('view="metrics"', self.metrics())
+
+    def test_records_template_time(self):
+        """Should time template rendering separately"""
+        self.client.get(reverse("zettle:zettlecards"))
+        text = self.metrics()
+        self.assertGreater(
+            self.sample(
+                text, "http_request_template_duration_seconds_sum", "zettlecards"
+            ),
+            0,
+        )
+
+    def test_requires_staff_or_api_key(self):
+        """Should only serve metrics to staff and API keys"""
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 403)
+        _, key = APIKey.objects.create_key(name="prometheus")
+        response = self.client.get(
+            reverse("metrics"), HTTP_AUTHORIZATION=f"Api-Key {key}"
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_logs_slow_requests_with_queries(self):
+        """Should log a slow request with its queries, once per view per interval"""
+        with (
+            self.settings(METRICS_SLOW_REQUEST_SECONDS=0),
+            self.assertLogs("backend.core.middleware", "WARNING") as logs,
+        ):
+            self.client.get(reverse("zettle:zettlecard-list"))
+            self.client.get(reverse("zettle:zettlecard-list"))
+            self.client.get(reverse("zettle:zettlecard-detail", args=[self.card.uuid]))
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn("Slow request GET /api/cards/", logs.output[0])
+        self.assertIn('FROM "zettle_zettlecard"', logs.output[0])
+
+
+class TagTests(APITestCase):
+    def setUp(self):
+        self.list_url = reverse("zettle:zettlecard-list")
+        self.soil = ZettleCard.objects.create(
+            title="Soil", card_type=ZettleCard.CardType.TOPIC
+        )
+        self.water = ZettleCard.objects.create(
+            title="Water", card_type=ZettleCard.CardType.TOPIC
+        )
+        self.both = ZettleCard.objects.create(title="Mulching")
+        self.both.tags.add(self.soil, self.water)
+        self.one = ZettleCard.objects.create(title="Compost")
+        self.one.tags.add(self.soil)
+
+    def titles(self, **params):
+        response = self.client.get(self.list_url, {**params, "ordering": "title"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [card["title"] for card in response.data["results"]]
+
+    def tag_counts(self):
+        return dict(ZettleCard.objects.values_list("title", "tag_count"))
+
+    def test_filter_all_and_any(self):
+        """tags should need every listed tag and tags_any at least one"""
+        tags = f"{self.soil.uuid},{self.water.uuid}"
+        self.assertEqual(self.titles(tags=tags), ["Mulching"])
+        self.assertEqual(self.titles(tags_any=tags), ["Compost", "Mulching"])
+        self.assertEqual(self.titles(tags=str(self.soil.uuid)), ["Compost", "Mulching"])
+
+    def test_filter_unknown_and_invalid_tags(self):
+        """An unknown tag should match nothing under tags, and a bad uuid fail"""
+        tags = f"{self.soil.uuid},{uuid4()}"
+        self.assertEqual(self.titles(tags=tags), [])
+        self.assertEqual(self.titles(tags_any=tags), ["Compost", "Mulching"])
+        response = self.client.get(self.list_url, {"tags": "soil"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_title_filter_lists_cards_once(self):
+        """tag should match tag titles without repeating cards"""
+        ZettleCard.objects.create(title="Watershed", card_type="topic").tags.add(
+            self.both
+        )
+        self.assertEqual(self.titles(tag="wat"), ["Mulching"])
+
+    def test_counts_follow_tag_changes(self):
+        """Adding, removing, clearing and deleting should keep the counts"""
+        self.assertEqual(
+            self.tag_counts(),
+            {"Soil": 2, "Water": 1, "Mulching": 2, "Compost": 1},
+        )
+        self.one.tags.remove(self.soil)
+        self.assertEqual(self.tag_counts()["Soil"], 1)
+        self.both.tags.clear()
+        self.assertEqual(
+            self.tag_counts(),
+            {"Soil": 0, "Water": 0, "Mulching": 0, "Compost": 0},
+        )
+        self.one.tags.add(self.soil, self.water)
+        self.soil.delete()
+        self.assertEqual(self.tag_counts(), {"Water": 1, "Mulching": 0, "Compost": 1})
+        self.water.tags.add(self.water, self.both)
+        self.assertEqual(self.tag_counts(), {"Water": 3, "Mulching": 1, "Compost": 1})
+        self.assertEqual(recount_tags(), 0)
+
+    def test_repaired_counts_reach_the_changes_feed(self):
+        """Cards whose drifted tag count is repaired should show up in the feed"""
+        past = timezone.now() - timedelta(seconds=60)
+        ZettleCard.objects.update(updated_at=past)
+        token = encode_token(past + timedelta(microseconds=1))
+
+        ZettleCard.objects.filter(pk=self.water.pk).update(tag_count=5)
+        self.assertEqual(recount_tags(), 1)
+        response = self.client.get(
+            reverse("zettle:zettlecard-changes"), {"since": token}
+        )
+        self.assertEqual(
+            {card["title"]: card["tag_count"] for card in response.data["cards"]},
+            {"Water": 1},
+        )
+
+    def test_api_writes_return_current_count(self):
+        """A card saved with tags should be returned with their count"""
+        self.client.force_authenticate(UserFactory())
+        response = self.client.post(
+            self.list_url,
+            {"title": "Rain", "tags": [self.water.pk]},
+            format="json",
+        )
+        self.assertEqual(response.data["tag_count"], 1)
+        self.assertEqual(self.tag_counts()["Water"], 2)
+
+    def test_directory(self):
+        """The directory should list used tags by count without counting links"""
+        url = reverse("zettle:zettlecard-tag-directory")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {"card_type": "topic"})
+        self.assertEqual(
+            [(card["title"], card["tag_count"]) for card in response.data],
+            [("Soil", 2), ("Water", 1)],
+        )
+        self.assertNotIn(
+            "zettle_zettlecard_tags", " ".join(query["sql"] for query in queries)
+        )
+        response = self.client.get(url, {"card_type": "topic", "limit": 1})
+        self.assertEqual([card["title"] for card in response.data], ["Soil"])
+
+
+class ReferenceTests(APITestCase):
+    def setUp(self):
+        self.list_url = reverse("zettle:zettlecard-list")
+        self.user = UserFactory(username="ada")
+        self.target = ZettleCard.objects.create(title="Target")
+        for i in range(30):
+            ZettleCard.objects.create(
+                title=f"Model {i}",
+                card_type=ZettleCard.CardType.MODEL,
+                content_object=self.user if i % 2 else self.target,
+            )
+
+    def list_models(self, **params):
+        response = self.client.get(self.list_url, {"card_type": "model", **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data["results"]
+
+    def test_summarizes_references(self):
+        """Should describe each model card's object, and null once deleted"""
+        cards = {card["title"]: card for card in self.list_models()}
+        self.assertEqual(
+            cards["Model 1"]["reference"],
+            {"type": "users.user", "id": self.user.pk, "label": "ada"},
+        )
+        self.assertEqual(cards["Model 0"]["reference"]["type"], "zettle.zettlecard")
+        self.assertIsNone(
+            self.client.get(self.list_url, {"card_type": "text"}).data["results"][0][
+                "reference"
+            ]
+        )
+        self.target.delete()
+        cards = {card["title"]: card for card in self.list_models()}
+        self.assertIsNone(cards["Model 0"]["reference"])
+
+    def test_one_query_per_content_type(self):
+        """A page of model cards should load each target model in one query"""
+        with CaptureQueriesContext(connection) as queries:
+            self.list_models()
+        sql = [query["sql"] for query in queries]
+        self.assertEqual(len([q for q in sql if 'FROM "users_user"' in q]), 1)
+        for _ in range(20):
+            ZettleCard.objects.create(
+                card_type=ZettleCard.CardType.MODEL, content_object=self.user
+            )
+        with CaptureQueriesContext(connection) as more_queries:
+            self.list_models()
+        self.assertEqual(len(more_queries), len(queries))
+
+    def test_sparse_fields(self):
+        """Sparse lists should resolve references only when asked for"""
+        with CaptureQueriesContext(connection) as queries:
+            cards = self.list_models(fields="title,reference")
+        self.assertEqual(set(cards[0]), {"title", "reference"})
+        self.assertIsNotNone(cards[0]["reference"])
+        with CaptureQueriesContext(connection) as fewer_queries:
+            self.list_models(fields="title")
+        self.assertEqual(len(fewer_queries), len(queries) - 2)
+
+    def test_filter_by_referenced_object(self):
+        """references should find the cards pointing to an object"""
+        cards = self.client.get(
+            self.list_url, {"references": f"users.user:{self.user.pk}"}
+        ).data["results"]
+        self.assertEqual(len(cards), 15)
+        response = self.client.get(self.list_url, {"references": "nope:1"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_only_allowed_models_are_referenced(self):
+        """Cards should not point to, or describe, models outside the allow-list"""
+        vote = Vote.objects.create(card=self.target, user=self.user)
+        vote_type = ContentType.objects.get_for_model(Vote)
+        card = ZettleCard.objects.create(
+            title="Vote", card_type=ZettleCard.CardType.MODEL, content_object=vote
+        )
+        self.assertIsNone(summarize_reference(card))
+
+        self.client.force_authenticate(self.user)
+        response = self.client.post(
+            self.list_url,
+            {"title": "Peek", "content_type": vote_type.pk, "object_id": vote.pk},
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("content_type", response.data)
+        response = self.client.get(
+            self.list_url, {"references": f"zettle.vote:{vote.pk}"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class CardCounterTests(APITestCase):
+    def setUp(self):
+        self.root = ZettleCard.objects.create(title="Root")
+        self.other = ZettleCard.objects.create(title="Other")
+        self.child = ZettleCard.objects.create(
+            title="Child", parent=self.root, reply_to=self.root
+        )
+        ZettleCard.objects.create(title="Second", parent=self.root)
+
+    def counts(self, card):
+        card.refresh_from_db(fields=["child_count", "reply_count"])
+        return card.child_count, card.reply_count
+
+    def test_counts_follow_links(self):
+        """Creating, re-linking and deleting cards should keep the counts"""
+        self.assertEqual(self.counts(self.root), (2, 1))
+        self.child.parent = self.other
+        self.child.reply_to = None
+        self.child.save()
+        self.assertEqual(self.counts(self.root), (1, 0))
+        self.assertEqual(self.counts(self.other), (1, 0))
+        self.child.delete()
+        self.assertEqual(self.counts(self.other), (0, 0))
+
+    def test_count_changes_touch_the_parent(self):
+        """A new child or reply should refresh the parent's ETag and sync entry"""
+        detail_url = reverse(
+            "zettle:zettlecard-detail", kwargs={"uuid": self.other.uuid}
+        )
+        past = timezone.now() - timedelta(seconds=60)
+        ZettleCard.objects.update(updated_at=past)
+        token = encode_token(past + timedelta(microseconds=1))
+        etag = self.client.get(detail_url)["ETag"]
+
+        ZettleCard.objects.create(title="New child", parent=self.other)
+        ZettleCard.objects.create(title="New reply", reply_to=self.other)
+        response = self.client.get(detail_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["child_count"], 1)
+        self.assertEqual(response.data["reply_count"], 1)
+
+        response = self.client.get(
+            reverse("zettle:zettlecard-changes"), {"since": token}
+        )
+        self.assertEqual(
+            {card["title"] for card in response.data["cards"]},
+            {"Other", "New child", "New reply"},
+        )
+
+    def test_saving_a_stale_card_keeps_counts(self):
+        """Saving a card loaded before its children should not reset its count"""
+        stale = ZettleCard.objects.get(pk=self.other.pk)
+        ZettleCard.objects.create(parent=self.other)
+        stale.title = "Renamed"
+        stale.save()
+        self.assertEqual(self.counts(self.other), (1, 0))
+
+    def test_reconcile_counts(self):
+        """reconcile_counts should fix counts that drifted"""
+        ZettleCard.objects.update(child_count=7, reply_count=0, tag_count=3)
+        out = StringIO()
+        call_command("reconcile_counts", stdout=out)
+        self.assertIn("Recounted children: 4 fixed", out.getvalue())
+        self.assertIn("Recounted replies: 1 fixed", out.getvalue())
+        self.assertIn("Recounted tags: 4 fixed", out.getvalue())
+        self.assertEqual(self.counts(self.root), (2, 1))
+
+    def test_api_sorts_and_filters_on_counts(self):
+        """The API should order and filter by the stored counts"""
+        url = reverse("zettle:zettlecard-list")
+        response = self.client.get(url, {"ordering": "-child_count", "cursor": ""})
+        self.assertEqual(response.data["results"][0]["title"], "Root")
+        response = self.client.get(url, {"reply_count__gte": 1})
+        self.assertEqual([card["title"] for card in response.data["results"]], ["Root"])
+
+    def test_admin_changelist_estimates_large_tables(self):
+        """The admin should show estimated totals and never count children"""
+        self.client.force_login(UserFactory(is_staff=True, is_superuser=True))
+        url = reverse("admin:zettle_zettlecard_changelist")
+        with (
+            mock.patch("backend.zettle.admin.estimate_count", return_value=50_000),
+            CaptureQueriesContext(connection) as queries,
+        ):
+            response = self.client.get(url, {"o": "-5"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["cl"].result_count, 50_000)
+        sql = " ".join(query["sql"] for query in queries)
+        self.assertNotIn("COUNT(", sql)
+        with mock.patch("backend.zettle.admin.estimate_count", return_value=50_000):
+            response = self.client.get(url, {"card_type__exact": "text"})
+        self.assertEqual(response.context["cl"].result_count, 4)
+
+
+class CanvasSocketTests(APITestCase):
+    def setUp(self):
+        self.coalescer = MoveCoalescer(move_interval=0.02, persist_interval=0.2)
+        self.app = CanvasSocket(self.coalescer)
+        self.card = ZettleCard.objects.create(title="Dragged", x=100, y=100)
+
+    async def connect(self, bbox="0,0,1000,1000", headers=()):
+        socket = ApplicationCommunicator(
+            self.app,
+            {
+                "type": "websocket",
+                "path": "/ws/canvas/",
+                "query_string": f"bbox={bbox}".encode(),
+                "headers": list(headers),
+            },
+        )
+        await socket.send_input({"type": "websocket.connect"})
+        self.assertEqual(await socket.receive_output(), {"type": "websocket.accept"})
+        self.assertEqual(
+            await self.receive(socket), {"type": "subscribed", "regions": 1}
+        )
+        return socket
+
+    async def receive(self, socket):
+        message = await socket.receive_output()
+        return json.loads(message["text"])
+
+    async def send(self, socket, data):
+        await socket.send_input({"type": "websocket.receive", "text": json.dumps(data)})
+
+    async def close(self, socket):
+        await socket.send_input({"type": "websocket.disconnect", "code": 1000})
+        await socket.wait()
+
+    def committed(self, change):
+        with self.captureOnCommitCallbacks(execute=True):
+            return change()
+
+    async def test_broadcasts_card_changes_in_region(self):
+        """Should send creates, updates, moves and deletes in the watched regions"""
+        socket = await self.connect()
+
+        far = await sync_to_async(self.committed)(
+            lambda: ZettleCard.objects.create(title="Far", x=50_000, y=0)
+        )
+        card = await sync_to_async(self.committed)(
+            lambda: ZettleCard.objects.create(title="Near", x=10, y=20)
+        )
+        event = await self.receive(socket)
+        self.assertEqual(event["type"], "card.created")
+        self.assertEqual(event["cards"][0]["title"], "Near")
+
+        card.title = "Renamed"
+        await sync_to_async(self.committed)(card.save)
+        event = await self.receive(socket)
+        self.assertEqual(
+            (event["type"], event["cards"][0]["title"]), ("card.updated", "Renamed")
+        )
+
+        await sync_to_async(self.committed)(
+            lambda: move_cards({card.uuid: (60_000, 0), far.uuid: (50_001, 0)})
+        )
+        event = await self.receive(socket)
+        self.assertEqual(event["type"], "card.moved")
+        self.assertEqual(
+            event["cards"], [{"uuid": str(card.uuid), "x": 60_000, "y": 0}]
+        )
+
+        await sync_to_async(self.committed)(self.card.delete)
+        event = await self.receive(socket)
+        self.assertEqual(
+            event, {"type": "card.deleted", "cards": [{"uuid": str(self.card.uuid)}]}
+        )
+        self.assertTrue(await socket.receive_nothing())
+        await self.close(socket)
+
+    async def test_coalesces_and_batches_drags(self):
+        """Many mouse events should become a few broadcasts and one write"""
+        user = await sync_to_async(UserFactory)()
+        await sync_to_async(self.client.force_login)(user)
+        cookie = f"sessionid={self.client.cookies['sessionid'].value}"
+        socket = await self.connect(headers=[(b"cookie", cookie.encode())])
+
+        queries = QueryCounter()
+        with connection.execute_wrapper(queries):
+            for i in range(100):
+                await self.send(
+                    socket,
+                    {"type": "move", "uuid": str(self.card.uuid), "x": i, "y": 5},
+                )
+            await asyncio.sleep(0.05)
+            await self.coalescer.idle()
+
+        moves = []
+        while not await socket.receive_nothing():
+            moves.append(await self.receive(socket))
+        self.assertTrue(1 <= len(moves) <= 3)
+        self.assertEqual(
+            moves[-1]["cards"], [{"uuid": str(self.card.uuid), "x": 99, "y": 5}]
+        )
+        await sync_to_async(self.card.refresh_from_db)()
+        self.assertEqual((self.card.x, self.card.y), (99, 5))
+        self.assertLess(queries.count, 10)
+        await self.close(socket)
+
+    async def test_rejects_anonymous_moves_and_bad_input(self):
+        """Moves should need a signed-in user, and bad messages an error"""
+        socket = await self.connect()
+        await self.send(
+            socket, {"type": "move", "uuid": str(self.card.uuid), "x": 1, "y": 1}
+        )
+        self.assertEqual(
+            await self.receive(socket),
+            {"type": "error", "detail": "Sign in to move cards."},
+        )
+        await self.send(socket, {"type": "subscribe", "bbox": "0,0,1000000,1000000"})
+        self.assertEqual((await self.receive(socket))["type"], "error")
+        await self.close(socket)
+
+    async def test_off_canvas_moves_are_rejected(self):
+        """Moves the columns can't hold should be refused, not spoil the batch"""
+        other = await ZettleCard.objects.acreate(title="Other", x=0, y=0)
+        user = await sync_to_async(UserFactory)()
+        await sync_to_async(self.client.force_login)(user)
+        cookie = f"sessionid={self.client.cookies['sessionid'].value}"
+        socket = await self.connect(headers=[(b"cookie", cookie.encode())])
+
+        for x in [1e19, float("inf"), float("nan")]:
+            await self.send(
+                socket, {"type": "move", "uuid": str(self.card.uuid), "x": x, "y": 1}
+            )
+            self.assertEqual((await self.receive(socket))["type"], "error")
+        await self.send(
+            socket, {"type": "move", "uuid": str(other.uuid), "x": 7, "y": 8}
+        )
+        await asyncio.sleep(0.05)
+        await self.coalescer.idle()
+
+        await sync_to_async(other.refresh_from_db)()
+        self.assertEqual((other.x, other.y), (7, 8))
+        await sync_to_async(self.card.refresh_from_db)()
+        self.assertEqual((self.card.x, self.card.y), (100, 100))
+        await self.close(socket)
+
+    async def test_rejects_other_origins(self):
+        """Should refuse connections opened by other sites"""
+        scope = {"type": "websocket", "path": "/ws/canvas/", "query_string": b""}
+        for origin, accepted in [
+            (b"https://garden.example", True),
+            (b"https://evil.example", False),
+        ]:
+            socket = ApplicationCommunicator(
+                self.app,
+                {
+                    **scope,
+                    "headers": [(b"host", b"garden.example"), (b"origin", origin)],
+                },
+            )
+            await socket.send_input({"type": "websocket.connect"})
+            message = await socket.receive_output()
+            if accepted:
+                self.assertEqual(message, {"type": "websocket.accept"})
+                await self.close(socket)
+            else:
+                self.assertEqual(message, {"type": "websocket.close", "code": 4403})
+
+
+class AsyncReadTests(APITestCase):
+    def setUp(self):
+        REGISTRY.clear()
+        self.author = UserFactory()
+        self.root = ZettleCard.objects.create(title="Soil", text="Loam and clay.")
+        self.child = ZettleCard.objects.create(title="Clay soil", parent=self.root)
+        self.tag = ZettleCard.objects.create(
+            title="Ground", card_type=ZettleCard.CardType.TOPIC
+        )
+        self.child.tags.add(self.tag)
+        self.model_card = ZettleCard.objects.create(
+            title="Gardener",
+            card_type=ZettleCard.CardType.MODEL,
+            content_object=self.author,
+        )
+
+    async def get_both(self, name, kwargs=None, **params):
+        """The sync and async responses to the same read."""
+        sync_url = reverse(f"zettle:zettlecard-{name}", kwargs=kwargs)
+        async_url = reverse(f"zettle:async-card-{name}", kwargs=kwargs)
+        sync = await sync_to_async(self.client.get)(sync_url, params)
+        response = await self.async_client.get(async_url, params)
+        self.assertEqual(response.status_code, sync.status_code)
+        return sync.json(), response.json()
+
+    async def test_reads_match_the_sync_api(self):
+        """Async list, detail, tree and search should answer like the sync API"""
+        for params in [
+            {},
+            {"fields": "uuid,title,reference,tags"},
+            {"tags": str(self.tag.uuid)},
+            {"view": "canvas", "ordering": "title"},
+            {"search": "soil"},
+            {"cursor": "", "page_size": 2},
+        ]:
+            with self.subTest(**params):
+                sync, response = await self.get_both("list", **params)
+                self.assertEqual(response["results"], sync["results"])
+                self.assertEqual(response.get("count"), sync.get("count"))
+
+        for name, params in [("detail", {}), ("tree", {"depth": 1})]:
+            with self.subTest(name):
+                sync, response = await self.get_both(
+                    name, {"uuid": self.root.uuid}, **params
+                )
+                self.assertEqual(response, sync)
+
+        sync, response = await self.get_both("search", q="soil")
+        self.assertEqual(response, sync)
+        self.assertEqual({hit["title"] for hit in response}, {"Soil", "Clay soil"})
+
+    async def test_model_card_references(self):
+        """Should resolve references without sync queries from the event loop"""
+        url = reverse("zettle:async-card-detail", args=[self.model_card.uuid])
+        response = await self.async_client.get(url)
+        self.assertEqual(
+            response.json()["reference"],
+            {"type": "users.user", "id": self.author.pk, "label": str(self.author)},
+        )
+
+    async def test_references_with_a_cold_content_type_cache(self):
+        """Content types missing from the cache should not be loaded in the loop"""
+        for name, kwargs, params in [
+            ("list", None, {"card_type": "model"}),
+            ("detail", {"uuid": self.model_card.uuid}, {"fields": "uuid,reference"}),
+            ("tree", {"uuid": self.model_card.uuid}, {}),
+        ]:
+            with self.subTest(name):
+                ContentType.objects.clear_cache()
+                response = await self.async_client.get(
+                    reverse(f"zettle:async-card-{name}", kwargs=kwargs), params
+                )
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertIn('"users.user"', response.content.decode())
+
+    async def test_follows_cursors_and_revalidates(self):
+        """Should page with cursors and answer 304 to a current ETag"""
+        url = reverse("zettle:async-card-list")
+        titles = []
+        response = await self.async_client.get(url, {"cursor": "", "page_size": 2})
+        while True:
+            page = response.json()
+            titles += [card["title"] for card in page["results"]]
+            if page["next"] is None:
+                break
+            response = await self.async_client.get(page["next"])
+        self.assertEqual(len(titles), 4)
+        self.assertEqual(len(set(titles)), 4)
+
+        response = await self.async_client.get(url)
+        again = await self.async_client.get(
+            url, headers={"If-None-Match": response["ETag"]}
+        )
+        self.assertEqual(again.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    async def test_errors(self):
+        """Should answer bad requests and unknown cards with DRF's JSON errors"""
+        response = await self.async_client.get(
+            reverse("zettle:async-card-tree", args=[uuid4()])
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertIn("detail", response.json())
+        response = await self.async_client.get(
+            reverse("zettle:async-card-tree", args=[self.root.uuid]), {"depth": "x"}
+        )
+        self.assertEqual(response.json(), {"depth": ["A valid integer is required."]})
+        response = await self.async_client.get(
+            reverse("zettle:async-card-list"), {"page": 9}
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_reads_skip_the_request_transaction(self):
+        """GETs should run outside ATOMIC_REQUESTS and writes inside it"""
+        for url in [
+            reverse("zettle:zettlecard-list"),
+            reverse("zettle:async-card-list"),
+        ]:
+            self.assertEqual(resolve(url).func._non_atomic_requests, {"default"})
+
+        with mock.patch.object(
+            transaction, "atomic", wraps=transaction.atomic
+        ) as atomic:
+            self.client.get(reverse("zettle:zettlecard-list"))
+            atomic.assert_not_called()
+            self.client.force_authenticate(self.author)
+            self.client.post(reverse("zettle:zettlecard-list"), {"title": "New"})
+            atomic.assert_called()
+
+    async def test_records_async_metrics(self):
+        """Should record async requests' queries without a thread per request"""
+        await self.async_client.get(
+            reverse("zettle:async-card-detail", args=[self.root.uuid])
+        )
+        series = REGISTRY.metrics["http_request_db_queries"]["series"]
+        histogram = series[("async-card-detail", "", "GET", "200")]
+        # The card and its tags.
+        self.assertEqual(histogram.sum, 2)
@@ -0,0 +1,122 @@
+import base64
+import json
+
+from django.db import connection
+from django.db.models import prefetch_related_objects
+from django.utils.dateparse import parse_datetime
+
+from backend.zettle.models import ZettleCard
+
+MAX_THREAD_DEPTH = 16
+MAX_BRANCH_LIMIT = 100
+
+# Reply orderings accepted by the thread endpoint, mapped to the column each
+# one sorts on. Every ordering has a matching (reply_to, -column, -id) index.
+THREAD_SORTS = {
+    "hot": "hot_score",
+    "top": "votes",
+    "new": "created_at",
+}
+
+# Each level reads at most limit + 1 replies per card straight from the
+# (reply_to, -column, -id) index. The extra one only marks its branch as
+# having more: it's flagged as spare and its own replies aren't read.
+THREAD_SQL = """
+    WITH RECURSIVE thread(id, thread_depth, thread_spare) AS (
+        SELECT id, 0, 0 FROM zettle_zettlecard WHERE uuid = %s
+        UNION ALL
+        SELECT c.id, t.thread_depth + 1, CASE WHEN (
+            SELECT COUNT(*) FROM zettle_zettlecard s
+            WHERE s.reply_to_id = t.id
+            AND (t.thread_depth > 0 OR {after_s})
+            AND (s.{column} > c.{column} OR (s.{column} = c.{column} AND s.id > c.id))
+        ) < %s THEN 0 ELSE 1 END
+        FROM thread t
+        JOIN zettle_zettlecard c ON c.id IN (
+            SELECT r.id FROM zettle_zettlecard r
+            WHERE r.reply_to_id = t.id AND (t.thread_depth > 0 OR {after_r})
+            ORDER BY r.{column} DESC, r.id DESC
+            LIMIT %s
+        )
+        WHERE t.thread_depth < %s AND t.thread_spare = 0
+    )
+    SELECT c.*, t.thread_depth, t.thread_spare
+    FROM thread t
+    JOIN zettle_zettlecard c ON c.id = t.id
+    ORDER BY t.thread_depth, c.{column} DESC, c.id DESC
+"""
+
+
+def encode_cursor(card: ZettleCard, sort: str) -> str:
+    value = getattr(card, THREAD_SORTS[sort])
+    if sort == "new":
+        value = value.isoformat()
+    payload = json.dumps([value, card.pk]).encode()
+    return base64.urlsafe_b64encode(payload).decode()
+
+
+def decode_cursor(cursor: str, sort: str) -> tuple:
+    """The ``(value, id)`` of the last reply seen, raising ValueError if malformed."""
+    try:
+        value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, ValueError) as e:
+        raise ValueError("Invalid cursor.") from e
+    if sort == "new":
+        value = parse_datetime(value) if isinstance(value, str) else None
+    elif not isinstance(value, (int, float)):
+        value = None
+    if value is None or not isinstance(pk, int):
+        raise ValueError("Invalid cursor.")
+    if sort == "new":
+        value = connection.ops.adapt_datetimefield_value(value)
+    return value, pk
+
+
+def fetch_thread(uuid, sort="hot", depth=MAX_THREAD_DEPTH, limit=20, cursor=None):
+    """Load a card and its ranked replies, at most ``limit`` per branch.
+
+    The whole page comes from one recursive query, which reads one reply
+    past the limit per card to learn whether a branch has more. The root's replies
+    start after ``cursor`` when one is given. Every returned card has
+    ``thread_depth``, ``thread_replies`` (the loaded replies in rank order)
+    and ``thread_has_more`` set. Returns None if there
+    is no card with that uuid.
+    """
+    column = THREAD_SORTS[sort]
+    after, params = "1 = 1", []
+    if cursor is not None:
+        value, pk = decode_cursor(cursor, sort)
+        after = "({alias}.{column} < %s OR ({alias}.{column} = %s AND {alias}.id < %s))"
+        params = [value, value, pk]
+    depth = min(depth, MAX_THREAD_DEPTH)
+    uuid = ZettleCard._meta.get_field("uuid").get_db_prep_value(uuid, connection)
+    sql = THREAD_SQL.format(
+        after_s=after.format(alias="s", column=column),
+        after_r=after.format(alias="r", column=column),
+        column=column,
+    )
+    cards = list(
+        ZettleCard.objects.raw(sql, [uuid, *params, limit, *params, limit + 1, depth])
+    )
+    if not cards:
+        return None
+
+    by_id = {}
+    for card in cards:
+        card.thread_replies = []
+        card.thread_has_more = card.thread_depth == depth and card.reply_count > 0
+        if card.thread_depth:
+            parent = by_id[card.reply_to_id]
+            if card.thread_spare:
+                parent.thread_has_more = True
+                continue
+            parent.thread_replies.append(card)
+        by_id[card.pk] = card
+    prefetch_related_objects(list(by_id.values()), "tags")
+    return cards[0]
+
+
+def walk_thread(card):
+    yield card
+    for reply in card.thread_replies:
+        yield from walk_thread(reply)
@@ -0,0 +1,193 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+from io import BytesIO
+from pathlib import PurePosixPath
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connections, transaction
+from django.utils import timezone
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from backend.zettle.card_cache import invalidate_cards
+from backend.zettle.models import ZettleCard
+from backend.zettle.storage import get_blob_storage, is_blob_name
+
+logger = logging.getLogger(__name__)
+
+# Widths to derive, doubling from a zoomed-out card (a card's image is 288px
+# wide at 1x) up to a zoomed-in one on a high-DPI display. Widths the original
+# can't fill are skipped; browsers fall back to the original for those.
+THUMBNAIL_WIDTHS = [256, 512, 1024, 2048]
+
+# Every width is saved as WebP, and as JPEG (or PNG, if transparent) for
+# browsers without WebP support.
+WEBP_QUALITY = 80
+FALLBACK_QUALITY = 85
+
+# Decompression bombs are refused rather than resized.
+MAX_SOURCE_PIXELS = 100_000_000
+
+
+def thumbnail_dir(image_name: str) -> PurePosixPath:
+    """Directory holding an image's thumbnails, e.g. ``images/{uuid}/``."""
+    path = PurePosixPath(image_name)
+    return path.parent / path.stem
+
+
+def thumbnail_name(image_name: str, width: int, extension: str) -> str:
+    return str(thumbnail_dir(image_name) / f"{width}.{extension}")
+
+
+def fallback_format(image: Image.Image) -> tuple[str, str]:
+    """The Pillow format and extension used next to WebP: PNG if transparent."""
+    if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+        return "PNG", "png"
+    return "JPEG", "jpg"
+
+
+def _encode(image: Image.Image, format: str) -> bytes:
+    buffer = BytesIO()
+    if format == "JPEG":
+        image.convert("RGB").save(
+            buffer, format, quality=FALLBACK_QUALITY, optimize=True, progressive=True
+        )
+    elif format == "WEBP":
+        image.save(buffer, format, quality=WEBP_QUALITY, method=4)
+    else:
+        image.save(buffer, format, optimize=True)
+    return buffer.getvalue()
+
+
+def _store(name: str, content: bytes):
+    # Names are deterministic, so whatever an earlier run left there is replaced.
+    get_blob_storage().save_as(name, ContentFile(content))
+
+
+def render_thumbnails(image_name: str) -> dict:
+    """Resize the stored image to every thumbnail width it can fill.
+
+    Returns ``{format: {width: name}}`` with a ``webp`` entry and one for the
+    fallback format, both empty if the image is too small to need any.
+    """
+    with get_blob_storage().open(image_name) as f, Image.open(f) as source:
+        if source.width * source.height > MAX_SOURCE_PIXELS:
+            raise Image.DecompressionBombError(f"{image_name} is too large")
+        image = ImageOps.exif_transpose(source)
+        image.load()
+
+    format, extension = fallback_format(image)
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if format == "PNG" else "RGB")
+
+    thumbnails = {"webp": {}, extension: {}}
+    for width in THUMBNAIL_WIDTHS:
+        if width >= image.width:
+            break
+        height = max(1, round(image.height * width / image.width))
+        resized = image.resize((width, height), Image.Resampling.LANCZOS)
+        for fmt, ext in [("WEBP", "webp"), (format, extension)]:
+            name = thumbnail_name(image_name, width, ext)
+            _store(name, _encode(resized, fmt))
+            thumbnails[ext][str(width)] = name
+    return thumbnails
+
+
+def delete_thumbnails(thumbnails: dict):
+    """Delete thumbnail files, except those of blobs, which go with the blob."""
+    storage = get_blob_storage()
+    for names in thumbnails.values():
+        for name in names.values():
+            if not is_blob_name(name):
+                storage.delete(name)
+
+
+def generate_thumbnails(card_id: int, rerender: bool = False) -> dict | None:
+    """Derive and record the thumbnails of a card's current image.
+
+    Thumbnails another card already has for the same image are reused,
+    unless ``rerender`` is set. The result is only saved if the card still
+    has the image it was made from; otherwise the files are dropped, as a
+    newer run will replace them. Returns the thumbnails, or None if there was
+    nothing to do.
+    """
+    card = ZettleCard.objects.filter(pk=card_id).only("image", "thumbnails").first()
+    if card is None or not card.image:
+        return None
+    # Cards with the same image share its blob, and so its thumbnails.
+    thumbnails = None
+    if not rerender:
+        thumbnails = (
+            ZettleCard.objects.filter(image=card.image.name)
+            .exclude(pk=card.pk)
+            .exclude(thumbnails={})
+            .values_list("thumbnails", flat=True)
+            .first()
+        )
+    rendered = thumbnails is None
+    if rendered:
+        try:
+            thumbnails = render_thumbnails(card.image.name)
+        except (OSError, UnidentifiedImageError, Image.DecompressionBombError):
+            logger.exception("Could not make thumbnails of %s", card.image.name)
+            return None
+
+    updated = ZettleCard.objects.filter(pk=card_id, image=card.image.name).update(
+        thumbnails=thumbnails, updated_at=timezone.now()
+    )
+    if not updated:
+        if rendered:
+            delete_thumbnails(thumbnails)
+        return None
+    invalidate_cards(card_ids=[card_id])
+    # A new upload gets a new name, so the old image's files are left over.
+    kept = {name for names in thumbnails.values() for name in names.values()}
+    delete_thumbnails(
+        {
+            format: {width: name for width, name in names.items() if name not in kept}
+            for format, names in card.thumbnails.items()
+        }
+    )
+    return thumbnails
+
+
+@cache
+def get_thumbnail_executor(workers: int) -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thumbnails")
+
+
+def _generate_in_worker(card_id: int):
+    try:
+        generate_thumbnails(card_id)
+    except Exception:
+        logger.exception("Thumbnail job for card %s failed", card_id)
+    finally:
+        # Worker threads hold their own connections, which would otherwise
+        # outlive the job.
+        connections.close_all()
+
+
+def schedule_thumbnails(card_id: int):
+    """Generate a card's thumbnails in the background once the save commits.
+
+    ``ZETTLE_THUMBNAIL_WORKERS`` sets the size of the thread pool; with 0 the
+    thumbnails are made inline, which suits tests and one-off scripts.
+    """
+    workers = getattr(settings, "ZETTLE_THUMBNAIL_WORKERS", 2)
+    if not workers:
+        transaction.on_commit(lambda: generate_thumbnails(card_id))
+        return
+    executor = get_thumbnail_executor(workers)
+    transaction.on_commit(lambda: executor.submit(_generate_in_worker, card_id))
+
+
+def srcset(request, names: dict) -> str:
+    """An ``<img srcset>`` value for ``{width: name}``, narrowest first."""
+    candidates = []
+    for width, name in sorted(names.items(), key=lambda item: int(item[0])):
+        url = get_blob_storage().url(name)
+        if request is not None:
+            url = request.build_absolute_uri(url)
+        candidates.append(f"{url} {width}w")
+    return ", ".join(candidates)
@@ -0,0 +1,485 @@
+import json
+import tarfile
+from datetime import datetime
+from itertools import batched
+from uuid import UUID
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import FieldDoesNotExist
+from django.core.files import File
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from backend.users.models import User
+from backend.zettle.blobs import count_references
+from backend.zettle.clusters import rebuild_tiles
+from backend.zettle.counters import recount_links
+from backend.zettle.hierarchy import rebuild_paths
+from backend.zettle.models import ZettleCard
+from backend.zettle.ranking import hot_score
+from backend.zettle.search import get_search_backend
+from backend.zettle.spatial import check_coordinate, grid_cell
+from backend.zettle.storage import get_blob_storage, is_blob_name
+from backend.zettle.tags import recount_tags
+
+FORMAT = "recursivegarden"
+FORMAT_VERSION = 1
+
+BATCH_SIZE = 2000
+
+# Card columns copied as they are. Links to other cards, users and content
+# types, and the objects model cards point to, are written as uuids and
+# natural keys instead of ids.
+EXPORTED_FIELDS = [
+    "uuid",
+    "card_type",
+    "title",
+    "votes",
+    "text",
+    "image",
+    "document",
+    "url",
+    "sequence_id",
+    "sequence_key",
+    "slug",
+    "x",
+    "y",
+    "created_at",
+    "updated_at",
+]
+LINK_FIELDS = ["parent", "next", "reply_to"]
+
+# Fields of a card line that must be strings or null, and those that must be
+# uuids or null, which are normalized like the card's own uuid.
+TEXT_FIELDS = [
+    "card_type",
+    "title",
+    "text",
+    "image",
+    "document",
+    "url",
+    "slug",
+    "sequence_key",
+    "author",
+    "content_type",
+    "object",
+]
+UUID_FIELDS = [*LINK_FIELDS, "sequence_id"]
+LINK_SQL = """
+    UPDATE zettle_zettlecard SET parent_id = %s, next_id = %s, reply_to_id = %s,
+        content_type_id = %s, object_id = %s
+    WHERE id = %s
+"""
+
+# The field written for the object a model card points to, by its content
+# type. References to other types are left out.
+REFERENCE_KEYS = {
+    "zettle.zettlecard": "uuid",
+    "users.user": "username",
+}
+
+
+class ExportEncoder(DjangoJSONEncoder):
+    def default(self, o):
+        # DjangoJSONEncoder rounds to milliseconds, which would reorder cards
+        # created in the same millisecond.
+        if isinstance(o, datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+def export_cards(queryset=None, batch_size=BATCH_SIZE):
+    """NDJSON lines for a garden: a header, then one card per line.
+
+    Cards are read ``batch_size`` at a time, with their links and tags, so
+    memory use doesn't grow with the garden.
+    """
+    queryset = ZettleCard.objects.all() if queryset is None else queryset
+    yield json.dumps({"format": FORMAT, "version": FORMAT_VERSION}) + "\n"
+    rows = (
+        queryset.order_by("pk")
+        .values(
+            "pk",
+            *EXPORTED_FIELDS,
+            *(f"{field}__uuid" for field in LINK_FIELDS),
+            "author__username",
+            "object_id",
+            "content_type__app_label",
+            "content_type__model",
+        )
+        .iterator(chunk_size=batch_size)
+    )
+    tags_through = ZettleCard.tags.through
+    for batch in batched(rows, batch_size):
+        targets = _export_targets(batch)
+        tags = {}
+        for card_id, tag_uuid in tags_through.objects.filter(
+            from_zettlecard_id__in=[row["pk"] for row in batch]
+        ).values_list("from_zettlecard_id", "to_zettlecard__uuid"):
+            tags.setdefault(card_id, []).append(tag_uuid)
+        lines = []
+        for row in batch:
+            card = {field: row[field] for field in EXPORTED_FIELDS}
+            card.update({field: row[f"{field}__uuid"] for field in LINK_FIELDS})
+            card["tags"] = sorted(tags.get(row["pk"], []))
+            card["author"] = row["author__username"]
+            target = targets.get((_content_type_label(row), row["object_id"]))
+            card["content_type"] = target and _content_type_label(row)
+            card["object"] = target
+            lines.append(json.dumps(card, cls=ExportEncoder) + "\n")
+        yield "".join(lines)
+
+
+def _content_type_label(row):
+    if row["content_type__app_label"] is None:
+        return None
+    return f"{row['content_type__app_label']}.{row['content_type__model']}"
+
+
+def _export_targets(batch) -> dict:
+    """Natural keys of the objects a batch of cards points to, by label and id.
+
+    Objects since deleted, and those of types without a natural key, are
+    missing.
+    """
+    object_ids = {}
+    for row in batch:
+        label = _content_type_label(row)
+        if label in REFERENCE_KEYS and row["object_id"] is not None:
+            object_ids.setdefault(label, set()).add(row["object_id"])
+    targets = {}
+    for label, ids in object_ids.items():
+        model = apps.get_model(label)
+        for pk, key in model.objects.filter(pk__in=ids).values_list(
+            "pk", REFERENCE_KEYS[label]
+        ):
+            targets[label, pk] = str(key)
+    return targets
+
+
+def export_media(queryset, fileobj):
+    """Write the images and documents of the cards to a tar archive."""
+    storage = get_blob_storage()
+    names = set()
+    for field in ["image", "document"]:
+        names.update(
+            queryset.exclude(**{field: ""})
+            .exclude(**{f"{field}__isnull": True})
+            .values_list(field, flat=True)
+            .distinct()
+            .order_by()
+        )
+    with tarfile.open(fileobj=fileobj, mode="w|") as archive:
+        for name in sorted(names):
+            if not storage.exists(name):
+                continue
+            info = tarfile.TarInfo(name)
+            info.size = storage.size(name)
+            with storage.open(name) as f:
+                archive.addfile(info, f)
+    return len(names)
+
+
+def import_media(fileobj) -> int:
+    """Store the files of a media archive, returning how many there were."""
+    storage = get_blob_storage()
+    count = 0
+    with tarfile.open(fileobj=fileobj, mode="r:") as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            content = File(archive.extractfile(member), member.name)
+            # Blobs are stored by content, so they land under the same name.
+            if is_blob_name(member.name):
+                storage.save(member.name, content)
+            elif not storage.exists(member.name):
+                storage.save_as(member.name, content)
+            count += 1
+    return count
+
+
+class GardenImportError(ValueError):
+    """The import file is not a garden export this version can read."""
+
+
+def _read_cards(lines, batch_size):
+    """Batches of cards from NDJSON lines, after checking the header."""
+    lines = iter(lines)
+    try:
+        header = json.loads(next(lines))
+    except (StopIteration, ValueError):
+        raise GardenImportError("The file doesn't start with a garden export header.")
+    if header.get("format") != FORMAT or header.get("version") != FORMAT_VERSION:
+        raise GardenImportError(
+            f"Unsupported export: {header.get('format')} {header.get('version')}."
+        )
+    cards = (
+        _parse_card(line, number)
+        for number, line in enumerate(lines, start=2)
+        if line.strip()
+    )
+    yield from batched(cards, batch_size)
+
+
+def _parse_card(line, number) -> dict:
+    """One card line, raising GardenImportError if it can't be imported.
+
+    Each field is checked for the type the column or lookup needs. Uuids are
+    normalized, so the same card is always spelled the same.
+    """
+    try:
+        card = json.loads(line)
+    except ValueError:
+        raise GardenImportError(f"Line {number} is not valid JSON.")
+    if not isinstance(card, dict):
+        raise GardenImportError(f"Line {number} is not a card.")
+    try:
+        card["uuid"] = str(UUID(str(card["uuid"])))
+        created_at = parse_datetime(card["created_at"])
+    except (KeyError, TypeError, ValueError):
+        created_at = None
+    if created_at is None:
+        raise GardenImportError(f"Line {number} needs a valid uuid and created_at.")
+    votes, x, y = card.get("votes", 0), card.get("x"), card.get("y")
+    if not _is_int(votes) or not all(
+        value is None or _is_int(value) for value in (x, y)
+    ):
+        raise GardenImportError(f"Line {number} needs integer votes, x and y.")
+    try:
+        for value in filter(None.__ne__, (x, y)):
+            check_coordinate(value)
+    except ValueError as e:
+        raise GardenImportError(f"Line {number}: {e}")
+    for field in TEXT_FIELDS:
+        value = card.get(field)
+        if value is not None and not isinstance(value, str):
+            raise GardenImportError(f"Line {number} needs a string or null {field}.")
+        max_length = _max_length(field)
+        if value and max_length and len(value) > max_length:
+            raise GardenImportError(
+                f"Line {number} has a {field} over {max_length} characters."
+            )
+    for field in UUID_FIELDS:
+        if card.get(field) is not None:
+            card[field] = _normalize_uuid(card[field])
+            if card[field] is None:
+                raise GardenImportError(f"Line {number} needs a uuid or null {field}.")
+    tags = card.get("tags", [])
+    tags = [_normalize_uuid(tag) for tag in tags] if isinstance(tags, list) else None
+    if tags is None or None in tags:
+        raise GardenImportError(f"Line {number} needs a list of uuids as tags.")
+    card["tags"] = tags
+    return card
+
+
+def _is_int(value) -> bool:
+    # JSON true and false load as bools, which are ints to Python.
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _normalize_uuid(value) -> str | None:
+    """A uuid string spelled as ``str(UUID)`` does, or None if it isn't one."""
+    try:
+        return str(UUID(value))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def _max_length(field):
+    try:
+        return ZettleCard._meta.get_field(field).max_length
+    except FieldDoesNotExist:
+        return None
+
+
+def _lookup_ids(uuids) -> dict:
+    """Card ids by uuid string, for the uuids that exist."""
+    return {
+        str(uuid): pk
+        for uuid, pk in ZettleCard.objects.filter(uuid__in=uuids).values_list(
+            "uuid", "pk"
+        )
+    }
+
+
+class _NaturalKeys:
+    """Cached lookups of users by username and content types by label."""
+
+    def __init__(self):
+        self.users = {}
+        self.content_types = {}
+
+    def user_id(self, username):
+        if username is None:
+            return None
+        if username not in self.users:
+            self.users[username] = (
+                User.objects.filter(username=username).values_list("pk", flat=True)
+            ).first()
+        return self.users[username]
+
+    def content_type_id(self, label):
+        if label is None:
+            return None
+        if label not in self.content_types:
+            app_label, _, model = label.partition(".")
+            self.content_types[label] = (
+                ContentType.objects.filter(app_label=app_label, model=model)
+                .values_list("pk", flat=True)
+                .first()
+            )
+        return self.content_types[label]
+
+
+def import_cards(file, batch_size=BATCH_SIZE) -> dict:
+    """Load an ``export_cards`` file into this garden.
+
+    ``file`` is read twice: the first pass inserts the cards with
+    ``bulk_create``, and the second sets their links and tags once every
+    card exists, looking ids up by uuid one batch at a time. Cards whose
+    uuid is already here, or came earlier in the file, are skipped, but links
+    to them are kept. Links to
+    cards in neither the file nor the garden are dropped, as are authors
+    and referenced objects missing here. Cards keep their ``created_at``, but
+    are stamped as updated now so syncing clients pick them up. The derived
+    indexes are updated at the end. Returns counts of the cards created and
+    skipped. Raises GardenImportError if a line isn't a card.
+    """
+    now = timezone.now()
+    keys = _NaturalKeys()
+    created = skipped = 0
+    with transaction.atomic():
+        # Cards created from here on are the imported ones.
+        last_id = ZettleCard.objects.aggregate(last_id=Max("pk"))["last_id"] or 0
+        seen = set()
+        for batch in _read_cards(file, batch_size):
+            cards = _first_seen(batch, seen)
+            existing = _lookup_ids([card["uuid"] for card in cards])
+            new_cards = [
+                _new_card(card, now, keys)
+                for card in cards
+                if card["uuid"] not in existing
+            ]
+            ZettleCard.objects.bulk_create(new_cards)
+            created += len(new_cards)
+            skipped += len(batch) - len(new_cards)
+
+        file.seek(0)
+        seen = set()
+        for batch in _read_cards(file, batch_size):
+            batch = _first_seen(batch, seen)
+            ids = _lookup_ids(
+                {card["uuid"] for card in batch}
+                | {
+                    card[field]
+                    for card in batch
+                    for field in LINK_FIELDS
+                    if card.get(field)
+                }
+                | {tag for card in batch for tag in card.get("tags", [])}
+                | {
+                    card["object"]
+                    for card in batch
+                    if card.get("content_type") == "zettle.zettlecard"
+                    and card.get("object")
+                }
+            )
+            _link_batch(
+                [card for card in batch if ids[card["uuid"]] > last_id], ids, keys
+            )
+        _update_indexes(last_id, batch_size)
+    return {"created": created, "skipped": skipped}
+
+
+def _first_seen(batch, seen) -> list:
+    """The cards of ``batch`` whose uuid isn't in ``seen``, which gains them."""
+    cards = []
+    for card in batch:
+        if card["uuid"] not in seen:
+            seen.add(card["uuid"])
+            cards.append(card)
+    return cards
+
+
+def _new_card(card, now, keys) -> ZettleCard:
+    # Fields missing from the line keep the model's defaults.
+    fields = {field: card[field] for field in EXPORTED_FIELDS if field in card}
+    for field in ["image", "document"]:
+        fields[field] = fields.get(field) or None
+    for field in ["title", "text", "url", "slug", "sequence_key"]:
+        fields[field] = fields.get(field) or ""
+    fields["created_at"] = parse_datetime(card["created_at"])
+    fields["updated_at"] = now
+    new_card = ZettleCard(**fields, author_id=keys.user_id(card.get("author")))
+    # Computed by save(), which bulk_create skips.
+    new_card.grid_x, new_card.grid_y = grid_cell(new_card.x, new_card.y)
+    new_card.hot_score = hot_score(new_card.votes, new_card.created_at)
+    return new_card
+
+
+def _link_batch(batch, ids, keys):
+    """Set the links, references and tags of one batch of imported cards."""
+    links = []
+    tag_links = []
+    for card in batch:
+        pk = ids[card["uuid"]]
+        link_ids = [
+            *(ids.get(card.get(field)) for field in LINK_FIELDS),
+            *_import_target(card, ids, keys),
+        ]
+        if any(link_ids):
+            links.append([*link_ids, pk])
+        for tag in card.get("tags", []):
+            if tag in ids:
+                # Tags are symmetrical, so both directions are stored.
+                tag_links.append((pk, ids[tag]))
+                tag_links.append((ids[tag], pk))
+    # One prepared statement per card beats bulk_update's CASE expressions,
+    # whose cost grows with the batch.
+    with connection.cursor() as cursor:
+        cursor.executemany(LINK_SQL, links)
+    through = ZettleCard.tags.through
+    through.objects.bulk_create(
+        [
+            through(from_zettlecard_id=from_id, to_zettlecard_id=to_id)
+            for from_id, to_id in tag_links
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def _import_target(card, ids, keys) -> tuple:
+    """The content type and object id a card points to, or Nones if missing here."""
+    label, key = card.get("content_type"), card.get("object")
+    if label == "zettle.zettlecard":
+        object_id = ids.get(key)
+    elif label == "users.user":
+        object_id = keys.user_id(key)
+    else:
+        object_id = None
+    content_type_id = keys.content_type_id(label)
+    if object_id is None or content_type_id is None:
+        return None, None
+    return content_type_id, object_id
+
+
+def _update_indexes(last_id, batch_size):
+    """Bring the derived indexes up to date with the cards created after ``last_id``."""
+    rebuild_paths(batch_size)
+    rebuild_tiles(batch_size)
+    search = get_search_backend()
+    card_ids = (
+        ZettleCard.objects.filter(pk__gt=last_id)
+        .order_by("pk")
+        .values_list("pk", flat=True)
+        .iterator(chunk_size=batch_size)
+    )
+    for batch in batched(card_ids, batch_size):
+        search.index(list(batch))
+    count_references()
+    recount_links()
+    recount_tags()
@@ -0,0 +1,116 @@
+import hashlib
+import os
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.core.files import File
+from django.utils import timezone
+
+from backend.zettle.blobs import register_blob
+from backend.zettle.models import UploadSession
+from backend.zettle.storage import get_blob_storage
+
+# Largest file accepted by a resumable upload.
+MAX_UPLOAD_SIZE = 4 * 1024**3
+
+# Resumable uploads untouched for this long are abandoned.
+UPLOAD_SESSION_TTL = timedelta(days=1)
+
+# Request bodies are copied to the partial file in pieces of this size.
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class UploadOffsetMismatch(Exception):
+    """A chunk was sent for an offset other than the end of the partial file."""
+
+
+class UploadChecksumMismatch(Exception):
+    """The finished file doesn't have the SHA-256 the upload was started with."""
+
+
+def upload_dir() -> Path:
+    return Path(
+        getattr(settings, "ZETTLE_UPLOAD_DIR", Path(settings.MEDIA_ROOT) / "uploads")
+    )
+
+
+def partial_path(session) -> Path:
+    return upload_dir() / f"{session.uuid}.part"
+
+
+def delete_partial_file(session):
+    partial_path(session).unlink(missing_ok=True)
+
+
+class PartialFile(File):
+    """A finished partial file, which storages can move rather than copy."""
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def append_chunk(session, offset: int, stream) -> bool:
+    """Append a request body to the session's partial file.
+
+    ``offset`` must be where the partial file ends, so a chunk sent twice
+    after a dropped response is refused rather than appended twice. The
+    session should be locked by the caller. Returns whether the upload is
+    complete; the session's ``offset`` is updated but not saved.
+    """
+    if offset != session.offset:
+        raise UploadOffsetMismatch(session.offset)
+    path = partial_path(session)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    remaining = session.size - session.offset
+    with open(path, "ab") as f:
+        # Anything past session.offset is from a request that failed midway.
+        f.truncate(session.offset)
+        while True:
+            chunk = stream.read(min(COPY_CHUNK_SIZE, remaining + 1))
+            if not chunk:
+                break
+            if len(chunk) > remaining:
+                f.truncate(session.offset)
+                raise ValueError("The chunk runs past the end of the file.")
+            f.write(chunk)
+            remaining -= len(chunk)
+        session.offset = f.tell()
+    return session.offset == session.size
+
+
+def finish_upload(session) -> str:
+    """Store the complete partial file as a blob, returning its SHA-256.
+
+    The blob has no references until a card is saved with it, and is
+    collected if none is within ``BLOB_GRACE``.
+    """
+    path = partial_path(session)
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(COPY_CHUNK_SIZE):
+            digest.update(chunk)
+    sha256 = digest.hexdigest()
+    if session.sha256 and session.sha256 != sha256:
+        os.remove(path)
+        raise UploadChecksumMismatch(sha256)
+
+    with open(path, "rb") as f:
+        content = PartialFile(f, session.filename)
+        content.sha256 = sha256
+        name = get_blob_storage().save(session.filename, content)
+    # Storages that copy instead of moving leave the partial file behind.
+    path.unlink(missing_ok=True)
+    register_blob(name)
+    return sha256
+
+
+def prune_upload_sessions(max_age=UPLOAD_SESSION_TTL) -> int:
+    """Delete the resumable uploads left unfinished for ``max_age``."""
+    sessions = UploadSession.objects.filter(updated_at__lt=timezone.now() - max_age)
+    count = 0
+    for session in sessions.iterator():
+        delete_partial_file(session)
+        session.delete()
+        count += 1
+    return count
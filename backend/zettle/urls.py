@@ -1,7 +1,7 @@
 from django.urls import include, path
 from rest_framework.routers import DefaultRouter
 
-from backend.zettle import views
+from backend.zettle import async_views, views
 
 app_name = "zettle"
 
@@ -10,6 +10,38 @@ router = DefaultRouter()
 router.register(r"cards", views.ZettleCardViewSet)
 
 urlpatterns = [
+    path(
+        "api/cards/<uuid:uuid>/vote/",
+        views.ZettleCardVoteView.as_view(),
+        name="zettlecard-vote",
+    ),
+    path("api/uploads/", views.UploadListView.as_view(), name="upload-list"),
+    path(
+        "api/uploads/<uuid:uuid>/",
+        views.UploadDetailView.as_view(),
+        name="upload-detail",
+    ),
+    # Async variants of the busiest reads, for ASGI deployments.
+    path(
+        "api/async/cards/",
+        async_views.AsyncCardList.as_view(),
+        name="async-card-list",
+    ),
+    path(
+        "api/async/cards/search/",
+        async_views.AsyncCardSearch.as_view(),
+        name="async-card-search",
+    ),
+    path(
+        "api/async/cards/<uuid:uuid>/",
+        async_views.AsyncCardDetail.as_view(),
+        name="async-card-detail",
+    ),
+    path(
+        "api/async/cards/<uuid:uuid>/tree/",
+        async_views.AsyncCardTree.as_view(),
+        name="async-card-tree",
+    ),
     path("api/", include(router.urls)),
     path("cards/", views.ZettleCardView.as_view(), name="zettlecards"),
 ]
@@ -1,25 +1,151 @@
+from functools import partial
+from urllib.parse import urlencode
+from uuid import UUID
+
+from django.db import transaction
+from django.http import Http404, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.dateparse import parse_datetime
+from django.utils.decorators import method_decorator
+from django.utils.http import http_date
 from django.views.generic import TemplateView
 from django_filters.rest_framework import DjangoFilterBackend
-from rest_framework import filters, viewsets
+from rest_framework import filters, status, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.parsers import FormParser, JSONParser, MultiPartParser
+from rest_framework.permissions import SAFE_METHODS, IsAdminUser, IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from backend.zettle.card_cache import get_card_cache
+from backend.zettle.clusters import get_clusters
+from backend.zettle.filters import FullTextSearchFilter, ZettleCardFilter
+from backend.zettle.fragments import get_fragment_cache, render_card
+from backend.zettle.hierarchy import (
+    MAX_TREE_DEPTH,
+    TREE_ORDERINGS,
+    fetch_subtree,
+    walk_subtree,
+)
+from backend.zettle.models import Blob, UploadSession, Vote, ZettleCard
+from backend.zettle.pagination import KEYSET_FIELDS, CardPagination
+from backend.zettle.positions import MAX_MOVED_CARDS, move_cards, shift_cards
+from backend.zettle.search import get_search_backend
+from backend.zettle.sequences import get_sequence, place_cards, reorder_sequence
+from backend.zettle.serializers import (
+    CardOffsetSerializer,
+    CardPositionSerializer,
+    UploadSessionSerializer,
+    ZettleCardSerializer,
+    sparse_fields,
+)
+from backend.zettle.spatial import parse_bbox
+from backend.zettle.sync import (
+    MAX_CHANGES,
+    SyncTokenExpired,
+    garden_version,
+    get_changes,
+    make_etag,
+)
+from backend.zettle.threads import (
+    MAX_BRANCH_LIMIT,
+    MAX_THREAD_DEPTH,
+    THREAD_SORTS,
+    encode_cursor,
+    fetch_thread,
+    walk_thread,
+)
+from backend.zettle.transfer import export_cards, import_cards, import_media
+from backend.zettle.uploads import (
+    UploadChecksumMismatch,
+    UploadOffsetMismatch,
+    append_chunk,
+    delete_partial_file,
+    finish_upload,
+)
+from backend.zettle.votes import cast_vote, retract_vote
+
+# Everything the canvas needs to draw a card, for ``?view=canvas``.
+CANVAS_FIELDS = ["uuid", "card_type", "title", "x", "y"]
+
+# The columns search results are listed with.
+SEARCH_CARDS = ZettleCard.objects.only("uuid", "card_type", "title", "votes")
+
+# Most tags the tag directory lists at once.
+MAX_DIRECTORY_TAGS = 1000
+
+# Serializer fields that are card columns, which sparse requests can defer.
+COLUMNS = {field.name for field in ZettleCard._meta.concrete_fields}
+
+
+def not_modified(request, etag, last_modified):
+    """A 304 Not Modified response when the client's copy is current, or None."""
+    return get_conditional_response(
+        request, etag=etag, last_modified=last_modified and timestamp(last_modified)
+    )
+
+
+def add_validators(response, etag, last_modified):
+    """Set the ``ETag`` and ``Last-Modified`` a client revalidates with."""
+    response["ETag"] = etag
+    if last_modified is not None:
+        response["Last-Modified"] = http_date(timestamp(last_modified))
+    # Cached copies may be kept, but must be revalidated before use.
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
 
-from backend.zettle.filters import ZettleCardFilter
-from backend.zettle.models import ZettleCard
-from backend.zettle.serializers import ZettleCardSerializer
+def card_etag(uuid, request, updated_at):
+    """The ``ETag`` of a card's detail, the same whether it was cached or not."""
+    return make_etag(uuid, request.accepted_media_type, updated_at.timestamp())
 
 
-class ZettleCardViewSet(viewsets.ModelViewSet):
+def timestamp(value):
+    return int(value.timestamp())
+
+
+def canvas_rows(page):
+    return [{name: row[name] for name in CANVAS_FIELDS} for row in page]
+
+
+@method_decorator(transaction.non_atomic_requests, name="dispatch")
+class AtomicWritesMixin:
+    """Wraps only unsafe methods in a transaction, in place of ``ATOMIC_REQUESTS``.
+
+    Reads run in autocommit mode, so they neither open a transaction nor
+    hold one while the response is serialized.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method in SAFE_METHODS:
+            return super().dispatch(request, *args, **kwargs)
+        with transaction.atomic():
+            return super().dispatch(request, *args, **kwargs)
+
+
+class ZettleCardViewSet(AtomicWritesMixin, viewsets.ModelViewSet):
     queryset = ZettleCard.objects.all()
     serializer_class = ZettleCardSerializer
     parser_classes = (MultiPartParser, FormParser, JSONParser)
     filter_backends = [
         DjangoFilterBackend,
-        filters.SearchFilter,
         filters.OrderingFilter,
+        FullTextSearchFilter,
     ]
     filterset_class = ZettleCardFilter
-    search_fields = ["title", "text", "tags__title"]
-    ordering_fields = ["created_at", "updated_at", "votes", "title"]
+    pagination_class = CardPagination
+    ordering_fields = [
+        "created_at",
+        "updated_at",
+        "votes",
+        "title",
+        "child_count",
+        "reply_count",
+        "tag_count",
+    ]
     ordering = ["-created_at"]
 
     lookup_field = "uuid"
@@ -31,12 +157,593 @@ class ZettleCardViewSet(viewsets.ModelViewSet):
         queryset = ZettleCard.objects.all()
 
         # Optimize queries based on the action
-        if self.action == "list":
-            queryset = queryset.select_related("author", "parent")
+        if self.action == "list" and self.is_sparse():
+            # Only load the columns the trimmed serializer will read.
+            fields = sparse_fields(
+                self.request.query_params, ZettleCardSerializer.Meta.fields
+            )
+            columns = [name for name in fields if name in COLUMNS]
+            if "reference" in fields:
+                columns += ["content_type", "object_id"]
+            queryset = queryset.only(*columns)
+            if "tags" in fields:
+                queryset = queryset.prefetch_related("tags")
+        elif self.action in ("list", "retrieve"):
+            # Links are serialized as ids, read from the card's own columns,
+            # so only the tags need another query.
             queryset = queryset.prefetch_related("tags")
+        elif self.action == "fragments":
+            # Fragment keys cover the parent and the tags.
+            queryset = queryset.select_related("parent").prefetch_related("tags")
 
         return queryset
 
+    def is_sparse(self):
+        params = self.request.query_params
+        return bool(params.get("fields") or params.get("omit"))
+
+    def list(self, request, *args, **kwargs):
+        changed, deleted = garden_version()
+        return self.conditional_response(
+            request,
+            etag=make_etag(
+                request.get_full_path(), request.accepted_media_type, changed, deleted
+            ),
+            last_modified=max(filter(None, [changed, deleted]), default=None),
+            view=lambda: (
+                self.list_canvas(request)
+                if request.query_params.get("view") == "canvas"
+                else super(ZettleCardViewSet, self).list(request, *args, **kwargs)
+            ),
+        )
+
+    def list_canvas(self, request):
+        """The lean ``?view=canvas`` projection, read as plain rows.
+
+        Skips model instances and the serializer altogether; the sort columns
+        are only selected for the paginator's cursors.
+        """
+        page = self.paginate_queryset(self.canvas_queryset())
+        return self.get_paginated_response(canvas_rows(page))
+
+    def canvas_queryset(self):
+        queryset = self.filter_queryset(ZettleCard.objects.all())
+        return queryset.values("id", *CANVAS_FIELDS, *KEYSET_FIELDS)
+
+    def retrieve(self, request, *args, **kwargs):
+        if request.query_params:
+            card = self.get_object()
+            return self.conditional_response(
+                request,
+                etag=card_etag(card.uuid, request, card.updated_at),
+                last_modified=card.updated_at,
+                view=lambda: Response(self.get_serializer(card).data),
+            )
+        data = self.cached_card()
+        updated_at = parse_datetime(data["updated_at"])
+        return self.conditional_response(
+            request,
+            etag=card_etag(data["uuid"], request, updated_at),
+            last_modified=updated_at,
+            view=lambda: Response(data),
+        )
+
+    def cached_card(self) -> dict:
+        """The serialized card, read through the card cache.
+
+        Payloads are cached whole, so only reads without query parameters use
+        it. Cards have no object permissions to check, so hits skip
+        ``get_object``.
+        """
+        try:
+            uuid = UUID(str(self.kwargs[self.lookup_field]))
+        except ValueError:
+            raise Http404
+        origin = f"{self.request.scheme}://{self.request.get_host()}"
+        return get_card_cache().get_or_load(uuid, origin, self.load_card)
+
+    def load_card(self):
+        card = self.get_object()
+        return card.pk, self.get_serializer(card).data
+
+    def conditional_response(self, request, etag, last_modified, view):
+        """Answer 304 Not Modified when the client's copy is current."""
+        response = not_modified(request, etag, last_modified)
+        if response is None:
+            response = view()
+        return add_validators(response, etag, last_modified)
+
+    @action(detail=False)
+    def changes(self, request):
+        """Cards changed and deleted since a sync token.
+
+        Without ``since`` every card is returned, along with the token to sync
+        from next time. While ``more`` is true, call again with ``next`` to
+        get the rest. The list filters are refused: a card that stops matching
+        one would just stop being sent, and the client would keep its old copy.
+        """
+        filtered = [
+            name
+            for name in [
+                *self.filterset_class.base_filters,
+                FullTextSearchFilter.search_param,
+            ]
+            if name in request.query_params
+        ]
+        if filtered:
+            raise ValidationError(
+                {name: ["Changes can't be filtered."] for name in filtered}
+            )
+        try:
+            limit = min(
+                int(request.query_params.get("limit", MAX_CHANGES)), MAX_CHANGES
+            )
+        except ValueError:
+            raise ValidationError({"limit": ["A valid integer is required."]})
+        queryset = self.get_queryset().prefetch_related("tags")
+        try:
+            cards, deleted, next_token, more = get_changes(
+                queryset, request.query_params.get("since"), max(limit, 1)
+            )
+        except ValueError as e:
+            raise ValidationError({"since": [str(e)]})
+        except SyncTokenExpired:
+            return Response(
+                {"detail": "Sync token expired, download all cards again."},
+                status=status.HTTP_410_GONE,
+            )
+        return Response(
+            {
+                "cards": self.get_serializer(cards, many=True).data,
+                "deleted": deleted,
+                "next": next_token,
+                "more": more,
+            }
+        )
+
+    @action(detail=False, permission_classes=[IsAdminUser])
+    def export(self, request):
+        """Every card, with its links and tags, streamed as NDJSON."""
+        response = StreamingHttpResponse(
+            export_cards(), content_type="application/x-ndjson"
+        )
+        response["Content-Disposition"] = 'attachment; filename="garden.ndjson"'
+        return response
+
+    @action(
+        detail=False,
+        methods=["post"],
+        url_path="import",
+        permission_classes=[IsAdminUser],
+        parser_classes=[MultiPartParser],
+    )
+    def import_garden(self, request):
+        """Load an exported ``file``, and optionally a ``media`` tar archive."""
+        if "file" not in request.FILES:
+            raise ValidationError({"file": ["No file was submitted."]})
+        if "media" in request.FILES:
+            import_media(request.FILES["media"])
+        try:
+            counts = import_cards(request.FILES["file"])
+        except ValueError as e:
+            raise ValidationError({"file": [str(e)]})
+        return Response(counts)
+
+    @action(detail=False)
+    def fragments(self, request):
+        """Each listed card's rendered HTML, served from the fragment cache."""
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        return self.get_paginated_response(
+            [{"uuid": card.uuid, "html": render_card(card)} for card in page]
+        )
+
+    @action(detail=False, url_path="fragments/stats", permission_classes=[IsAdminUser])
+    def fragment_stats(self, request):
+        """Hit and miss counts of this process's fragment cache."""
+        return Response(get_fragment_cache().stats())
+
+    @action(detail=False, url_path="cache/stats", permission_classes=[IsAdminUser])
+    def card_cache_stats(self, request):
+        """Hit and miss counts of this process's card cache."""
+        return Response(get_card_cache().stats())
+
+    @action(detail=False, url_path="tags")
+    def tag_directory(self, request):
+        """Cards used as tags, most used first, with their ``tag_count``.
+
+        Reads the stored counts, so no links are counted. ``?card_type=``
+        narrows the directory, e.g. to topics.
+        """
+        try:
+            limit = min(int(request.query_params.get("limit", 50)), MAX_DIRECTORY_TAGS)
+        except ValueError:
+            raise ValidationError({"limit": ["A valid integer is required."]})
+        cards = ZettleCard.objects.filter(tag_count__gt=0)
+        if request.query_params.get("card_type"):
+            cards = cards.filter(card_type=request.query_params["card_type"])
+        return Response(
+            cards.order_by("-tag_count", "-id").values(
+                "uuid", "card_type", "title", "tag_count"
+            )[: max(limit, 1)]
+        )
+
+    @action(detail=False)
+    def clusters(self, request):
+        """Pre-aggregated card clusters for a zoomed-out viewport."""
+        try:
+            bbox = parse_bbox(request.query_params.get("bbox", ""))
+        except ValueError as e:
+            raise ValidationError({"bbox": [str(e)]})
+        try:
+            zoom = float(request.query_params.get("zoom", 0.25))
+            clusters = get_clusters(zoom, bbox)
+        except ValueError as e:
+            raise ValidationError({"zoom": [str(e)]})
+        return Response(clusters)
+
+    @action(detail=False, methods=["post"])
+    def move(self, request):
+        """Move many cards in one request, e.g. a dragged group selection.
+
+        Accepts either a list of ``{"uuid", "x", "y"}`` positions or
+        ``{"uuids": [...], "dx": n, "dy": n}`` to shift a selection. Cards
+        without a position are left where they are by a shift.
+        """
+        if isinstance(request.data, list):
+            # The length is checked before validating any of the items.
+            serializer = CardPositionSerializer(
+                data=request.data, many=True, max_length=MAX_MOVED_CARDS
+            )
+            serializer.is_valid(raise_exception=True)
+            positions = {
+                move["uuid"]: (move["x"], move["y"])
+                for move in serializer.validated_data
+            }
+            move = partial(move_cards, positions)
+        else:
+            serializer = CardOffsetSerializer(data=request.data)
+            serializer.is_valid(raise_exception=True)
+            move = partial(shift_cards, **serializer.validated_data)
+
+        try:
+            cards = move()
+        except ValueError as e:
+            raise ValidationError({"non_field_errors": [str(e)]})
+        return Response(
+            [{"uuid": card.uuid, "x": card.x, "y": card.y} for card in cards]
+        )
+
+    @action(detail=True)
+    def tree(self, request, uuid=None):
+        """The card and its nested descendants, fetched in a single query."""
+        card = self.get_object()
+        depth, ordering = self.tree_params(request)
+        return Response(self.nest_tree(fetch_subtree(card, depth, ordering)))
+
+    def tree_params(self, request):
+        """The ``depth`` and sibling ``ordering`` of a tree request."""
+        try:
+            depth = int(request.query_params.get("depth", MAX_TREE_DEPTH))
+        except ValueError:
+            raise ValidationError({"depth": ["A valid integer is required."]})
+        if not 0 <= depth <= MAX_TREE_DEPTH:
+            raise ValidationError(
+                {"depth": [f"Depth must be between 0 and {MAX_TREE_DEPTH}."]}
+            )
+        ordering = request.query_params.get("ordering", "created_at")
+        if ordering not in TREE_ORDERINGS:
+            raise ValidationError(
+                {"ordering": [f"Ordering must be one of {', '.join(TREE_ORDERINGS)}."]}
+            )
+        return depth, ordering
+
+    def nest_tree(self, root):
+        """The serialized subtree under a fetched ``root``, children nested."""
+        cards = list(walk_subtree(root))
+        serializer = self.get_serializer(cards, many=True)
+        nodes = {}
+        for node, data in zip(cards, serializer.data):
+            nodes[node.pk] = {
+                **data,
+                "depth": node.tree_depth,
+                "child_count": node.child_count,
+                "children": [],
+            }
+            if node is not root:
+                nodes[node.parent_id]["children"].append(nodes[node.pk])
+        return nodes[root.pk]
+
+    @action(detail=True)
+    def ancestors(self, request, uuid=None):
+        """Breadcrumbs from the root down to the card's parent."""
+        card = self.get_object()
+        serializer = self.get_serializer(
+            card.get_ancestors().prefetch_related("tags"), many=True
+        )
+        return Response(serializer.data)
+
+    @action(detail=True)
+    def descendants(self, request, uuid=None):
+        """Every card below this one, at any depth, paginated with a total count."""
+        card = self.get_object()
+        queryset = self.filter_queryset(card.get_descendants().prefetch_related("tags"))
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @action(detail=True)
+    def thread(self, request, uuid=None):
+        """The card and its ranked, nested replies, fetched in a single query.
+
+        Each branch carries a ``next`` link that loads its further replies.
+        """
+        sort = request.query_params.get("sort", "hot")
+        if sort not in THREAD_SORTS:
+            raise ValidationError(
+                {"sort": [f"Sort must be one of {', '.join(THREAD_SORTS)}."]}
+            )
+        params = {}
+        for name, default, maximum in [
+            ("depth", MAX_THREAD_DEPTH, MAX_THREAD_DEPTH),
+            ("limit", 20, MAX_BRANCH_LIMIT),
+        ]:
+            try:
+                params[name] = int(request.query_params.get(name, default))
+            except ValueError:
+                raise ValidationError({name: ["A valid integer is required."]})
+            if not 0 <= params[name] <= maximum:
+                raise ValidationError(
+                    {name: [f"{name.capitalize()} must be between 0 and {maximum}."]}
+                )
+        try:
+            uuid = UUID(uuid)
+        except ValueError:
+            raise Http404
+        try:
+            root = fetch_thread(
+                uuid, sort, cursor=request.query_params.get("cursor"), **params
+            )
+        except ValueError as e:
+            raise ValidationError({"cursor": [str(e)]})
+        if root is None:
+            raise Http404
+        self.check_object_permissions(request, root)
+
+        cards = list(walk_thread(root))
+        serializer = self.get_serializer(cards, many=True)
+        nodes = {}
+        for node, data in zip(cards, serializer.data):
+            next_url = None
+            if node.thread_has_more:
+                query = {"sort": sort, **params}
+                if node.thread_replies:
+                    query["cursor"] = encode_cursor(node.thread_replies[-1], sort)
+                next_url = request.build_absolute_uri(
+                    reverse("zettle:zettlecard-thread", kwargs={"uuid": node.uuid})
+                    + "?"
+                    + urlencode(query)
+                )
+            nodes[node.pk] = {
+                **data,
+                "depth": node.thread_depth,
+                "reply_count": node.reply_count,
+                "replies": [],
+                "next": next_url,
+            }
+            if node is not root:
+                nodes[node.reply_to_id]["replies"].append(nodes[node.pk])
+        return Response(nodes[root.pk])
+
+    @action(detail=True, methods=["get", "post", "put"])
+    def sequence(self, request, uuid=None):
+        """The card's whole sequence in order.
+
+        POST ``{"cards": [uuid, ...], "after": uuid | null}`` inserts or moves
+        cards into the sequence after ``after`` (at the start for null, at the
+        end when omitted). PUT ``{"order": [uuid, ...]}`` reorders the whole
+        sequence.
+        """
+        card = self.get_object()
+        if request.method != "GET" and not isinstance(request.data, dict):
+            raise ValidationError(
+                {"non_field_errors": ['Expected an object, like {"cards": [...]}.']}
+            )
+        try:
+            if request.method == "POST":
+                cards = self._cards_by_uuid(request.data.get("cards"), "cards")
+                after = None
+                if request.data.get("after") is not None:
+                    (after,) = self._cards_by_uuid([request.data["after"]], "after")
+                place_cards(card, cards, after, at_end="after" not in request.data)
+            elif request.method == "PUT":
+                reorder_sequence(
+                    card, self._cards_by_uuid(request.data.get("order"), "order")
+                )
+        except ValueError as e:
+            raise ValidationError({"non_field_errors": [str(e)]})
+
+        serializer = self.get_serializer(
+            get_sequence(card).prefetch_related("tags"), many=True
+        )
+        return Response(serializer.data)
+
+    def _cards_by_uuid(self, uuids, field):
+        """Load the cards for a request list of uuids, in the given order."""
+        if not isinstance(uuids, list) or not uuids:
+            raise ValidationError({field: ["A non-empty list of uuids is required."]})
+        try:
+            uuids = list(dict.fromkeys(UUID(str(value)) for value in uuids))
+        except ValueError:
+            raise ValidationError({field: ["Invalid uuid."]})
+        cards = {card.uuid: card for card in ZettleCard.objects.filter(uuid__in=uuids)}
+        missing = [str(value) for value in uuids if value not in cards]
+        if missing:
+            raise ValidationError({field: [f"Unknown cards: {', '.join(missing)}."]})
+        return [cards[value] for value in uuids]
+
+    @action(detail=False)
+    def search(self, request):
+        """Ranked full-text matches with highlighted snippets."""
+        results = get_search_backend().search(*self.search_params(request))
+        cards = SEARCH_CARDS.in_bulk([card_id for card_id, _, _ in results])
+        return Response(search_hits(results, cards))
+
+    def search_params(self, request):
+        """The ``query``, ``limit`` and ``by_votes`` of a search request."""
+        query = request.query_params.get("q", "")
+        try:
+            limit = max(1, min(int(request.query_params.get("limit", 20)), 100))
+        except ValueError:
+            raise ValidationError({"limit": ["A valid integer is required."]})
+        return query, limit, request.query_params.get("rank") == "votes"
+
+
+def search_hits(results, cards):
+    """Search ``results`` with the fields of their ``cards``, by id."""
+    return [
+        {
+            "uuid": cards[card_id].uuid,
+            "card_type": cards[card_id].card_type,
+            "title": cards[card_id].title,
+            "votes": cards[card_id].votes,
+            "score": score,
+            "snippet": snippet,
+        }
+        for card_id, score, snippet in results
+        if card_id in cards
+    ]
+
+
+@method_decorator(transaction.non_atomic_requests, name="dispatch")
+class ZettleCardVoteView(APIView):
+    """Vote on a card with POST ``{"value": 1 | -1}``, or retract it with DELETE.
+
+    Runs outside the per-request transaction, so the card row is only locked
+    while the vote is recorded rather than until the response is sent.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, uuid):
+        if not isinstance(request.data, dict):
+            raise ValidationError(
+                {"non_field_errors": ['Expected an object, like {"value": 1}.']}
+            )
+        try:
+            value = int(request.data.get("value", Vote.Value.UP))
+        except (TypeError, ValueError):
+            value = None
+        if value not in Vote.Value.values:
+            raise ValidationError(
+                {"value": [f"Value must be one of {Vote.Value.values}."]}
+            )
+        card = get_object_or_404(ZettleCard, uuid=uuid)
+        cast_vote(card, request.user, value)
+        return self.vote_response(card, value)
+
+    def delete(self, request, uuid):
+        card = get_object_or_404(ZettleCard, uuid=uuid)
+        retract_vote(card, request.user)
+        return self.vote_response(card, None)
+
+    def vote_response(self, card, value):
+        return Response(
+            {
+                "uuid": card.uuid,
+                "votes": card.votes,
+                "hot_score": card.hot_score,
+                "vote": value,
+            }
+        )
+
+
+class UploadListView(APIView):
+    """Start a resumable upload with POST ``{"filename", "size", "sha256"}``.
+
+    When ``sha256`` (optional) is the hash of a stored file, nothing needs to
+    be uploaded and the response is already ``complete``.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        serializer = UploadSessionSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        sha256 = serializer.validated_data.get("sha256")
+        if sha256 and Blob.objects.filter(sha256=sha256).exists():
+            session = UploadSession(
+                uuid=None,
+                offset=serializer.validated_data["size"],
+                **serializer.validated_data,
+            )
+            return Response(UploadSessionSerializer(session).data)
+        session = serializer.save(user=request.user)
+        return Response(
+            serializer.data,
+            status=status.HTTP_201_CREATED,
+            headers={"Location": reverse("zettle:upload-detail", args=[session.uuid])},
+        )
+
+
+class UploadDetailView(APIView):
+    """Send the next chunk of a resumable upload with PATCH, or see its progress.
+
+    Each PATCH body is appended at the ``Upload-Offset`` header, which must
+    be the current ``offset``; after a dropped connection, GET the offset
+    and resume from there. The response to the last chunk has the file's
+    ``sha256``, to create cards with as ``image_blob`` or ``document_blob``.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def get_session(self, request, uuid, lock=False):
+        sessions = UploadSession.objects.filter(user=request.user)
+        if lock:
+            sessions = sessions.select_for_update()
+        return get_object_or_404(sessions, uuid=uuid)
+
+    def get(self, request, uuid):
+        return Response(UploadSessionSerializer(self.get_session(request, uuid)).data)
+
+    def patch(self, request, uuid):
+        try:
+            offset = int(request.headers["Upload-Offset"])
+        except (KeyError, ValueError):
+            raise ValidationError({"Upload-Offset": ["A valid integer is required."]})
+        session = self.get_session(request, uuid, lock=True)
+        try:
+            complete = append_chunk(session, offset, request.stream)
+        except UploadOffsetMismatch:
+            return Response(
+                {"detail": "Upload-Offset doesn't match.", "offset": session.offset},
+                status=status.HTTP_409_CONFLICT,
+            )
+        except ValueError as e:
+            raise ValidationError({"non_field_errors": [str(e)]})
+        if not complete:
+            session.save(update_fields=["offset", "updated_at"])
+            return Response(UploadSessionSerializer(session).data)
+
+        try:
+            session.sha256 = finish_upload(session)
+        except UploadChecksumMismatch:
+            # Returned rather than raised, so the request's transaction still
+            # commits the deletion.
+            session.delete()
+            return Response(
+                {"sha256": ["The uploaded file doesn't match this hash."]},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        session.delete()
+        return Response(UploadSessionSerializer(session).data)
+
+    def delete(self, request, uuid):
+        session = self.get_session(request, uuid)
+        delete_partial_file(session)
+        session.delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
 
 class ZettleCardView(TemplateView):
     template_name = "zettle/zettlecards.html"
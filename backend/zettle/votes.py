@@ -0,0 +1,45 @@
+from django.db import transaction
+
+from backend.zettle.clusters import card_state, update_tiles
+from backend.zettle.models import Vote, ZettleCard
+
+
+def _apply_delta(card: ZettleCard, delta: int):
+    if not delta:
+        return
+    old_state = card_state(card, loaded=True)
+    card.add_votes(delta)
+    new_state = card_state(card, loaded=True)
+    # Tiles are shared by many cards, so their lock is taken after the vote
+    # has committed instead of while the card row is locked.
+    transaction.on_commit(lambda: update_tiles(removed=[old_state], added=[new_state]))
+
+
+def cast_vote(card: ZettleCard, user, value=Vote.Value.UP) -> int:
+    """Record ``user``'s vote on ``card``, returning the change to its count.
+
+    Voting again with the same value changes nothing, and switching sides
+    moves the count by two. Only this user's ledger row and the card row are
+    locked, and only for the length of this call's transaction.
+    """
+    with transaction.atomic():
+        vote, created = Vote.objects.select_for_update().get_or_create(
+            card=card, user=user, defaults={"value": value}
+        )
+        delta = value if created else value - vote.value
+        if not created and delta:
+            vote.value = value
+            vote.save(update_fields=["value"])
+        _apply_delta(card, delta)
+    return delta
+
+
+def retract_vote(card: ZettleCard, user) -> int:
+    """Remove ``user``'s vote on ``card``, if any, returning the change to its count."""
+    with transaction.atomic():
+        vote = Vote.objects.select_for_update().filter(card=card, user=user).first()
+        if vote is None:
+            return 0
+        vote.delete()
+        _apply_delta(card, -vote.value)
+    return -vote.value